@@ -112,6 +112,9 @@ def client(request):
             # Activate debug headers
             os.environ['QGIS_WMTS_CACHE_DEBUG_HEADERS'] = 'true'
 
+            # Activate the tiles cache management API
+            os.environ['QGIS_TILES_MANAGEMENT_ENABLED'] = 'yes'
+
             self.datapath = request.config.rootdir.join('data')
             self.server = QgsServer()
 
@@ -145,6 +148,9 @@ def client(request):
         def get(self, *args, **kwargs) -> OWSResponse:
             return self.request(QgsServerRequest.GetMethod, *args, **kwargs)
 
+        def post(self, *args, **kwargs) -> OWSResponse:
+            return self.request(QgsServerRequest.PostMethod, *args, **kwargs)
+
         def delete(self, *args, **kwargs) -> OWSResponse:
             return self.request(QgsServerRequest.DeleteMethod, *args, **kwargs)
 
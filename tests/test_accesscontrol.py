@@ -0,0 +1,115 @@
+""" Test the access control partitioning of the tile caches
+"""
+from qgis.core import QgsVectorLayer
+from qgis.server import QgsBufferServerRequest, QgsServerRequest
+
+
+class _AccessControls:
+    """ Access controls with a filter for one layer
+    """
+
+    def __init__(self, filtered=None, readable=True, cache_key=(), hidden=()):
+        self._filtered = filtered
+        self._readable = readable
+        self._cache_key = list(cache_key)
+        self._hidden = set(hidden)
+
+    def layerReadPermission(self, layer):
+        return self._readable
+
+    def layerFilterExpression(self, layer):
+        return "\"name\" = 'a'" if layer.id() == self._filtered else ''
+
+    def extraSubsetString(self, layer):
+        return ''
+
+    def layerAttributes(self, layer, attributes):
+        return [name for name in attributes if name not in self._hidden]
+
+    def fillCacheKey(self, cache_key):
+        return True, self._cache_key
+
+
+def test_access_control_key(client, monkeypatch):
+    """ Test public and restricted partitions
+    """
+    from tilesForServer.accesscontrol import PUBLIC, access_control_key
+
+    layers = [
+        QgsVectorLayer("Point?crs=EPSG:4326&field=name:string", "points", "memory"),
+        QgsVectorLayer("Point?crs=EPSG:4326&field=name:string", "others", "memory"),
+    ]
+
+    assert access_control_key(layers, None) == PUBLIC
+    assert access_control_key(layers, _AccessControls()) == PUBLIC
+    # Cache key of the filters is not relevant without restriction
+    assert access_control_key(layers, _AccessControls(cache_key=['admin'])) == PUBLIC
+
+    restricted = access_control_key(layers, _AccessControls(filtered=layers[0].id()))
+    assert restricted != PUBLIC
+    assert restricted == access_control_key(layers, _AccessControls(filtered=layers[0].id()))
+    assert restricted != access_control_key(layers, _AccessControls(filtered=layers[1].id()))
+    assert restricted != access_control_key(layers, _AccessControls(filtered=layers[0].id(),
+                                                                    cache_key=['admin']))
+    assert access_control_key(layers, _AccessControls(readable=False)) not in (PUBLIC, restricted)
+
+    # Hidden attributes
+    hidden = access_control_key(layers, _AccessControls(hidden=['name']))
+    assert hidden not in (PUBLIC, restricted)
+    assert hidden == access_control_key(layers, _AccessControls(hidden=['name']))
+    assert access_control_key(layers, _AccessControls(hidden=['other'])) == PUBLIC
+
+    # User roles from the request headers
+    monkeypatch.setenv('QGIS_TILES_ACL_HEADERS', 'X-User-Groups')
+    acl = _AccessControls(filtered=layers[0].id())
+    req1 = QgsBufferServerRequest('/tms', QgsServerRequest.GetMethod, {'X-User-Groups': 'admins'})
+    req2 = QgsBufferServerRequest('/tms', QgsServerRequest.GetMethod, {'X-User-Groups': 'users'})
+    assert access_control_key(layers, acl, req1) != access_control_key(layers, acl, req2)
+
+
+def test_authorized_attributes(client):
+    """ Test the attributes written to restricted vector tiles
+    """
+    from tilesForServer.accesscontrol import authorized_attributes
+
+    layer = QgsVectorLayer("Point?crs=EPSG:4326&field=name:string&field=owner:string", "points", "memory")
+    assert authorized_attributes(layer, _AccessControls()) is None
+    assert authorized_attributes(layer, _AccessControls(hidden=['owner'])) == ['name']
+    assert authorized_attributes(layer, _AccessControls(hidden=['name', 'owner'])) == []
+
+
+def test_tilemap_generation(client, tmp_path, monkeypatch):
+    """ Test the generations of the restricted partitions
+    """
+    from qgis.core import QgsProject
+
+    from tilesForServer.generation import bump_generation, tilemap_generation
+
+    monkeypatch.setenv('QGIS_TILES_GENERATION_PATH', str(tmp_path))
+    project = QgsProject()
+    project.setFileName(str(tmp_path.joinpath('project.qgs')))
+
+    assert tilemap_generation(project, 'france_parts') == 0
+    assert bump_generation(project, 'france_parts') == 1
+    assert tilemap_generation(project, 'france_parts') == 1
+    for _ in range(9):
+        bump_generation(project, 'france_parts')
+    assert tilemap_generation(project, 'france_parts') == 10
+    # Other tile maps are not invalidated
+    assert tilemap_generation(project, 'other') == 0
+
+
+def test_partition_forwarded(client, monkeypatch):
+    """ Test the headers required by background requests of a partition
+    """
+    from tilesForServer.accesscontrol import PUBLIC, partition_forwarded
+
+    monkeypatch.delenv('QGIS_TILES_ACL_HEADERS', raising=False)
+    assert partition_forwarded(PUBLIC, [])
+    assert not partition_forwarded('restricted', [])
+    assert not partition_forwarded('restricted', ['Authorization'])
+
+    monkeypatch.setenv('QGIS_TILES_ACL_HEADERS', 'X-User-Groups')
+    assert not partition_forwarded('restricted', ['X-User-Groups'])
+    assert not partition_forwarded('restricted', ['Authorization'])
+    assert partition_forwarded('restricted', ['authorization', 'x-user-groups'])
@@ -0,0 +1,68 @@
+""" Test the access log and the replay tool
+"""
+import json
+
+from qgis.core import QgsProject
+
+
+def test_access_log(client, tmp_path, monkeypatch):
+    """ Test that tile requests are logged
+    """
+    from tilesForServer import accesslog
+    from tilesForServer.accesslog import AccessLog
+
+    path = tmp_path.joinpath('access.log')
+    monkeypatch.setattr(accesslog, '_access_log', AccessLog(str(path), buffer_size=2))
+    monkeypatch.setattr(accesslog, '_initialized', True)
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    rv = client.get("/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName())
+    assert rv.status_code == 200
+    # Buffered
+    assert not path.exists()
+
+    rv = client.get("/tms/france_parts?MAP=%s" % project.fileName())
+    assert rv.status_code == 200
+
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(entries) == 2
+
+    tile = entries[0]
+    assert tile['path'] == '/tms/france_parts/0/0/0.png'
+    assert tile['status'] == 200
+    assert tile['tilemap'] == 'france_parts'
+    assert tile['tms'] == 'EPSG:3857'
+    assert (tile['z'], tile['x'], tile['y']) == (0, 0, 0)
+    assert tile['format'] == 'png'
+    assert tile['cache'] in ('miss', 'cache-manager', 'shm', 'redis')
+    assert tile['duration'] >= 0
+    assert tile['project'] == project.fileName()
+
+    assert 'z' not in entries[1]
+
+
+def test_replay_urls(client, tmp_path):
+    """ Test the replay tool log parsing
+    """
+    from tilesForServer.replay import entry_url, percentile, popular_urls, read_log
+
+    path = tmp_path.joinpath('access.log')
+    path.write_text('\n'.join([
+        '{"path":"/tms/a/0/0/0.png","query":"MAP=p.qgs","z":0}',
+        '{"path":"/tms/a/1/0/0.png","query":"MAP=p.qgs","z":1}',
+        'invalid',
+        '{"path":"/tms/a/1/0/0.png","query":"MAP=p.qgs","z":1}',
+        '{"path":"/tms","query":""}',
+    ]))
+
+    entries = list(read_log(str(path)))
+    assert len(entries) == 4
+    assert entry_url(entries[0]) == '/tms/a/0/0/0.png?MAP=p.qgs'
+    assert entry_url(entries[3]) == '/tms'
+
+    assert popular_urls(entries)[0] == ('/tms/a/1/0/0.png?MAP=p.qgs', 2)
+
+    assert percentile([1., 2., 3., 4.], 50) == 2.
+    assert percentile([1., 2., 3., 4.], 99) == 4.
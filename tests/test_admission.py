@@ -0,0 +1,96 @@
+""" Test admission control of tile renders
+"""
+import fcntl
+import multiprocessing
+import os
+
+import pytest
+
+
+def _hold_slots(path: str, offsets, ready, release) -> None:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    for offset in offsets:
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset)
+    ready.set()
+    release.wait()
+
+
+@pytest.fixture
+def busy_slot(tmp_path):
+    """ Hold the render slot of a tile map from an other process
+    """
+    ready = multiprocessing.Event()
+    release = multiprocessing.Event()
+
+    def hold(name, offsets):
+        proc = multiprocessing.Process(target=_hold_slots,
+                                       args=(str(tmp_path / f"{name}.lock"), offsets, ready, release))
+        proc.start()
+        ready.wait(5)
+        return proc
+
+    procs = []
+    yield lambda name, offsets: procs.append(hold(name, offsets))
+    release.set()
+    for proc in procs:
+        proc.join()
+
+
+def test_admission_unlimited(client, tmp_path):
+    """ Test that renders are not limited without slots
+    """
+    from tilesForServer.admission import AdmissionControl
+
+    control = AdmissionControl(str(tmp_path))
+    with control.admit('tilemap', 0):
+        pass
+    assert not list(tmp_path.iterdir())
+
+
+def test_admission_reject(client, tmp_path, busy_slot):
+    """ Test that requests are rejected when the queue is full
+    """
+    from tilesForServer.admission import AdmissionControl
+    from tilesForServer.apiutils import HTTPError
+
+    control = AdmissionControl(str(tmp_path), queue_size=1, queue_timeout=0.1, retry_after=3)
+
+    # Render and queue slots are busy
+    busy_slot('busy', [0, 1])
+    with pytest.raises(HTTPError) as err:
+        with control.admit('busy', 1):
+            pass
+    assert err.value.status_code == 503
+    assert err.value.headers == {'Retry-After': '3'}
+
+    # Other tile maps are admitted
+    with control.admit('other', 1):
+        pass
+
+    stats = control.stats()
+    assert stats['rejected'] == 1
+    assert stats['admitted'] == 1
+
+
+def test_admission_queue_timeout(client, tmp_path, busy_slot):
+    """ Test that queued requests wait for a render slot
+    """
+    from tilesForServer.admission import AdmissionControl
+    from tilesForServer.apiutils import HTTPError
+
+    control = AdmissionControl(str(tmp_path), queue_size=1, queue_timeout=0.1)
+
+    busy_slot('busy', [0])
+    with pytest.raises(HTTPError) as err:
+        with control.admit('busy', 1):
+            pass
+    assert err.value.status_code == 503
+    # Seeding requests are not queued
+    with pytest.raises(HTTPError):
+        with control.admit('busy', 1, queue=False):
+            pass
+
+    stats = control.stats()
+    assert stats['queued'] == 1
+    assert stats['timeouts'] == 1
+    assert stats['rejected'] == 1
@@ -0,0 +1,50 @@
+""" Test the request handler utilities
+"""
+from qgis.server import (
+    QgsBufferServerRequest,
+    QgsBufferServerResponse,
+    QgsServerRequest,
+)
+
+
+class _Context:
+
+    def __init__(self) -> None:
+        self._request = QgsBufferServerRequest('/tms', QgsServerRequest.GetMethod, {}, None)
+        self._response = QgsBufferServerResponse()
+
+    def request(self):
+        return self._request
+
+    def response(self):
+        return self._response
+
+    def project(self):
+        return None
+
+
+def test_write_stream(client):
+    """ Test chunked writes
+    """
+    from tilesForServer.apiutils import STREAM_CHUNK_SIZE, RequestHandler
+
+    context = _Context()
+    handler = RequestHandler(None, context)
+    handler.set_header('Content-Type', 'application/octet-stream')
+
+    data = bytes(range(256)) * (STREAM_CHUNK_SIZE // 128 + 3)
+    handler.write(memoryview(data))
+    handler.finish()
+
+    response = context.response()
+    assert response.headersSent()
+    assert bytes(response.body()) == data
+
+    # Small chunks are not streamed
+    context = _Context()
+    handler = RequestHandler(None, context)
+    handler.write(memoryview(b'tile'))
+    handler.write({'status': 'ok'})
+    assert not context.response().headersSent()
+    handler.finish()
+    assert bytes(context.response().body()) == b'tile{"status": "ok"}'
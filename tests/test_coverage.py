@@ -0,0 +1,90 @@
+""" Test the coverage index of vector tile maps
+"""
+
+
+def test_coverage_index(client):
+    """ Test covered tiles at and above the base zoom level
+    """
+    from tilesForServer.coverage import CoverageIndex
+
+    index = CoverageIndex(4, 10, 20, 8, 4)
+    index.add(11, 21, 12, 21)
+
+    assert index.covers(4, 11, 21)
+    assert index.covers(4, 12, 21)
+    assert not index.covers(4, 13, 21)
+    assert not index.covers(4, 11, 22)
+    # Children of the covered tiles
+    assert index.covers(6, 11 * 4 + 3, 21 * 4)
+    assert not index.covers(6, 13 * 4, 21 * 4)
+    # Tiles below the base zoom level are always covered
+    assert index.covers(2, 0, 0)
+    # Tiles outside of the range
+    assert not index.covers(4, 0, 0)
+
+    # Features outside of the range make the index unbounded
+    index.add(9, 20, 10, 20)
+    assert index.unbounded
+    assert index.covers(4, 10, 20)
+    assert index.covers(4, 0, 0)
+
+
+def test_coverage_index_persistence(client, tmp_path):
+    """ Test saving and loading the coverage index
+    """
+    import pytest
+
+    from tilesForServer.coverage import CoverageIndex
+
+    index = CoverageIndex(14, 100, 200, 30, 20)
+    index.add(105, 210, 106, 211)
+    path = str(tmp_path / 'coverage' / 'index.cov')
+    index.save(path)
+
+    loaded = CoverageIndex.load(path)
+    assert (loaded.zoom, loaded.col_min, loaded.row_min, loaded.width, loaded.height) == (14, 100, 200, 30, 20)
+    assert not loaded.unbounded
+    assert loaded.to_bytes() == index.to_bytes()
+    assert loaded.covers(15, 211, 421)
+    assert not loaded.covers(15, 200, 400)
+
+    with pytest.raises(ValueError):
+        CoverageIndex.from_bytes(index.to_bytes()[:-1])
+
+
+def test_coverage_index_update(client, tmp_path, monkeypatch):
+    """ Test building the coverage index out of the request path
+    """
+    from types import SimpleNamespace
+
+    from tilesForServer import coverage
+
+    path = str(tmp_path / 'coverage' / 'index.cov')
+    monkeypatch.setattr(coverage, 'coverage_path', lambda *args: path)
+
+    built = []
+
+    def build(project, layers, tms, zoom):
+        built.append(zoom)
+        index = coverage.CoverageIndex(zoom, 0, 0, 4, 4)
+        index.add(1, 1, 1, 1)
+        return index
+
+    monkeypatch.setattr(coverage, 'build_coverage_index', build)
+    tms = SimpleNamespace(identifier='EPSG:3857')
+
+    # Tiles are covered until the index is built
+    assert coverage.coverage_index(None, 'a', tms, 4) is None
+    assert not built
+
+    assert coverage.update_coverage_index(None, 'a', tms, 4, []) is not None
+    assert built == [4]
+    # Existing indexes are built again only when forced
+    coverage.update_coverage_index(None, 'a', tms, 4, [])
+    assert built == [4]
+    coverage.update_coverage_index(None, 'a', tms, 4, [], force=True)
+    assert built == [4, 4]
+
+    index = coverage.coverage_index(None, 'a', tms, 4)
+    assert index.covers(4, 1, 1)
+    assert not index.covers(4, 2, 2)
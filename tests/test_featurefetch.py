@@ -0,0 +1,51 @@
+""" Test concurrent feature fetching
+"""
+from qgis.core import QgsProject, QgsRectangle
+
+
+def test_fetch_layers(client):
+    """ Test fetching the features of layers into memory layers
+    """
+    from tilesForServer.featurefetch import FID_FIELD, FeatureFetcher
+
+    project = QgsProject()
+    assert project.read(client.getprojectpath("france_parts.qgs").strpath)
+
+    layer = project.mapLayersByName('france_parts')[0]
+    extent = layer.extent()
+    expression = f"\"{layer.fields()[0].name()}\" IS NOT NULL"
+
+    fetcher = FeatureFetcher(2)
+    fetched = fetcher.fetch_layers(project, [(layer, None, None), (layer, expression, None)],
+                                   extent, layer.crs())
+
+    assert len(fetched) == 2
+    for memory_layer in fetched:
+        assert memory_layer.name() == layer.name()
+        assert memory_layer.fields().names() == layer.fields().names() + [FID_FIELD]
+        assert memory_layer.featureCount() == layer.featureCount()
+        # Source feature ids are kept
+        assert sorted(f[FID_FIELD] for f in memory_layer.getFeatures()) == sorted(f.id() for f in layer.getFeatures())
+
+    # Features outside of the extent are not fetched
+    empty = QgsRectangle(extent.xMaximum() + 1, extent.yMaximum() + 1,
+                         extent.xMaximum() + 2, extent.yMaximum() + 2)
+    fetched = fetcher.fetch_layers(project, [(layer, None, None)], empty, layer.crs())
+    assert fetched[0].featureCount() == 0
+
+
+def test_copy_layer_attributes(client):
+    """ Test that only the authorized attributes are copied
+    """
+    from tilesForServer.featurefetch import FID_FIELD, copy_layer
+
+    project = QgsProject()
+    assert project.read(client.getprojectpath("france_parts.qgs").strpath)
+
+    layer = project.mapLayersByName('france_parts')[0]
+    name = layer.fields()[1].name()
+
+    copy = copy_layer(project, layer, None, [name], layer.extent(), layer.crs())
+    assert copy.fields().names() == [name, FID_FIELD]
+    assert copy.featureCount() == layer.featureCount()
+    assert sorted(f[name] for f in copy.getFeatures()) == sorted(f[name] for f in layer.getFeatures())
@@ -0,0 +1,126 @@
+import json
+import logging
+
+from qgis.core import Qgis, QgsProject
+
+LOGGER = logging.getLogger('server')
+
+
+def test_ogcapi_landingpage(client):
+    """ Test the OGC API Tiles - Landing page
+        /ogcapi/tiles?
+    """
+    plugin = client.getplugin('tilesForServer')
+    assert plugin is not None
+
+    # Get project
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    qs = "/ogcapi/tiles?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type',"").startswith('application/json')
+
+    json_content = json.loads(rv.content)
+    assert 'links' in json_content
+    assert '/ogcapi/tiles/tileMatrixSets' in json_content['links'][0]['href']
+    assert '/ogcapi/tiles/collections/france_parts/tiles' in json_content['links'][1]['href']
+    assert len(json_content['tilesets']) == 2
+
+    # No project
+    qs = "/ogcapi/tiles?"
+    rv = client.get(qs)
+    assert rv.status_code == 400
+
+
+def test_ogcapi_tilematrixsets(client):
+    """ Test the OGC API Tiles - Tile matrix sets
+        /ogcapi/tiles/tileMatrixSets/{tileMatrixSetId}?
+    """
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    qs = "/ogcapi/tiles/tileMatrixSets?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    assert [tms['id'] for tms in json_content['tileMatrixSets']] == ['EPSG:4326', 'EPSG:3857']
+
+    qs = "/ogcapi/tiles/tileMatrixSets/EPSG:3857?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    assert json_content['id'] == 'EPSG:3857'
+    assert json_content['crs'] == 'http://www.opengis.net/def/crs/EPSG/0/3857'
+    assert len(json_content['tileMatrices']) == 19
+    assert json_content['tileMatrices'][0]['matrixWidth'] == 1
+    assert json_content['tileMatrices'][1]['matrixWidth'] == 2
+
+    qs = "/ogcapi/tiles/tileMatrixSets/EPSG:2154?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 404
+
+
+def test_ogcapi_tilesets(client):
+    """ Test the OGC API Tiles - Tilesets
+        /ogcapi/tiles/collections/{tilemapid}/tiles/{tileMatrixSetId}?
+    """
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    qs = "/ogcapi/tiles/collections/france_parts/tiles?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    assert len(json_content['tilesets']) == 2
+    assert json_content['tilesets'][1]['tileMatrixSetId'] == 'EPSG:3857'
+    assert json_content['tilesets'][1]['dataType'] == 'map'
+
+    qs = "/ogcapi/tiles/collections/france_parts/tiles/EPSG:3857?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    assert json_content['crs'] == 'http://www.opengis.net/def/crs/EPSG/0/3857'
+    assert len(json_content['tileMatrixSetLimits']) == 19
+    items = [link for link in json_content['links'] if link['rel'] == 'item']
+    assert items[0]['templated']
+    assert '{tileMatrix}/{tileRow}/{tileCol}' in items[0]['href']
+
+    qs = "/ogcapi/tiles/collections/unknown/tiles?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 404
+
+
+def test_ogcapi_tilecontent(client):
+    """ Test the OGC API Tiles - Tile content
+        /ogcapi/tiles/collections/{tilemapid}/tiles/{tileMatrixSetId}/{z}/{y}/{x}?
+    """
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    qs = "/ogcapi/tiles/collections/france_parts/tiles/EPSG:3857/0/0/0?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type',"").startswith('image/png')
+    assert len(rv.content) > 0
+
+    if Qgis.QGIS_VERSION_INT >= 31400:
+        qs = "/ogcapi/tiles/collections/france_parts/tiles/EPSG:3857/0/0/0?f=pbf&MAP=%s" % project.fileName()
+        rv = client.get(qs)
+        assert rv.status_code == 200
+        assert rv.headers.get('Content-Type',"").startswith('application/x-protobuf')
+
+    # Format not available
+    qs = "/ogcapi/tiles/collections/france_parts/tiles/EPSG:3857/0/0/0?f=jpg&MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 400
+
+    # EPSG:4326 has 2 columns at level 0
+    qs = "/ogcapi/tiles/collections/france_parts/tiles/EPSG:4326/0/0/1?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
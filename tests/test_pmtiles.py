@@ -0,0 +1,90 @@
+""" Test tile exports
+"""
+import os
+import tarfile
+
+
+def test_pmtiles_tileid(client):
+    """ Test Hilbert tile ids
+    """
+    from tilesForServer.pmtiles import zxy_to_tileid
+
+    assert zxy_to_tileid(0, 0, 0) == 0
+    assert [zxy_to_tileid(1, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]] == [1, 2, 3, 4]
+    assert zxy_to_tileid(2, 0, 0) == 5
+    assert zxy_to_tileid(12, 3423, 1763) == 19078479
+
+
+def test_pmtiles_archive(client, tmp_path):
+    """ Test writing and reading a PMTiles archive
+    """
+    from tilesForServer.pmtiles import PMTilesReader, PMTilesWriter
+
+    path = str(tmp_path / 'tiles.pmtiles')
+    writer = PMTilesWriter(path, 'png', {'name': 'test'})
+    assert writer.write(0, 0, 0, b'root')
+    # Identical tiles are stored once
+    assert writer.write(1, 0, 0, b'sea')
+    assert not writer.write(1, 0, 1, b'sea')
+    assert writer.write(1, 1, 1, b'land')
+    assert not writer.write(1, 1, 0, b'sea')
+    writer.write(2, 0, 0, b'')
+    writer.close()
+
+    reader = PMTilesReader(path)
+    assert reader.get(0, 0, 0) == b'root'
+    assert reader.get(1, 0, 0) == b'sea'
+    assert reader.get(1, 0, 1) == b'sea'
+    assert reader.get(1, 1, 1) == b'land'
+    assert reader.get(1, 1, 0) == b'sea'
+    assert reader.get(2, 0, 0) is None
+
+    # Consecutive identical tiles share an entry
+    root = reader.entries(reader.header[2], reader.header[3])
+    assert [entry[0] for entry in root] == [0, 1, 3, 4]
+    assert root[1][3] == 2
+
+
+def test_pmtiles_leaf_directories(client, tmp_path):
+    """ Test archives with leaf directories
+    """
+    from tilesForServer.pmtiles import PMTilesReader, PMTilesWriter
+
+    path = str(tmp_path / 'tiles.pmtiles')
+    writer = PMTilesWriter(path, 'pbf')
+    for x in range(128):
+        for y in range(128):
+            writer.write(7, x, y, f"{x}/{y}".encode())
+    writer.close()
+
+    reader = PMTilesReader(path)
+    assert reader.header[7] > 0
+    assert reader.get(7, 0, 0) == b'0/0'
+    assert reader.get(7, 100, 42) == b'100/42'
+    assert reader.get(6, 0, 0) is None
+
+
+def test_export_writers(client, tmp_path):
+    """ Test directory and tar writers
+    """
+    from tilesForServer.export import DirectoryWriter, TarWriter
+
+    writer = DirectoryWriter(str(tmp_path / 'tiles'), 'png')
+    assert writer.write(1, 0, 0, b'sea')
+    assert not writer.write(1, 0, 1, b'sea')
+    writer.close()
+    first = tmp_path / 'tiles' / '1' / '0' / '0.png'
+    second = tmp_path / 'tiles' / '1' / '0' / '1.png'
+    assert second.read_bytes() == b'sea'
+    assert os.path.samefile(first, second)
+
+    path = str(tmp_path / 'tiles.tar')
+    writer = TarWriter(path, 'png')
+    assert writer.write(1, 0, 0, b'sea')
+    assert not writer.write(1, 1, 0, b'sea')
+    assert writer.write(1, 1, 1, b'land')
+    writer.close()
+    with tarfile.open(path) as tar:
+        assert tar.getmember('1/1/0.png').islnk()
+        assert tar.extractfile('1/1/0.png').read() == b'sea'
+        assert tar.extractfile('1/1/1.png').read() == b'land'
@@ -0,0 +1,113 @@
+""" Test tile prefetching
+"""
+
+
+def test_prefetch_token_bucket(client):
+    """ Test the prefetch budget
+    """
+    from tilesForServer.prefetch import TokenBucket
+
+    bucket = TokenBucket(3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_prefetch_hits(client):
+    """ Test the tile request counters
+    """
+    from tilesForServer.prefetch import Prefetcher
+
+    prefetch = Prefetcher(min_hits=2, max_counters=2)
+    assert prefetch.hit('a') == 1
+    assert not prefetch.accepts(1)
+    assert prefetch.hit('a') == 2
+    assert prefetch.accepts(2)
+
+    # Least recently requested counters are discarded
+    prefetch.hit('b')
+    prefetch.hit('c')
+    assert prefetch.hit('a') == 1
+
+
+def test_prefetch_queue(client):
+    """ Test the priority, the budget and the size of the queue
+    """
+    from tilesForServer.prefetch import Prefetcher
+
+    prefetch = Prefetcher(budget=4, max_queue=3)
+    # Do not start the prefetch thread
+    prefetch._start = lambda: None
+
+    assert prefetch.submit('a', 0, ['a/1'], {}) == 0
+    assert prefetch.submit('a', 1, ['a/1', 'a/2'], {}) == 2
+    # Queued urls are not queued again
+    assert prefetch.submit('a', 1, ['a/1'], {}) == 0
+    # Budget of the tile map is exhausted
+    assert prefetch.submit('a', 1, ['a/3', 'a/4', 'a/5'], {}) == 2
+
+    # Lowest priority urls are dropped
+    assert prefetch.submit('b', 5, ['b/1'], {}) == 1
+    urls = [item[2] for item in sorted(prefetch._heap)]
+    assert urls == ['b/1', 'a/1', 'a/2']
+
+    stats = prefetch.stats()
+    assert stats['pending'] == 3
+    assert stats['dropped'] == 2
+    assert stats['overBudget'] == 1
+
+
+def test_prefetch_expand(client):
+    """ Test the deferred expansion of the prefetch candidates
+    """
+    from tilesForServer.prefetch import Prefetcher
+
+    prefetch = Prefetcher(min_hits=2)
+    prefetch._start = lambda: None
+
+    expanded = []
+
+    def candidates():
+        expanded.append(True)
+        return ['a/1', 'a/2']
+
+    assert not prefetch.expand('a', 1, candidates, {})
+    assert prefetch.expand('a', 2, candidates, {})
+    # Candidates are expanded by the prefetch thread
+    assert not expanded
+    assert prefetch.stats()['expansions'] == 1
+
+    prefetch._expand(*prefetch._expansions.popleft())
+    assert expanded == [True]
+    assert sorted(item[2] for item in prefetch._heap) == ['a/1', 'a/2']
+
+
+def test_prefetch_restricted_tiles(client, monkeypatch):
+    """ Test that restricted tiles are prefetched only with the partition headers
+    """
+    from qgis.core import QgsProject
+
+    from tilesForServer import prefetch
+    from tilesForServer.tilecontent import TileContentHandler
+
+    prefetch_ = prefetch.Prefetcher()
+    prefetch_._start = lambda: None
+    monkeypatch.setattr(prefetch, '_prefetcher', prefetch_)
+    monkeypatch.setattr(prefetch, '_initialized', True)
+    monkeypatch.setattr(TileContentHandler, 'access_control_key',
+                        lambda self, layers, access_controls: 'restricted')
+    monkeypatch.setenv('QGIS_TILES_ACL_HEADERS', 'X-User-Groups')
+    monkeypatch.delenv('QGIS_TILES_SEED_HEADERS', raising=False)
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    qs = "/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName()
+    headers = {'Authorization': 'Basic dXNlcjp1c2Vy', 'X-User-Groups': 'users'}
+
+    # Prefetch requests would not get the partition of the user
+    rv = client.get(qs, headers=headers)
+    assert rv.status_code == 200
+    assert prefetch_.stats()['expansions'] == 0
+
+    monkeypatch.setenv('QGIS_TILES_SEED_HEADERS', 'Authorization,X-User-Groups')
+    rv = client.get(qs, headers=headers)
+    assert rv.status_code == 200
+    assert prefetch_.stats()['expansions'] == 1
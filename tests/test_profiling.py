@@ -0,0 +1,77 @@
+""" Test request profiling
+"""
+import json
+import pstats
+import tracemalloc
+
+from qgis.core import QgsProject
+
+
+def test_profiler_accepts(client, tmp_path):
+    """ Test the selection of the profiled requests
+    """
+    from tilesForServer.profiling import Profiler
+
+    profiler = Profiler(str(tmp_path), ['/tms/france_parts/*'], token='secret')
+    assert profiler.accepts('/tms/france_parts/0/0/0.png', 'secret')
+    assert not profiler.accepts('/tms/france_parts/0/0/0.png', 'other')
+    # Not sampled
+    assert not profiler.accepts('/tms/france_parts/0/0/0.png', None)
+    # Not allowed
+    assert not profiler.accepts('/tms/other/0/0/0.png', 'secret')
+
+    profiler = Profiler(str(tmp_path), ['/tms/*'], sample=100)
+    assert profiler.accepts('/tms/france_parts/0/0/0.png', None)
+
+
+def test_profiler_profile(client, tmp_path):
+    """ Test writing cpu and memory profiles
+    """
+    from tilesForServer.profiling import Profiler
+
+    profiler = Profiler(str(tmp_path), ['/*'], memory=True, limit=1)
+    with profiler.profile('/tms/france_parts/0/0/0.png') as summary:
+        data = [bytes(1024) for _ in range(100)]
+        summary['status'] = 200
+    assert len(data) == 100
+    assert not tracemalloc.is_tracing()
+
+    base = tmp_path.joinpath(summary['name'])
+    assert pstats.Stats(str(base.with_suffix('.prof'))).total_calls > 0
+    assert tracemalloc.Snapshot.load(str(base.with_suffix('.tracemalloc'))).traces
+
+    content = json.loads(base.with_suffix('.json').read_text())
+    assert content['url'] == '/tms/france_parts/0/0/0.png'
+    assert content['status'] == 200
+    assert content['peak'] >= 100 * 1024
+    assert content['allocations']
+
+    # Limit reached
+    assert not profiler.accepts('/tms/france_parts/0/0/0.png', 'yes')
+
+
+def test_profile_request(client, tmp_path, monkeypatch):
+    """ Test profiling tile requests
+    """
+    from tilesForServer import profiling
+    from tilesForServer.profiling import PROFILE_HEADER, Profiler
+
+    monkeypatch.setattr(profiling, '_profiler', Profiler(str(tmp_path), ['/tms/france_parts/*']))
+    monkeypatch.setattr(profiling, '_initialized', True)
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    qs = "/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName()
+
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert not list(tmp_path.glob('*.json'))
+
+    rv = client.get(qs, headers={PROFILE_HEADER: 'yes'})
+    assert rv.status_code == 200
+    profiles = list(tmp_path.glob('*.json'))
+    assert len(profiles) == 1
+    content = json.loads(profiles[0].read_text())
+    assert content['status'] == 200
+    assert '/tms/france_parts/0/0/0.png' in content['url']
+    assert profiles[0].with_suffix('.prof').exists()
@@ -0,0 +1,192 @@
+""" Test the redis tile store against an in process RESP server
+"""
+import socketserver
+import threading
+import time
+
+import pytest
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """ Minimal RESP server: GET, MGET, SET [EX], DEL, EXISTS, EXPIRE, SELECT
+    """
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def lookup(self, key):
+        value, expire = self.server.data.get(key, (None, None))
+        if expire is not None and expire < time.time():
+            return None
+        return value
+
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            if cmd == b'GET':
+                self.wfile.write(self.bulk(self.lookup(args[1])))
+            elif cmd == b'MGET':
+                self.server.mget += 1
+                out = b'*%d\r\n' % (len(args) - 1)
+                out += b''.join(self.bulk(self.lookup(key)) for key in args[1:])
+                self.wfile.write(out)
+            elif cmd == b'SET':
+                expire = None
+                if len(args) == 5 and args[3].upper() == b'EX':
+                    expire = time.time() + int(args[4])
+                self.server.data[args[1]] = (args[2], expire)
+                self.wfile.write(b'+OK\r\n')
+            elif cmd == b'DEL':
+                n = sum(1 for key in args[1:] if self.server.data.pop(key, None))
+                self.wfile.write(b':%d\r\n' % n)
+            elif cmd == b'EXISTS':
+                self.wfile.write(b':%d\r\n' % (self.lookup(args[1]) is not None))
+            elif cmd == b'EXPIRE':
+                value = self.lookup(args[1])
+                if value is not None:
+                    self.server.data[args[1]] = (value, time.time() + int(args[2]))
+                self.wfile.write(b':%d\r\n' % (value is not None))
+            elif cmd == b'SELECT':
+                self.wfile.write(b'+OK\r\n')
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+@pytest.fixture
+def resp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _RespHandler)
+    server.daemon_threads = True
+    server.data = {}
+    server.connections = 0
+    server.mget = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_redis_get_set(client, resp_server):
+    """ Test redis tile store
+    """
+    from tilesForServer.cache import tile_key
+    from tilesForServer.rediscache import RedisStore
+
+    host, port = resp_server.server_address
+    store = RedisStore(host, port, db=1)
+
+    key = tile_key('project', 'france_parts', 0, 0, 0, 'png')
+    assert store.get(key) is None
+
+    # Binary safe values
+    data = bytes(range(256)) * 4 + b'\r\n'
+    store.set(key, data, 1000.)
+    entry = store.get(key)
+    assert entry is not None
+    assert entry.data == data
+    assert entry.created == 1000.
+
+    store.delete(key)
+    assert store.get(key) is None
+
+    # Connections are reused
+    assert resp_server.connections == 1
+
+    stats = store.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['errors'] == 0
+
+    store.close()
+
+
+def test_redis_get_many(client, resp_server):
+    """ Test pipelined multi-get
+    """
+    from tilesForServer.cache import tile_key
+    from tilesForServer.rediscache import MGET_CHUNK_SIZE, RedisStore
+
+    host, port = resp_server.server_address
+    store = RedisStore(host, port, ttl=3600)
+
+    keys = [tile_key('project', 'france_parts', 10, x, 0, 'png') for x in range(MGET_CHUNK_SIZE + 10)]
+    for x, key in enumerate(keys[::2]):
+        store.set(key, b'tile%d' % x)
+
+    entries = store.get_many(keys)
+    assert len(entries) == len(keys)
+    assert [entry is not None for entry in entries] == [i % 2 == 0 for i in range(len(keys))]
+    assert entries[2].data == b'tile1'
+    # References then data
+    assert resp_server.mget == 3
+
+    store.close()
+
+
+def test_redis_deduplication(client, resp_server):
+    """ Test that identical tiles are stored once
+    """
+    from tilesForServer.cache import content_digest, tile_key
+    from tilesForServer.rediscache import RedisStore
+
+    host, port = resp_server.server_address
+    store = RedisStore(host, port, ttl=3600)
+
+    keys = [tile_key('project', 'france_parts', 10, x, 0, 'png') for x in range(10)]
+    for key in keys:
+        store.set(key, b'sea')
+    store.set(keys[0], b'land')
+
+    data = [key for key in resp_server.data if key.startswith(b'qgis-tiles:data:')]
+    assert len(data) == 2
+    assert store.stats()['deduplicated'] == 9
+
+    entries = store.get_many(keys)
+    assert entries[0].data == b'land'
+    assert all(entry.data == b'sea' and entry.digest == content_digest(b'sea') for entry in entries[1:])
+    # References are read without the data
+    assert store.get_reference(keys[0]).digest == content_digest(b'land')
+    assert store.get_reference(tile_key('other')) is None
+
+    # Deleting a reference keeps the data of the other tiles
+    store.delete(keys[1])
+    assert store.get(keys[1]) is None
+    assert store.get(keys[2]).data == b'sea'
+
+    store.close()
+
+
+def test_redis_errors(client):
+    """ Test that server errors are handled as misses
+    """
+    import socket
+
+    from tilesForServer.rediscache import RedisStore
+
+    # Get a free port
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    store = RedisStore('127.0.0.1', port, timeout=0.5)
+    assert store.get(b'0' * 16) is None
+    store.set(b'0' * 16, b'data')
+    assert store.stats()['errors'] == 2
@@ -0,0 +1,23 @@
+""" Test tile render deadlines
+"""
+import time
+
+
+def test_render_deadline(client):
+    """ Test that the feedback is canceled at the deadline
+    """
+    from tilesForServer.render import render_deadline
+
+    with render_deadline(0) as feedback:
+        assert feedback is None
+
+    with render_deadline(0.05) as feedback:
+        assert not feedback.isCanceled()
+        time.sleep(0.2)
+        assert feedback.isCanceled()
+
+    # The deadline is disarmed when the render ends
+    with render_deadline(0.1) as feedback:
+        pass
+    time.sleep(0.2)
+    assert not feedback.isCanceled()
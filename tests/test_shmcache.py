@@ -0,0 +1,147 @@
+import multiprocessing
+
+
+def test_shmcache_get_set(client, tmp_path):
+    """ Test shared memory tile store
+    """
+    from tilesForServer.cache import tile_key
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    path = str(tmp_path.joinpath('tiles.shm'))
+    store = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+
+    key = tile_key('project', 'france_parts', 0, 0, 0, 'png')
+    assert store.get(key) is None
+
+    store.set(key, b'tile')
+    entry = store.get(key)
+    assert entry.data == b'tile'
+    assert entry.created > 0
+
+    # Shared with other instances
+    other = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+    assert other.get(key).data == b'tile'
+
+    other.delete(key)
+    assert store.get(key) is None
+
+    # Tiles larger than slots are not stored
+    store.set(key, b'x' * 5000)
+    assert store.get(key) is None
+    assert store.stats()['tooLarge'] == 1
+
+    other.close()
+    store.close()
+
+
+def test_shmcache_layout_change(client, tmp_path):
+    """ Test that a file with another layout is replaced, not resized
+    """
+    import os
+
+    from tilesForServer.cache import tile_key
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    path = str(tmp_path.joinpath('tiles.shm'))
+    store = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+    key = tile_key('project', 'france_parts', 0, 0, 0, 'png')
+    store.set(key, b'tile')
+    inode = os.stat(path).st_ino
+
+    # New layout
+    other = SharedMemoryStore(path, 2 * 1024 * 1024, slot_size=8192, ways=4)
+    assert os.stat(path).st_ino != inode
+    assert other.get(key) is None
+
+    # Processes with the previous layout keep their mapping
+    assert store.get(key).data == b'tile'
+    store.set(key, b'other')
+    assert other.get(key) is None
+
+    other.close()
+    store.close()
+
+
+def test_shmcache_eviction(client, tmp_path):
+    """ Test that the store size is fixed
+    """
+    from tilesForServer.cache import tile_key
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    path = str(tmp_path.joinpath('tiles.shm'))
+    store = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+    slots = store.stats()['slots']
+
+    for i in range(slots * 4):
+        store.set(tile_key(i), b'tile %d' % i)
+
+    assert tmp_path.joinpath('tiles.shm').stat().st_size <= 1024 * 1024
+    # References to evicted data are misses
+    assert sum(1 for i in range(slots * 4) if store.get(tile_key(i))) <= slots
+
+    # Last stored tile is never evicted
+    assert store.get(tile_key(slots * 4 - 1)).data == b'tile %d' % (slots * 4 - 1)
+    store.close()
+
+
+def test_shmcache_deduplication(client, tmp_path):
+    """ Test that identical tiles are stored once
+    """
+    from tilesForServer.cache import content_digest, tile_key
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    path = str(tmp_path.joinpath('tiles.shm'))
+    store = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+    slots = store.stats()['slots']
+    assert store.stats()['references'] == slots * 16
+
+    # More identical tiles than data slots
+    keys = [tile_key('sea', i) for i in range(slots * 2)]
+    for key in keys:
+        store.set(key, b'sea')
+    assert store.stats()['deduplicated'] == len(keys) - 1
+
+    entry = store.get(keys[0])
+    assert entry.data == b'sea'
+    assert entry.digest == content_digest(b'sea')
+    assert sum(store.contains_many(keys)) > slots
+    # References are read without the data
+    assert store.get_reference(keys[0]) == (entry.created, entry.digest)
+    assert store.get_reference(tile_key('land')) is None
+
+    # Deleting a reference keeps the data of the other tiles
+    store.delete(keys[0])
+    assert store.get(keys[0]) is None
+    assert store.get(keys[-1]).data == b'sea'
+    store.close()
+
+
+def _write_tiles(args):
+    from tilesForServer.cache import tile_key
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    path, n = args
+    store = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+    for i in range(200):
+        store.set(tile_key(n, i), b'%d-%d' % (n, i))
+    store.close()
+
+
+def test_shmcache_processes(client, tmp_path):
+    """ Test concurrent writes from processes
+    """
+    from tilesForServer.cache import tile_key
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    path = str(tmp_path.joinpath('tiles.shm'))
+    store = SharedMemoryStore(path, 1024 * 1024, slot_size=4096, ways=4)
+
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.map(_write_tiles, [(path, n) for n in range(4)])
+
+    # Stored entries are consistent
+    for n in range(4):
+        for i in range(200):
+            entry = store.get(tile_key(n, i))
+            assert entry is None or entry.data == b'%d-%d' % (n, i)
+    store.close()
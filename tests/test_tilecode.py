@@ -0,0 +1,60 @@
+""" Test compact tile codes and keys
+"""
+
+
+def test_tile_code(client):
+    """ Test encoding and decoding tile codes
+    """
+    from tilesForServer.tilecode import tile_code, tile_from_code, tile_zoom
+
+    assert tile_code(0, 0, 0) == 1
+    for zoom, col, row in [(0, 0, 0), (1, 1, 0), (12, 2048, 1400), (30, (1 << 30) - 1, 12345)]:
+        code = tile_code(zoom, col, row)
+        assert code < 1 << 64
+        assert tile_from_code(code) == (zoom, col, row)
+        assert tile_zoom(code) == zoom
+
+    # Tile matrices with 2 tiles at level 0
+    code = tile_code(3, 15, 7, root_bits=1)
+    assert tile_from_code(code, root_bits=1) == (3, 15, 7)
+    assert tile_zoom(code, root_bits=1) == 3
+
+
+def test_tile_code_hierarchy(client):
+    """ Test parents, children and descendants of tile codes
+    """
+    from tilesForServer.tilecode import (
+        child_tiles,
+        descendant_range,
+        parent_tile,
+        tile_code,
+        tile_from_code,
+    )
+
+    code = tile_code(10, 512, 350)
+    children = [tile_from_code(c) for c in child_tiles(code)]
+    assert children == [(11, 1024, 700), (11, 1025, 700), (11, 1024, 701), (11, 1025, 701)]
+    assert all(parent_tile(c) == code for c in child_tiles(code))
+    assert parent_tile(tile_code(12, 2051, 1403), 2) == code
+
+    start, end = descendant_range(code, 2)
+    assert end - start == 16
+    assert start <= tile_code(12, 2051, 1403) < end
+    assert not start <= tile_code(12, 2052, 1403) < end
+
+
+def test_tile_code_key(client):
+    """ Test tile store keys of tile codes
+    """
+    from tilesForServer.cache import tile_code_key, tile_namespace
+    from tilesForServer.tilecode import tile_code
+
+    namespace = tile_namespace('project', 'fingerprint', 'france_parts', 'EPSG:3857', 'png', 'public')
+    assert namespace == tile_namespace('project', 'fingerprint', 'france_parts', 'EPSG:3857', 'png', 'public')
+    other = tile_namespace('project', 'fingerprint', 'france_parts', 'EPSG:3857', 'pbf', 'public')
+    assert other != namespace
+
+    keys = {tile_code_key(ns, tile_code(z, x, y))
+            for ns in (namespace, other) for z in range(4) for x in range(1 << z) for y in range(1 << z)}
+    assert len(keys) == 2 * sum(4 ** z for z in range(4))
+    assert all(len(key) == 16 for key in keys)
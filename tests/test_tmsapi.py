@@ -89,6 +89,8 @@ def test_tmsapi_landingpage(client):
     assert len(json_content['links']) == 0
 
 
+    assert tile_map['tileMatrixSets'] == ['EPSG:4326', 'EPSG:3857']
+
     # Project with WMTS but not in EPSG:3857
     project.setFileName(client.getprojectpath("france_parts_grid_4326.qgs").strpath)
     qs = "/tms?MAP=%s" % project.fileName()
@@ -98,7 +100,8 @@ def test_tmsapi_landingpage(client):
 
     json_content = json.loads(rv.content)
     assert 'tileMaps' in json_content
-    assert len(json_content['tileMaps']) == 0
+    assert len(json_content['tileMaps']) == 1
+    assert json_content['tileMaps'][0]['tileMatrixSets'] == ['EPSG:4326']
 
     # Project without WMTS
     project.setFileName(client.getprojectpath("france_parts_no_wmts.qgs").strpath)
@@ -150,6 +153,24 @@ def test_tmsapi_tilemapinfo(client):
         assert 'mimetype' in json_content['formats'][1]
         assert json_content['formats'][1]['mimetype'] == 'application/x-protobuf'
 
+    assert json_content['crs'] == 'EPSG:3857'
+    assert [tms['id'] for tms in json_content['tileMatrixSets']] == ['EPSG:4326', 'EPSG:3857']
+
+    # TMS API request - tile matrix set selection
+    qs = "/tms/france_parts@EPSG:4326?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    assert json_content['id'] == 'france_parts'
+    assert json_content['crs'] == 'EPSG:4326'
+    assert -180 <= json_content['bbox'][0] <= 180
+
+    # TMS API request - tile matrix set unknwon
+    qs = "/tms/france_parts@EPSG:2154?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 404
+
     # TMS API request - tilemapid unknwon
     qs = "/tms/unknwon?MAP=%s" % project.fileName()
     rv = client.get(qs)
@@ -189,8 +210,420 @@ def test_tmsapi_tilemapcontent(client):
         assert rv.headers.get('Content-Type',"").startswith('application/x-protobuf')
         assert len(rv.content) > 0
 
+    # TMS API requests - EPSG:4326 tile matrix set
+    qs = "/tms/france_parts@EPSG:4326/0/1/0.png?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type',"").startswith('image/png')
+
+    if Qgis.QGIS_VERSION_INT >= 32200:
+        qs = "/tms/france_parts@EPSG:4326/0/1/0.pbf?MAP=%s" % project.fileName()
+        rv = client.get(qs)
+        assert rv.status_code == 200
+        assert rv.headers.get('Content-Type',"").startswith('application/x-protobuf')
+
+    # TMS API requests - Tile out of range
+    qs = "/tms/france_parts/0/1/0.png?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 400
+
     # TMS API request - No project
     qs = "/tms/france_parts/0/0/0.png"
     rv = client.get(qs)
     assert rv.status_code == 400
     assert rv.headers.get('Content-Type',"").startswith('application/json')
+
+def test_tmsapi_match_tile_path(client):
+    """ Test the split based tile path parser
+    """
+    plugin = client.getplugin('tilesForServer')
+    assert plugin is not None
+
+    from tilesForServer.tmsapi import match_tile_path
+
+    values = match_tile_path("/france_parts/3/4/5.png")
+    assert values == {
+        'tilemapid': 'france_parts',
+        'tilematrixid': '3',
+        'tilecolid': '4',
+        'tilerowid': '5',
+        'extension': 'png',
+    }
+    assert match_tile_path("/france_parts/3/4/5.pbf/")['extension'] == 'pbf'
+
+    assert match_tile_path("/france_parts") is None
+    assert match_tile_path("/france_parts/3/4/5") is None
+    assert match_tile_path("/france_parts/a/4/5.png") is None
+    assert match_tile_path("//3/4/5.png") is None
+    assert match_tile_path("/france_parts/3/4/5/6.png") is None
+
+def test_tmsapi_tilemapcontent_encodings(client):
+    """ Test the TMS API - Tile map extra encodings
+        /tms/{tilemapid}/{tilematrixid}/{tilecolid}/{tilerowid}.{png8|mixed}
+    """
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts_tiles.qgs").strpath)
+
+    qs = "/tms/france_parts?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    extensions = [fmt['extension'] for fmt in json_content['formats']]
+    assert 'png8' in extensions
+    assert 'mixed' in extensions
+    assert 'webp' not in extensions
+
+    qs = "/tms/france_parts/0/0/0.png8?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type',"").startswith('image/png')
+    assert rv.content[:8] == b'\x89PNG\r\n\x1a\n'
+
+    # The tile is not opaque
+    qs = "/tms/france_parts/0/0/0.mixed?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('Content-Type',"").startswith('image/png')
+
+    # Not enabled for this tile map
+    qs = "/tms/france_parts/0/0/0.webp?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 400
+
+def test_tmsapi_tilemapcontent_overzoom(client):
+    """ Test the TMS API - Vector tiles above maxzoom
+    """
+    if Qgis.QGIS_VERSION_INT < 31400:
+        return
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts_tiles.qgs").strpath)
+
+    qs = "/tms/france_parts?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    json_content = json.loads(rv.content)
+    pbf = [fmt for fmt in json_content['formats'] if fmt['extension'] == 'pbf'][0]
+    assert pbf['maxzoom'] == 10
+    png = [fmt for fmt in json_content['formats'] if fmt['extension'] == 'png'][0]
+    assert 'maxzoom' not in png
+
+    qs = "/tms/france_parts/10/512/350.pbf?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+    qs = "/tms/france_parts/12/2048/1400.pbf?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 302
+    assert '/tms/france_parts/10/512/350.pbf' in rv.headers.get('Location')
+    assert rv.headers.get('X-Tiles-Overzoom') == '10'
+
+    # Raster tiles are not concerned
+    qs = "/tms/france_parts/12/2048/1400.png?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+
+def test_tmsapi_cache_invalidation(client):
+    """ Test the TMS API - Tile cache management
+        /tms/_cache
+    """
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    qs = "/tms/_cache?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    json_content = json.loads(rv.content)
+    assert 'stores' in json_content
+    assert 'seeding' in json_content
+
+    qs = "/tms/france_parts?MAP=%s" % project.fileName()
+    rv = client.get(qs)
+    formats = json.loads(rv.content)['formats']
+
+    # France at zoom levels 0 to 2: 1 + 2 + 2 tiles per format
+    qs = ("/tms/_cache?MAP=%s&TILEMAP=france_parts&TILEMATRIXSET=EPSG:3857"
+          "&BBOX=-5,41,10,51&CRS=EPSG:4326&MINZOOM=0&MAXZOOM=2") % project.fileName()
+    rv = client.post(qs)
+    assert rv.status_code == 200
+    json_content = json.loads(rv.content)
+    assert json_content['tileMaps'] == ['france_parts']
+    assert json_content['tiles'] == 5 * len(formats)
+    assert json_content['seeded'] == 0
+
+    # Tile maps containing the layer
+    qs = ("/tms/_cache?MAP=%s&LAYER=france_parts_8d8d649f_7748_43cc_8bde_b013e17ede29"
+          "&MAXZOOM=1") % project.fileName()
+    rv = client.post(qs)
+    assert rv.status_code == 200
+    json_content = json.loads(rv.content)
+    assert 'france_parts' in json_content['tileMaps']
+    assert json_content['tiles'] > 0
+
+    # Missing tile map
+    qs = "/tms/_cache?MAP=%s" % project.fileName()
+    rv = client.post(qs)
+    assert rv.status_code == 400
+
+    qs = "/tms/_cache?MAP=%s&TILEMAP=unknown" % project.fileName()
+    rv = client.post(qs)
+    assert rv.status_code == 404
+
+def test_tmsapi_etag(client):
+    """ Test the TMS API - Entity tags
+    """
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+
+    for qs in ("/tms/france_parts?MAP=%s", "/tms/france_parts/0/0/0.png?MAP=%s"):
+        qs = qs % project.fileName()
+        rv = client.get(qs)
+        assert rv.status_code == 200
+        etag = rv.headers.get('ETag')
+        assert etag
+
+        rv = client.get(qs, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert len(rv.content) == 0
+
+        rv = client.get(qs, headers={'If-None-Match': '"other"'})
+        assert rv.status_code == 200
+
+def test_tmsapi_etag_precheck(client, monkeypatch):
+    """ Test the TMS API - Conditional requests are answered without rendering
+    """
+    from tilesForServer import cache
+    from tilesForServer.tilecontent import TileContentHandler
+
+    monkeypatch.setattr(cache, '_stores', [])
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    qs = "/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName()
+
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    etag = rv.headers.get('ETag')
+
+    def render_tile(*args, **kwargs):
+        raise AssertionError("Tile rendered")
+
+    with monkeypatch.context() as m:
+        m.setattr(TileContentHandler, 'render_tile', render_tile)
+        rv = client.get(qs, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+    # Invalidated tiles get a new entity tag
+    rv = client.post("/tms/_cache?MAP=%s&TILEMAP=france_parts&MAXZOOM=0" % project.fileName())
+    assert rv.status_code == 200
+    rv = client.get(qs, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers.get('ETag') != etag
+
+def _stale_tiles_setup(monkeypatch):
+    """ Serve tiles from a memory tile store, record the revalidations
+    """
+    import time
+
+    from collections import OrderedDict
+
+    from tilesForServer import cache, tilecontent
+    from tilesForServer.cache import TileEntry, TileStore, content_digest
+
+    class MemoryStore(TileStore):
+        name = 'memory'
+
+        def __init__(self):
+            self.entries = {}
+
+        def get(self, key):
+            return self.entries.get(key)
+
+        def set(self, key, data, created=None, digest=None):
+            self.entries[key] = TileEntry(data, created or time.time(), digest or content_digest(data))
+
+        def delete(self, key):
+            self.entries.pop(key, None)
+
+    class Seeder:
+
+        def __init__(self):
+            self.urls = []
+
+        def submit(self, urls, headers=None):
+            urls = list(urls)
+            self.urls.extend(urls)
+            return len(urls)
+
+    store = MemoryStore()
+    seeder = Seeder()
+    monkeypatch.setattr(cache, '_stores', [store])
+    monkeypatch.setattr(tilecontent, 'seeder', lambda: seeder)
+    monkeypatch.setattr(tilecontent, '_revalidations', OrderedDict())
+    return store, seeder
+
+def test_tmsapi_stale_tiles(client, monkeypatch):
+    """ Test the TMS API - Stale tiles
+    """
+    from tilesForServer.seeding import SEED_HEADER
+
+    store, seeder = _stale_tiles_setup(monkeypatch)
+    monkeypatch.setenv('QGIS_TILES_MAX_AGE', '60')
+    monkeypatch.setenv('QGIS_TILES_MAX_STALE', '600')
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    qs = "/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName()
+
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert len(store.entries) == 1
+    key, entry = next(iter(store.entries.items()))
+
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') == 'memory'
+    assert 'X-Tiles-Stale' not in rv.headers
+
+    # Tiles older than maxAge are served stale and revalidated
+    store.entries[key] = entry._replace(created=entry.created - 120)
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') == 'memory'
+    assert int(rv.headers.get('X-Tiles-Stale')) >= 120
+    assert rv.content == entry.data
+    assert len(seeder.urls) == 1
+    assert '/tms/france_parts/0/0/0.png' in seeder.urls[0]
+
+    # Tiles are revalidated once per interval
+    rv = client.get(qs)
+    assert 'X-Tiles-Stale' in rv.headers
+    assert len(seeder.urls) == 1
+
+    # Seeding requests never get stale tiles
+    rv = client.get(qs, headers={SEED_HEADER: 'yes'})
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') != 'memory'
+    assert 'X-Tiles-Stale' not in rv.headers
+    assert store.entries[key].created > entry.created
+
+    # Tiles older than maxAge + maxStale are not served
+    store.entries[key] = entry._replace(created=entry.created - 1000)
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') != 'memory'
+    assert 'X-Tiles-Stale' not in rv.headers
+    assert len(seeder.urls) == 1
+
+def test_tmsapi_restricted_stale_tiles(client, monkeypatch):
+    """ Test the TMS API - Stale tiles of a restricted partition
+    """
+    from tilesForServer.tilecontent import TileContentHandler
+
+    store, seeder = _stale_tiles_setup(monkeypatch)
+    monkeypatch.setenv('QGIS_TILES_MAX_AGE', '60')
+    monkeypatch.setenv('QGIS_TILES_MAX_STALE', '600')
+    monkeypatch.setenv('QGIS_TILES_ACL_HEADERS', 'X-User-Groups')
+    monkeypatch.delenv('QGIS_TILES_SEED_HEADERS', raising=False)
+    monkeypatch.setattr(TileContentHandler, 'access_control_key',
+                        lambda self, layers, access_controls: 'restricted')
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    qs = "/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName()
+    headers = {'Authorization': 'Basic dXNlcjp1c2Vy', 'X-User-Groups': 'users'}
+
+    rv = client.get(qs, headers=headers)
+    assert rv.status_code == 200
+    key, entry = next(iter(store.entries.items()))
+
+    # Revalidation requests would not get the partition of the user
+    store.entries[key] = entry._replace(created=entry.created - 120)
+    rv = client.get(qs, headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') != 'memory'
+    assert 'X-Tiles-Stale' not in rv.headers
+    assert store.entries[key].created > entry.created - 120
+    assert seeder.urls == []
+
+    monkeypatch.setenv('QGIS_TILES_SEED_HEADERS', 'Authorization,X-User-Groups')
+    store.entries[key] = entry._replace(created=entry.created - 120)
+    rv = client.get(qs, headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') == 'memory'
+    assert 'X-Tiles-Stale' in rv.headers
+    assert len(seeder.urls) == 1
+
+def test_tmsapi_previous_version_tiles(client, monkeypatch, tmp_path):
+    """ Test the TMS API - Stale tiles of the previous version of the project
+    """
+    from tilesForServer import tilecontent
+
+    store, seeder = _stale_tiles_setup(monkeypatch)
+    monkeypatch.setenv('QGIS_TILES_GENERATION_PATH', str(tmp_path))
+    monkeypatch.delenv('QGIS_TILES_MAX_AGE', raising=False)
+    monkeypatch.delenv('QGIS_TILES_MAX_STALE', raising=False)
+
+    project = QgsProject()
+    project.setFileName(client.getprojectpath("france_parts.qgs").strpath)
+    qs = "/tms/france_parts/0/0/0.png?MAP=%s" % project.fileName()
+
+    monkeypatch.setattr(tilecontent, 'project_fingerprint', lambda project: 'v1')
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    previous_entries = dict(store.entries)
+
+    # New version of the project
+    monkeypatch.setattr(tilecontent, 'project_fingerprint', lambda project: 'v2')
+    monkeypatch.setattr(tilecontent, 'previous_fingerprint', lambda project: 'v1')
+
+    # Tiles of the previous version are not served without maxAge or maxStale
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert 'X-Tiles-Stale' not in rv.headers
+    assert not seeder.urls
+
+    monkeypatch.setenv('QGIS_TILES_MAX_STALE', '600')
+    store.entries = dict(previous_entries)
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') == 'memory'
+    assert 'X-Tiles-Stale' in rv.headers
+    assert len(seeder.urls) == 1
+
+    # Tiles stored before the invalidation of the tile map are not served
+    rv = client.post("/tms/_cache?MAP=%s&TILEMAP=france_parts&MAXZOOM=0" % project.fileName())
+    assert rv.status_code == 200
+    store.entries = dict(previous_entries)
+    rv = client.get(qs)
+    assert rv.status_code == 200
+    assert rv.headers.get('X-Tiles-Cache') != 'memory'
+    assert 'X-Tiles-Stale' not in rv.headers
+
+def test_project_fingerprint(client, tmp_path):
+    """ Test that the fingerprint changes with the loaded project
+    """
+    from tilesForServer.fingerprint import previous_fingerprint, project_fingerprint
+
+    path = tmp_path.joinpath('project.qgs')
+    path.write_text('<qgis version="3.16"/>')
+
+    project = QgsProject()
+    project.setFileName(str(path))
+    fingerprint = project_fingerprint(project)
+    assert fingerprint == project_fingerprint(project)
+    assert previous_fingerprint(project) is None
+
+    # The file is updated while the loaded project is still served
+    path.write_text('<qgis version="3.16"><properties/></qgis>')
+    assert project_fingerprint(project) == fingerprint
+    assert previous_fingerprint(project) is None
+
+    # Loading the updated project
+    updated = QgsProject()
+    updated.setFileName(str(path))
+    assert project_fingerprint(updated) != fingerprint
+    # Stale tiles are looked up with the previous fingerprint
+    assert previous_fingerprint(updated) == fingerprint
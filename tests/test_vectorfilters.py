@@ -0,0 +1,65 @@
+""" Test vector tile layer filters
+"""
+from qgis.core import (
+    QgsRuleBasedRenderer,
+    QgsSymbol,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+
+
+def _rule(expression, minimum_scale=0, else_rule=False):
+    symbol = QgsSymbol.defaultSymbol(QgsWkbTypes.PointGeometry)
+    rule = QgsRuleBasedRenderer.Rule(symbol, 0, minimum_scale, expression)
+    rule.setIsElse(else_rule)
+    return rule
+
+
+def test_renderer_filter(client):
+    """ Test rule-based renderer filters
+    """
+    from tilesForServer.vectorfilters import FALSE, renderer_filter
+
+    root = QgsRuleBasedRenderer.Rule(None)
+    root.appendChild(_rule("\"name\" = 'a'"))
+    root.appendChild(_rule("\"name\" = 'b'", minimum_scale=100000))
+    renderer = QgsRuleBasedRenderer(root)
+
+    assert renderer_filter(renderer, 1000000) == "\"name\" = 'a'"
+    assert renderer_filter(renderer, 50000) == "(\"name\" = 'a') OR (\"name\" = 'b')"
+
+    # Rule without filter
+    root.appendChild(_rule(''))
+    assert renderer_filter(renderer, 50000) is None
+
+    # No feature drawn
+    root = QgsRuleBasedRenderer.Rule(None)
+    rule = _rule("\"name\" = 'a'")
+    rule.setActive(False)
+    root.appendChild(rule)
+    root.appendChild(_rule("\"name\" = 'b'", minimum_scale=100000))
+    assert renderer_filter(QgsRuleBasedRenderer(root), 1000000) == FALSE
+
+    # Else rules are not translated
+    root = QgsRuleBasedRenderer.Rule(None)
+    root.appendChild(_rule("\"name\" = 'a'"))
+    root.appendChild(_rule('', else_rule=True))
+    assert renderer_filter(QgsRuleBasedRenderer(root), 1000000) is None
+
+    # Other renderers draw all the features
+    layer = QgsVectorLayer("Point?crs=EPSG:4326&field=name:string", "points", "memory")
+    assert renderer_filter(layer.renderer(), 1000000) is None
+
+
+def test_layer_in_scale_range(client):
+    """ Test scale based visibility
+    """
+    from tilesForServer.vectorfilters import layer_in_scale_range
+
+    layer = QgsVectorLayer("Point?crs=EPSG:4326&field=name:string", "points", "memory")
+    assert layer_in_scale_range(layer, 1000000)
+
+    layer.setScaleBasedVisibility(True)
+    layer.setMinimumScale(100000)
+    assert not layer_in_scale_range(layer, 1000000)
+    assert layer_in_scale_range(layer, 50000)
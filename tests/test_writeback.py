@@ -0,0 +1,64 @@
+""" Test background tile store writes
+"""
+import threading
+
+
+def test_writeback_dedupe(client):
+    """ Test that pending writes to the same key are deduplicated
+    """
+    from tilesForServer.writeback import WriteBack
+
+    writer = WriteBack(threads=1, max_queue=10)
+
+    # Block the writer thread
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    assert writer.submit(b'block', block)
+    started.wait()
+
+    written = []
+    for i in range(5):
+        assert writer.submit(b'key', lambda i=i: written.append(i))
+    release.set()
+    writer.join()
+
+    assert written == [4]
+    stats = writer.stats()
+    assert stats['written'] == 2
+    assert stats['deduplicated'] == 4
+    assert stats['dropped'] == 0
+
+
+def test_writeback_overflow(client):
+    """ Test that writes are dropped when the queue is full
+    """
+    from tilesForServer.writeback import WriteBack
+
+    writer = WriteBack(threads=1, max_queue=2)
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    writer.submit(b'block', block)
+    started.wait()
+
+    written = []
+    results = [writer.submit(b'%d' % i, lambda i=i: written.append(i)) for i in range(4)]
+    assert results == [True, True, False, False]
+
+    # Discarded writes are not executed
+    writer.discard([b'0'])
+    release.set()
+    writer.join()
+
+    assert written == [1]
+    assert writer.stats()['dropped'] == 2
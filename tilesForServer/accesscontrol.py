@@ -0,0 +1,111 @@
+""" Access control partitioning of the tile caches
+
+    Tiles of layers without access control restrictions are shared
+    by all the users in the public partition. Restricted tiles are
+    partitioned by a fingerprint of the restrictions (read permission,
+    filters and hidden attributes), the access control cache key and
+    the user roles.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import hashlib
+
+from typing import List, Optional
+
+from qgis.core import QgsMapLayer, QgsVectorLayer
+from qgis.server import QgsServerRequest
+
+from tilesForServer.config import getenv
+
+# Partition of the tiles without access control restrictions
+PUBLIC = 'public'
+
+
+def role_headers() -> List[str]:
+    """ Return the names of the request headers holding the user roles
+
+        Set with `QGIS_TILES_ACL_HEADERS` as a comma separated list
+        (ie: `X-Lizmap-User-Groups`)
+    """
+    value = getenv('QGIS_TILES_ACL_HEADERS', '')
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def partition_forwarded(acl_key: str, forwarded: List[str]) -> bool:
+    """ Check that background requests of a tile of the partition,
+        with the forwarded request headers, get the same partition
+
+        Restricted partitions require the role headers and at least
+        one other header identifying the user (ie: `Authorization`).
+    """
+    if acl_key == PUBLIC:
+        return True
+    roles = {name.lower() for name in role_headers()}
+    names = {name.lower() for name in forwarded}
+    return bool(roles) and roles <= names and bool(names - roles)
+
+
+def access_control_cache_key(access_controls) -> List[str]:
+    """ Return the cache key of the access control filters
+    """
+    cache_key = []
+    try:
+        result = access_controls.fillCacheKey(cache_key)
+    except TypeError:
+        # Not available in the bindings
+        return []
+    # The key may be returned with the status
+    if isinstance(result, tuple):
+        ok, cache_key = result
+        if not ok:
+            return []
+    return list(cache_key)
+
+
+def authorized_attributes(layer: QgsVectorLayer, access_controls) -> Optional[List[str]]:
+    """ Return the attributes of the layer authorized by the access
+        controls, None if all the attributes are authorized
+    """
+    names = layer.fields().names()
+    authorized = set(access_controls.layerAttributes(layer, names))
+    if authorized.issuperset(names):
+        return None
+    return [name for name in names if name in authorized]
+
+
+def access_control_key(layers: List[QgsMapLayer], access_controls,
+                       request: Optional[QgsServerRequest] = None) -> str:
+    """ Return the partition of the tiles of the layers
+
+        Return `PUBLIC` if no access control restriction applies to
+        the layers.
+    """
+    if not access_controls:
+        return PUBLIC
+
+    restrictions = []
+    for layer in layers:
+        readable = access_controls.layerReadPermission(layer)
+        expression = subset = attributes = ''
+        if layer.type() == QgsMapLayer.VectorLayer:
+            expression = access_controls.layerFilterExpression(layer) or ''
+            subset = access_controls.extraSubsetString(layer) or ''
+            authorized = authorized_attributes(layer, access_controls)
+            if authorized is not None:
+                attributes = ','.join(authorized) or '-'
+        if not readable or expression or subset or attributes:
+            restrictions.extend((layer.id(), str(readable), expression, subset, attributes))
+
+    if not restrictions:
+        return PUBLIC
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('|'.join(restrictions).encode())
+    digest.update(b'\0')
+    digest.update('|'.join(access_control_cache_key(access_controls)).encode())
+    if request is not None:
+        for name in role_headers():
+            digest.update(b'\0')
+            digest.update(request.header(name).encode())
+    return digest.hexdigest()
@@ -0,0 +1,122 @@
+""" Tile requests access log
+
+    Requests are logged as NDJSON, one JSON object per line.
+    Entries are buffered and appended to the log file by batches.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+from typing import Dict, List, Optional
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.config import getenv, getenv_float, getenv_int
+
+
+class AccessLog:
+    """ Buffered NDJSON log
+
+        Entries are written when the buffer is full or when the
+        flush interval is elapsed.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 100, flush_interval: float = 5.) -> None:
+        self._path = path
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    @classmethod
+    def from_env(cls, name: str = 'QGIS_TILES_ACCESS_LOG') -> Optional['AccessLog']:
+        """ Create the access log from the environment
+
+            * `QGIS_TILES_ACCESS_LOG`: path of the log file, the log is disabled if not set
+            * `QGIS_TILES_ACCESS_LOG_BUFFER`: number of buffered entries
+            * `QGIS_TILES_ACCESS_LOG_INTERVAL`: maximum delay before writing entries in seconds
+
+            Other logs are configured with the same suffixes.
+        """
+        path = getenv(name)
+        if not path:
+            return None
+        log = cls(
+            path,
+            buffer_size=getenv_int(f'{name}_BUFFER', 100),
+            flush_interval=getenv_float(f'{name}_INTERVAL', 5.),
+        )
+        atexit.register(log.flush)
+        return log
+
+    def log(self, entry: Dict) -> None:
+        """ Add an entry to the log
+        """
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            self._buffer.append(line)
+            elapsed = time.monotonic() - self._last_flush
+            if len(self._buffer) < self._buffer_size and elapsed < self._flush_interval:
+                return
+            lines, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        self._write(lines)
+
+    def flush(self) -> None:
+        """ Write the buffered entries
+        """
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        self._write(lines)
+
+    def _write(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode()
+        try:
+            # Appends of a single write are not interleaved with
+            # the entries of other processes
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            QgsMessageLog.logMessage(f"Failed to write access log: {err}", "tilesApi", Qgis.Warning)
+
+
+_access_log: Optional[AccessLog] = None
+_initialized = False
+
+
+def access_log() -> Optional[AccessLog]:
+    """ Return the access log or None if disabled
+    """
+    global _access_log, _initialized
+    if not _initialized:
+        _access_log = AccessLog.from_env()
+        _initialized = True
+    return _access_log
+
+
+_timeout_log: Optional[AccessLog] = None
+_timeout_initialized = False
+
+
+def timeout_log() -> Optional[AccessLog]:
+    """ Return the log of the timed out tiles or None if disabled
+
+        Set with `QGIS_TILES_TIMEOUT_LOG`
+    """
+    global _timeout_log, _timeout_initialized
+    if not _timeout_initialized:
+        _timeout_log = AccessLog.from_env('QGIS_TILES_TIMEOUT_LOG')
+        _timeout_initialized = True
+    return _timeout_log
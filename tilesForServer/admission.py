@@ -0,0 +1,160 @@
+""" Admission control of tile renders
+
+    Renders of a tile map are limited to a number of slots shared by
+    the server processes of a host. Slots are fcntl locks on bytes of
+    a lock file per tile map: locks are released by the system if a
+    process dies.
+
+    Requests waiting for a slot hold a queue slot, requests are rejected
+    with `503 Service Unavailable` when the queue is full or when no
+    render slot is freed in time. Tiles from the caches never wait.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import fcntl
+import os
+import tempfile
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from tilesForServer.apiutils import HTTPError
+from tilesForServer.config import getenv, getenv_float, getenv_int
+
+
+class AdmissionControl:
+    """ Render slots and queues per tile map
+
+        * `slots`: default number of concurrent renders of a tile map,
+          renders are not limited if 0
+        * `queue_size`: number of requests waiting for a render slot
+        * `queue_timeout`: maximum waiting time for a render slot in seconds
+        * `retry_after`: value of the `Retry-After` header of rejected requests
+    """
+
+    def __init__(self, path: str, slots: int = 0, queue_size: int = 0, queue_timeout: float = 10.,
+                 retry_after: int = 2, poll_interval: float = 0.01, max_files: int = 256) -> None:
+        self.slots = slots
+        self._path = path
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._retry_after = retry_after
+        self._poll_interval = poll_interval
+        self._max_files = max_files
+        self._fds: Dict[str, int] = OrderedDict()
+
+        self._admitted = 0
+        self._queued = 0
+        self._rejected = 0
+        self._timeouts = 0
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionControl':
+        """ Create the admission control from the environment
+
+            * `QGIS_TILES_RENDER_SLOTS`: concurrent renders per tile map, not limited if not set
+            * `QGIS_TILES_RENDER_QUEUE_SIZE`: requests waiting for a render slot per tile map
+            * `QGIS_TILES_RENDER_QUEUE_TIMEOUT`: maximum waiting time for a render slot in seconds
+            * `QGIS_TILES_RETRY_AFTER`: `Retry-After` of rejected requests in seconds
+            * `QGIS_TILES_RENDER_LOCK_PATH`: directory of the lock files
+        """
+        slots = getenv_int('QGIS_TILES_RENDER_SLOTS')
+        return cls(
+            getenv('QGIS_TILES_RENDER_LOCK_PATH', os.path.join(tempfile.gettempdir(), 'qgis-tiles-slots')),
+            slots=slots,
+            queue_size=getenv_int('QGIS_TILES_RENDER_QUEUE_SIZE', slots),
+            queue_timeout=getenv_float('QGIS_TILES_RENDER_QUEUE_TIMEOUT', 10.),
+            retry_after=getenv_int('QGIS_TILES_RETRY_AFTER', 2),
+        )
+
+    def _fd(self, name: str) -> int:
+        fd = self._fds.get(name)
+        if fd is None:
+            os.makedirs(self._path, exist_ok=True)
+            fd = os.open(os.path.join(self._path, f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            self._fds[name] = fd
+            if len(self._fds) > self._max_files:
+                # Closing a file releases the locks of the process on it,
+                # the oldest file is not in use
+                _, old = self._fds.popitem(last=False)
+                os.close(old)
+        else:
+            self._fds.move_to_end(name)
+        return fd
+
+    @staticmethod
+    def _try_lock(fd: int, start: int, end: int) -> Optional[int]:
+        for offset in range(start, end):
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                return offset
+            except OSError:
+                continue
+        return None
+
+    @staticmethod
+    def _unlock(fd: int, offset: int) -> None:
+        fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset)
+
+    def _unavailable(self, name: str) -> HTTPError:
+        return HTTPError(503, f"No render slot available for {name}", reason="Too many tile renders",
+                         headers={'Retry-After': str(self._retry_after)})
+
+    @contextmanager
+    def admit(self, name: str, slots: int, queue: bool = True) -> Iterator[None]:
+        """ Hold a render slot of name
+
+            With `queue`, wait for a render slot if the queue is not full,
+            else reject the request if no render slot is free.
+        """
+        if slots <= 0:
+            yield
+            return
+
+        fd = self._fd(name)
+        slot = self._try_lock(fd, 0, slots)
+        if slot is None:
+            queue_slot = self._try_lock(fd, slots, slots + self._queue_size) if queue else None
+            if queue_slot is None:
+                self._rejected += 1
+                raise self._unavailable(name)
+            self._queued += 1
+            try:
+                deadline = time.monotonic() + self._queue_timeout
+                while slot is None:
+                    if time.monotonic() >= deadline:
+                        self._timeouts += 1
+                        raise self._unavailable(name)
+                    time.sleep(self._poll_interval)
+                    slot = self._try_lock(fd, 0, slots)
+            finally:
+                self._unlock(fd, queue_slot)
+
+        self._admitted += 1
+        try:
+            yield
+        finally:
+            self._unlock(fd, slot)
+
+    def stats(self) -> Dict:
+        return {
+            'admitted': self._admitted,
+            'queued': self._queued,
+            'rejected': self._rejected,
+            'timeouts': self._timeouts,
+        }
+
+
+_admission: Optional[AdmissionControl] = None
+
+
+def admission() -> AdmissionControl:
+    """ Return the admission control of the process
+    """
+    global _admission
+    if _admission is None:
+        _admission = AdmissionControl.from_env()
+    return _admission
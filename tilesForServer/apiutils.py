@@ -3,15 +3,17 @@
     author: David Marteau (3liz)
     Copyright: (C) 2019 3Liz
 """
+import hashlib
 import json
 import sys
+import time
 import traceback
 
 from http.client import responses as http_responses
-from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 from qgis.core import Qgis, QgsMessageLog, QgsProject
-from qgis.PyQt.QtCore import QRegularExpression, QUrl
+from qgis.PyQt.QtCore import QRegularExpression, QUrl, QUrlQuery
 from qgis.server import (
     QgsServerInterface,
     QgsServerOgcApi,
@@ -19,6 +21,11 @@ from qgis.server import (
     QgsServerRequest,
 )
 
+from tilesForServer.accesslog import access_log
+from tilesForServer.config import getenv_int
+from tilesForServer.fingerprint import project_fingerprint
+from tilesForServer.profiling import PROFILE_HEADER, Profiler, profiler
+
 
 class HTTPError(Exception):
 
@@ -28,6 +35,7 @@ class HTTPError(Exception):
         self.log_message = log_message
         self.args = args
         self.reason =  kwargs.get("reason", None)
+        self.headers = kwargs.get("headers", None) or {}
 
     def __str__(self) -> str:
         message = "HTTP %d: %s" % (
@@ -40,16 +48,58 @@ class HTTPError(Exception):
             return message
 
 
+# Size of the chunks of streamed responses
+STREAM_CHUNK_SIZE = getenv_int('QGIS_TILES_STREAM_CHUNK_SIZE', 256) * 1024
+
+
+class _Activity:
+    """ Requests in progress in the process
+    """
+    active = 0
+    last = 0.
+
+
+def idle_time() -> float:
+    """ Return the time in seconds since the last request of the
+        process finished, 0 if a request is in progress
+    """
+    if _Activity.active:
+        return 0.
+    return time.monotonic() - _Activity.last
+
+
 class RequestHandler:
 
-    def __init__(self, parent: QgsServerOgcApiHandler,  context) -> None:
+    def __init__(self, parent: QgsServerOgcApiHandler,  context=None) -> None:
         self._parent   = parent
+        self._project_needed = False
+        if context is not None:
+            self.reset(context)
+
+    def reset(self, context) -> None:
+        """ Bind the handler to a request context
+        """
         self._context  = context
         self._response = context.response()
         self._request  = context.request()
         self._project  = context.project()
-        self._project_needed = False
         self._finished = False
+        self._log_values = {}
+
+    def release(self) -> None:
+        """ Drop references to the request context
+
+            The context is only valid for the duration of the request
+        """
+        self._context  = None
+        self._response = None
+        self._request  = None
+        self._project  = None
+
+    def log_values(self, **values: Any) -> None:
+        """ Add values to the access log entry of the request
+        """
+        self._log_values.update(values)
 
     def initialize(self, **kwargs: Any ) -> None:
         """ May be overrided
@@ -68,6 +118,50 @@ class RequestHandler:
         """
         return self._parent.href(self._context,path,extension)
 
+    def api_href(self, path: str="") -> str:
+        """ Returns an URL relative to the API root path
+        """
+        url = QUrl(self._request.url())
+        url.setPath(self._context.matchedPath() + path)
+        return url.toString()
+
+    def get_argument(self, name: str, default: Optional[str]=None) -> Optional[str]:
+        """ Returns the value of the query argument 'name'
+        """
+        query = QUrlQuery(self._request.url())
+        if not query.hasQueryItem(name):
+            return default
+        return query.queryItemValue(name, QUrl.FullyDecoded)
+
+    def check_etag(self, etag: str) -> bool:
+        """ Set the ETag header
+
+            Return True if the client already has the current
+            version: the request is finished with a 304 status
+        """
+        etag = f'"{etag}"'
+        self.set_header('ETag', etag)
+        if_none_match = self._request.header('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if '*' not in tags and etag not in tags and f"W/{etag}" not in tags:
+            return False
+        self.set_status(304)
+        self.finish()
+        return True
+
+    def check_document_etag(self) -> bool:
+        """ Check the ETag of a document built from the project
+
+            The document only depends on the project version and
+            the request url
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(project_fingerprint(self._project).encode())
+        digest.update(self._request.url().toString().encode())
+        return self.check_etag(digest.hexdigest())
+
     @property
     def project(self) -> Optional[QgsProject]:
         """ Return the current project (or None)
@@ -92,15 +186,35 @@ class RequestHandler:
         self._finished = True
         self._response.finish()
 
-    def write(self, chunk: Union[str, bytes, dict]) -> None:
-        """
+    def write(self, chunk: Union[str, bytes, bytearray, memoryview, dict]) -> None:
+        """ Write to the response
+
+            Large chunks are streamed
         """
-        if not isinstance(chunk, (bytes, str, dict)):
-            raise TypeError("write() only accepts bytes, unicode, and dict objects")
+        if not isinstance(chunk, (bytes, bytearray, memoryview, str, dict)):
+            raise TypeError("write() only accepts bytes, memoryview, unicode, and dict objects")
         if isinstance(chunk, dict):
-            chunk = json.dumps(chunk, sort_keys=True)
+            chunk = json.dumps(chunk, sort_keys=True).encode()
             self.set_header('Content-Type', 'application/json;charset=utf-8')
-        self._response.write(chunk)
+        if isinstance(chunk, str):
+            self._response.write(chunk)
+        elif len(chunk) > STREAM_CHUNK_SIZE:
+            self.write_stream(chunk)
+        else:
+            self._response.write(bytes(chunk))
+
+    def write_stream(self, data: Union[bytes, bytearray, memoryview],
+                     chunk_size: Optional[int] = None) -> None:
+        """ Write data by chunks, flushing the response after each chunk
+
+            Headers are sent with the first chunk and cannot be
+            changed afterwards.
+        """
+        chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), chunk_size):
+            self._response.write(view[start:start + chunk_size].tobytes())
+            self._response.flush()
 
     def set_status(self, status_code: int, reason: Optional[str]=None) -> None:
         """
@@ -125,6 +239,8 @@ class RequestHandler:
                     QgsMessageLog.logMessage(f"{exception}", "tilesApi", Qgis.Warning)
                 if exception.reason:
                     reason = exception.reason
+                for name, value in exception.headers.items():
+                    self.set_header(name, value)
         self.set_status(status_code, reason=reason)
         self.write(dict(status="error" if status_code != 200 else "ok",
                         httpcode = status_code,
@@ -160,6 +276,48 @@ class RequestHandler:
     def execute(self, values):
         """ Execute the request
         """
+        _Activity.active += 1
+        try:
+            profile = profiler()
+            if profile is not None and profile.accepts(self._request.url().path(),
+                                                       self._request.header(PROFILE_HEADER)):
+                self._execute_profiled(profile, values)
+            else:
+                self._execute_logged(values)
+        finally:
+            _Activity.active -= 1
+            _Activity.last = time.monotonic()
+
+    def _execute_profiled(self, profile: Profiler, values):
+        with profile.profile(self._request.url().toString()) as summary:
+            if summary:
+                self.log_values(profile=summary['name'])
+            self._execute_logged(values)
+            summary['status'] = self._response.statusCode()
+
+    def _execute_logged(self, values):
+        log = access_log()
+        if log is None:
+            self._execute(values)
+            return
+
+        start = time.perf_counter()
+        try:
+            self._execute(values)
+        finally:
+            url = self._request.url()
+            log.log({
+                'time': time.time(),
+                'method': self.METHODS.get(self._request.method(), ''),
+                'path': url.path(),
+                'query': url.query(),
+                'project': self._project.fileName() if self._project else None,
+                'status': self._response.statusCode(),
+                'duration': round((time.perf_counter() - start) * 1000, 3),
+                **self._log_values,
+            })
+
+    def _execute(self, values):
         try:
             method = self._request.method()
             if method not in self.METHODS:
@@ -177,7 +335,7 @@ class RequestHandler:
             if not self._finished:
                 self.finish()
         except Exception as e:
-            if self._finished:
+            if self._finished or self._response.headersSent():
                 # Nothing to send, but log for debugging purpose
                 QgsMessageLog.logMessage(traceback.format_exc(), "tilesApi",Qgis.Critical)
                 return
@@ -190,6 +348,11 @@ class RequestHandler:
 
 
 
+# Split based path matcher: return the path values
+# or None if the path does not match
+FastMatch = Callable[[str], Optional[Dict[str, str]]]
+
+
 class RequestHandlerDelegate(QgsServerOgcApiHandler):
     """ Delegate request to handler
     """
@@ -200,7 +363,8 @@ class RequestHandlerDelegate(QgsServerOgcApiHandler):
 
     def __init__(self, path: str, handler: Type[RequestHandler],
                  content_types=[QgsServerOgcApi.JSON,],
-                 kwargs: Dict={}):
+                 kwargs: Dict={},
+                 fast_match: Optional[FastMatch]=None):
 
         super().__init__()
         if content_types:
@@ -209,6 +373,9 @@ class RequestHandlerDelegate(QgsServerOgcApiHandler):
         self._name = handler.__name__
         self._handler = handler
         self._kwargs = kwargs
+        self._fast_match = fast_match
+        # Pool of idle handlers for the fast path
+        self._idle = []
 
         self.__instances.append(self)
 
@@ -244,6 +411,31 @@ class RequestHandlerDelegate(QgsServerOgcApiHandler):
         handler.initialize(**self._kwargs)
         handler.execute(self.values(context))
 
+    def fast_match(self, path: str) -> Optional[Dict[str, str]]:
+        """ Return the path values if the fast matcher accept the path
+        """
+        if self._fast_match is None:
+            return None
+        return self._fast_match(path)
+
+    def handleFastRequest(self, context, values: Dict[str, str]) -> None:
+        """ Handle a request already matched by the fast path
+
+            Handler instances are initialized once and reused
+            across requests.
+        """
+        try:
+            handler = self._idle.pop()
+        except IndexError:
+            handler = self._handler(self)
+            handler.initialize(**self._kwargs)
+        try:
+            handler.reset(context)
+            handler.execute(values)
+        finally:
+            handler.release()
+            self._idle.append(handler)
+
 
 class _ServerApi(QgsServerOgcApi):
     """ Redefine Accept method as to get exact match
@@ -253,6 +445,7 @@ class _ServerApi(QgsServerOgcApi):
     # See above
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
+        self._fast_routes = []
 
         self.__instances.append(self)
 
@@ -261,6 +454,28 @@ class _ServerApi(QgsServerOgcApi):
         """
         return url.path().startswith( self.rootPath() )
 
+    def registerFastRoute(self, delegate: RequestHandlerDelegate) -> None:
+        """ Register a delegate to be tried before the regular
+            handler selection
+        """
+        self._fast_routes.append(delegate)
+
+    def executeRequest(self, context) -> None:
+        """ Override the api to dispatch fast routes
+
+            Fast routes bypass the regular expression matching
+            of all registered handlers and the parameters extraction
+            from the url.
+        """
+        if self._fast_routes:
+            path = context.request().url().path()[len(self.rootPath()):]
+            for delegate in self._fast_routes:
+                values = delegate.fast_match(path)
+                if values is not None:
+                    delegate.handleFastRequest(context, values)
+                    return
+        super().executeRequest(context)
+
 
 HandlerDefinition = Tuple[str,Type[RequestHandler],Dict]
 
@@ -273,8 +488,12 @@ def register_api_handlers(serverIface, rootpath: str, name: str, handlers: List[
     for path,handler,kwargs in handlers:
         kw = kwargs.copy() # Ensure that kwargs dict is not mutated
         content_types = kw.pop('content_types',[QgsServerOgcApi.JSON,])
-        api.registerHandler(RequestHandlerDelegate(path,handler,content_types=content_types,
-                                                   kwargs=kw))
+        fast_match = kw.pop('fast_match', None)
+        delegate = RequestHandlerDelegate(path,handler,content_types=content_types,
+                                          kwargs=kw, fast_match=fast_match)
+        api.registerHandler(delegate)
+        if fast_match is not None:
+            api.registerFastRoute(delegate)
 
     serverIface.serviceRegistry().registerApi(api)
 
@@ -0,0 +1,156 @@
+""" Native tile stores
+
+    Tile stores are checked before the QGIS server cache manager.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import hashlib
+import struct
+
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from qgis.core import Qgis, QgsMessageLog
+
+
+class TileEntry(NamedTuple):
+    data: bytes
+    # Creation timestamp
+    created: float
+    # Content hash
+    digest: bytes
+
+
+class TileReference(NamedTuple):
+    # Creation timestamp
+    created: float
+    # Content hash
+    digest: bytes
+
+
+class TileStore(ABC):
+    """ Base class for tile stores
+
+        Keys are binary digests. Tile data is stored once per
+        content hash, keys hold references to the tile data.
+    """
+    name = 'store'
+
+    @abstractmethod
+    def get(self, key: bytes) -> Optional[TileEntry]:
+        """ Return the entry of key
+        """
+
+    def get_reference(self, key: bytes) -> Optional[TileReference]:
+        """ Return the creation time and the content hash of key
+            without reading the data
+        """
+        entry = self.get(key)
+        return TileReference(entry.created, entry.digest) if entry is not None else None
+
+    def get_many(self, keys: Sequence[bytes]) -> List[Optional[TileEntry]]:
+        """ Return the entries of keys
+        """
+        return [self.get(key) for key in keys]
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        """ Check which keys are stored
+        """
+        return [self.get_reference(key) is not None for key in keys]
+
+    @abstractmethod
+    def set(self, key: bytes, data: bytes, created: Optional[float] = None,
+            digest: Optional[bytes] = None) -> None:
+        """ Store data for key
+
+            `digest` is the content hash of data if already computed
+        """
+
+    @abstractmethod
+    def delete(self, key: bytes) -> None:
+        """ Delete the reference of key
+        """
+
+    def delete_many(self, keys: Sequence[bytes]) -> None:
+        for key in keys:
+            self.delete(key)
+
+    def stats(self) -> Dict:
+        return {}
+
+
+def content_digest(data: bytes) -> bytes:
+    """ Return the content hash of the tile data
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def tile_key(*parts) -> bytes:
+    """ Return the store key for the key parts
+    """
+    return hashlib.blake2b('|'.join(str(part) for part in parts).encode(), digest_size=16).digest()
+
+
+# Interned namespace ids
+_namespaces: Dict[Tuple, int] = {}
+_namespaces_size = 4096
+
+CODE_KEY = struct.Struct('<QQ')
+# Odd multiplier spreading the tile codes over the store sets
+CODE_MIX = 0x9E3779B97F4A7C15
+
+
+def tile_namespace(*parts) -> int:
+    """ Return the 64-bit id of the namespace of the key parts
+
+        Ids are stable across processes and interned per process.
+    """
+    namespace = _namespaces.get(parts)
+    if namespace is None:
+        if len(_namespaces) >= _namespaces_size:
+            _namespaces.clear()
+        digest = hashlib.blake2b('|'.join(str(part) for part in parts).encode(), digest_size=8).digest()
+        namespace = _namespaces[parts] = int.from_bytes(digest, 'little')
+    return namespace
+
+
+def tile_code_key(namespace: int, code: int) -> bytes:
+    """ Return the store key of the tile code in the namespace
+
+        The first 8 bytes, hashed by the stores, mix the code
+        and the namespace.
+    """
+    return CODE_KEY.pack((code * CODE_MIX + namespace) & 0xFFFFFFFFFFFFFFFF, namespace)
+
+
+_stores: Optional[List[TileStore]] = None
+
+
+def create_stores() -> List[TileStore]:
+    """ Create the tile stores configured in the environment
+    """
+    from tilesForServer.rediscache import RedisStore
+    from tilesForServer.shmcache import SharedMemoryStore
+
+    # Local stores are checked first
+    stores = []
+    for factory in (SharedMemoryStore.from_env, RedisStore.from_env):
+        try:
+            store = factory()
+        except Exception as err:
+            QgsMessageLog.logMessage(f"Failed to create tile store: {err}", "tilesApi", Qgis.Critical)
+            continue
+        if store is not None:
+            QgsMessageLog.logMessage(f"Using tile store {store.name}", "tilesApi", Qgis.Info)
+            stores.append(store)
+    return stores
+
+
+def tile_stores() -> List[TileStore]:
+    """ Return the configured tile stores
+    """
+    global _stores
+    if _stores is None:
+        _stores = create_stores()
+    return _stores
@@ -0,0 +1,423 @@
+""" Tile maps catalog built from the WMTS Server project configuration
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+from typing import Dict, List, Optional, Tuple
+
+from qgis.core import (
+    Qgis,
+    QgsCoordinateTransform,
+    QgsMapLayer,
+)
+from qgis.server import QgsServerProjectUtils
+
+from tilesForServer.config import TileMapOptions
+from tilesForServer.encoders import EXTRA_FORMATS, webp_supported
+from tilesForServer.tilematrix import (
+    TileMatrixSet,
+    default_tile_matrix_set,
+    project_tile_matrix_sets,
+)
+
+
+class ProjectParser:
+
+    def tile_project_info(self):
+        project = self.project
+        # The project as tiles source
+        if not project.readBoolEntry("WMTSLayers", "Project")[0]:
+            return
+
+        # project identifier
+        root_name = QgsServerProjectUtils.wmsRootName(project)
+        if not root_name:
+            root_name = project.title()
+        if not root_name:
+            return
+
+        # available formats
+        formats = []
+        if project.readBoolEntry("WMTSPngLayers", "Project")[0]:
+            formats.append('png')
+        if project.readBoolEntry("WMTSJpegLayers", "Project")[0]:
+            formats.append('jpg')
+
+        if self.support_pbf():
+            for layer in project.mapLayers().values():
+                if layer.type() == QgsMapLayer.VectorLayer:
+                    formats.append('pbf')
+                    break
+
+        if not formats:
+            return
+
+        # tileMap info
+        yield {
+            'source_id': root_name,
+            'source_type': 'project',
+            'id': root_name,
+            'title': project.title(),
+            'abstract': project.title(),
+            'formats': formats,
+        }
+
+    def tile_groups_info(self):
+        project = self.project
+
+        # Groups as tiles source
+        g_names = project.readListEntry("WMTSLayers", "Group")[0]
+        if not g_names:
+            return
+
+        tree_root = project.layerTreeRoot()
+
+        png_g_names = project.readListEntry("WMTSPngLayers", "Group")[0]
+        jpg_g_names = project.readListEntry("WMTSJpegLayers", "Group")[0]
+
+        for g_name in g_names:
+            tree_group = tree_root.findGroup(g_name)
+            if not tree_group:
+                continue
+
+            # Group identifier and other infos
+            g_id = tree_group.customProperty("wmsShortName")
+            if not g_id:
+                g_id = g_name
+            g_title = tree_group.customProperty("wmsTitle")
+            if not g_title:
+                g_title = g_name
+            g_abstract = tree_group.customProperty("wmsAbstract")
+
+            # available formats
+            g_formats = []
+            if g_name in png_g_names:
+                g_formats.append('png')
+            if g_name in jpg_g_names:
+                g_formats.append('jpg')
+
+            if self.support_pbf():
+                for tree_layer in tree_group.findLayers():
+                    layer = tree_layer.layer()
+                    if not layer:
+                        continue
+                    if layer.type() == QgsMapLayer.VectorLayer:
+                        g_formats.append('pbf')
+                        break
+
+            if not g_formats:
+                continue
+
+            # tileMap info
+            yield {
+                'source_id': g_name,
+                'source_type': 'group',
+                'id': g_id,
+                'title': g_title,
+                'abstract': g_abstract,
+                'formats': g_formats,
+            }
+
+    def tile_layers_info(self):
+        project = self.project
+
+        # Layers as tiles source
+        layer_ids = project.readListEntry("WMTSLayers", "Layer")[0]
+        if not layer_ids:
+            return
+
+        png_layer_ids = project.readListEntry("WMTSPngLayers", "Layer")[0]
+        jpg_layer_ids = project.readListEntry("WMTSJpegLayers", "Layer")[0]
+
+        for layer_id in layer_ids:
+            layer = project.mapLayer(layer_id)
+            if not layer:
+                continue
+
+            # Layer identifier and informations
+            l_id = layer.shortName()
+            if not l_id:
+                l_id = layer.name()
+            l_title = layer.title()
+            if not l_title:
+                l_title = layer.name()
+
+            # available formats
+            l_formats = []
+            if layer_id in png_layer_ids:
+                l_formats.append('png')
+            if layer_id in jpg_layer_ids:
+                l_formats.append('jpg')
+
+            if self.support_pbf() and \
+               layer.type() == QgsMapLayer.VectorLayer:
+                l_formats.append('pbf')
+
+            if not l_formats:
+                continue
+
+            # tileMap info
+            yield {
+                'source_id': layer.id(),
+                'source_type': 'layer',
+                'id': l_id,
+                'title': l_title,
+                'abstract': layer.abstract(),
+                'formats': l_formats,
+            }
+
+    def tile_maps_info(self):
+        # The project as tiles source
+        for info in self.tile_project_info():
+            yield self.with_extra_formats(info)
+
+        # Groups as tiles source
+        for info in self.tile_groups_info():
+            yield self.with_extra_formats(info)
+
+        # Layers as tiles source
+        for info in self.tile_layers_info():
+            yield self.with_extra_formats(info)
+
+    def tilemap_options(self, tilemapid: str) -> TileMapOptions:
+        """ Return the tile map options
+        """
+        return TileMapOptions(self.project, tilemapid)
+
+    def with_extra_formats(self, info: Dict) -> Dict:
+        """ Add the raster encodings enabled with the `formats` tile map option
+
+            Extra encodings are only available for tile maps published
+            as raster in the WMTS configuration.
+        """
+        formats = info['formats']
+        if 'png' not in formats and 'jpg' not in formats:
+            return info
+        for ext in self.tilemap_options(info['id']).get_list('formats'):
+            if ext not in EXTRA_FORMATS or ext in formats:
+                continue
+            if ext == 'webp' and not webp_supported():
+                continue
+            formats.append(ext)
+        return info
+
+    def get_tilemap_info(self, tilemapid: str) -> Optional[Dict]:
+        """ Return the tile map info or None if the tile map is not found
+        """
+        for info in self.tile_maps_info():
+            if tilemapid == info['id']:
+                return info
+        return None
+
+    def tile_matrix_sets(self) -> Dict[str, TileMatrixSet]:
+        """ Return the tile matrix sets configured in the project
+        """
+        return project_tile_matrix_sets(self.project)
+
+    def get_tile_matrix_set(self, tilemapid: str) -> Tuple[str, Optional[TileMatrixSet]]:
+        """ Split the tile map id from the tile matrix set identifier
+
+            The tile matrix set is selected with a `@{tileMatrixSet}` suffix
+            ie: `france_parts@EPSG:2154`, the default tile matrix set
+            is used when no suffix is given.
+        """
+        grids = self.tile_matrix_sets()
+        if '@' not in tilemapid:
+            return tilemapid, default_tile_matrix_set(grids)
+        tilemapid, grid = tilemapid.rsplit('@', 1)
+        return tilemapid, grids.get(grid)
+
+    def get_complete_tilemap_info(self, tilemapid, tms: TileMatrixSet):
+        """
+        """
+        for info in self.tile_maps_info():
+            if tilemapid != info['id']:
+                continue
+
+            extra = {**info}
+            source_type = extra.pop('source_type')
+            source_id = extra.pop('source_id')
+
+            extra['crs'] = tms.identifier
+            extra['bbox'] = self.get_tilemap_bbox(source_type, source_id, tms.crs)
+            extra['tileMatrixSets'] = [grid.as_dict() for grid in self.tile_matrix_sets().values()]
+            extra['formats'] = [{
+                'extension': ext,
+                'mimetype': self.mimetypeFromExtension(ext)
+            } for ext in extra['formats']]
+
+            # Clients should overzoom vector tiles above maxzoom
+            maxzoom = self.vector_maxzoom(tilemapid, tms)
+            for fmt in extra['formats']:
+                if fmt['extension'] == 'pbf' and maxzoom < tms.last_level:
+                    fmt['maxzoom'] = maxzoom
+            return extra
+        return None
+
+    def vector_maxzoom(self, tilemapid: str, tms: TileMatrixSet) -> int:
+        """ Return the maximum zoom level vector tiles are built for
+
+            Set with the `maxZoom` tile map option, defaults to the
+            tile matrix set last level.
+        """
+        maxzoom = self.tilemap_options(tilemapid).get_int('maxZoom', -1)
+        if maxzoom < 0:
+            return tms.last_level
+        return min(maxzoom, tms.last_level)
+
+    def get_tilemap_bbox(self, source_type, source_id, crs_dest):
+        """
+        """
+        bbox = None
+        if source_type == 'project':
+            bbox = self.get_project_bbox(crs_dest)
+        elif source_type == 'group':
+            bbox = self.get_group_bbox(source_id, crs_dest)
+        elif source_type == 'layer':
+            bbox = self.get_layer_bbox(source_id, crs_dest)
+        return bbox
+
+    def get_project_bbox(self, crs_dest):
+        """
+        """
+        project = self.project
+
+        xform_context = project.transformContext()
+
+        proj_rect = QgsServerProjectUtils.wmsExtent(project)
+        xform = QgsCoordinateTransform(project.crs(), crs_dest, xform_context)
+        proj_rect = xform.transform(proj_rect)
+
+        return [
+            proj_rect.xMinimum(), proj_rect.yMinimum(),
+            proj_rect.xMaximum(), proj_rect.yMaximum()
+        ]
+
+    def get_group_bbox(self, group_name, crs_dest):
+        """
+        """
+        project = self.project
+        xform_context = project.transformContext()
+
+        group_rect = None
+
+        tree_root = project.layerTreeRoot()
+        tree_group = tree_root.findGroup(group_name)
+
+        for tree_layer in tree_group.findLayers():
+            layer = tree_layer.layer()
+            if not layer:
+                continue
+
+            xform = QgsCoordinateTransform(layer.crs(), crs_dest, xform_context)
+            if not group_rect:
+                group_rect = xform.transform(layer.extent())
+            else:
+                group_rect.combineExtentWith(xform.transform(layer.extent()))
+
+        if not group_rect:
+            return group_rect
+
+        return [
+            group_rect.xMinimum(), group_rect.yMinimum(),
+            group_rect.xMaximum(), group_rect.yMaximum()
+        ]
+
+    def get_layer_bbox(self, layer_id, crs_dest):
+        project = self.project
+        xform_context = project.transformContext()
+
+        layer = project.mapLayer(layer_id)
+        if not layer:
+            return None
+
+        xform = QgsCoordinateTransform(layer.crs(), crs_dest, xform_context)
+        layer_rect = xform.transform(layer.extent())
+
+        if not layer_rect:
+            return layer_rect
+
+        return [
+            layer_rect.xMinimum(), layer_rect.yMinimum(),
+            layer_rect.xMaximum(), layer_rect.yMaximum()
+        ]
+
+    def tilemap_vectorlayers(self, tilemapid):
+        for info in self.tile_maps_info():
+            if tilemapid != info['id']:
+                continue
+
+            project = self.project
+
+            source_type = info.get('source_type')
+            source_id = info.get('source_id')
+            if source_type == 'project':
+                for layer in project.mapLayers().values():
+                    if layer.type() == QgsMapLayer.VectorLayer:
+                        yield layer
+            elif source_type == 'group':
+                tree_root = project.layerTreeRoot()
+                tree_group = tree_root.findGroup(source_id)
+                if not tree_group:
+                    return
+                for tree_layer in tree_group.findLayers():
+                    layer = tree_layer.layer()
+                    if not layer:
+                        continue
+                    if layer.type() == QgsMapLayer.VectorLayer:
+                        yield layer
+            elif source_type == 'layer':
+                layer = project.mapLayer(source_id)
+                if not layer:
+                    return
+                if layer.type() == QgsMapLayer.VectorLayer:
+                    yield layer
+
+    def tilemap_layers(self, tilemapid) -> List[QgsMapLayer]:
+        """ Return the layers to render for the tile map
+
+            Layers are returned in rendering order, top layer first,
+            restricted WMS layers are excluded.
+        """
+        info = self.get_tilemap_info(tilemapid)
+        if not info:
+            return []
+
+        project = self.project
+        restricted = set(QgsServerProjectUtils.wmsRestrictedLayers(project))
+
+        source_type = info['source_type']
+        source_id = info['source_id']
+        layer_order = project.layerTreeRoot().layerOrder()
+        if source_type == 'project':
+            layers = layer_order
+        elif source_type == 'group':
+            tree_group = project.layerTreeRoot().findGroup(source_id)
+            if not tree_group:
+                return []
+            ids = set(tree_group.findLayerIds())
+            layers = [layer for layer in layer_order if layer.id() in ids]
+        else:
+            layer = project.mapLayer(source_id)
+            layers = [layer] if layer else []
+
+        return [layer for layer in layers if layer.name() not in restricted]
+
+    def mimetypeFromExtension(self, extension):
+        if extension in ('png', 'png8'):
+            return 'image/png'
+        elif extension in ('jpg', 'jpeg'):
+            return 'image/jpeg'
+        elif extension == 'webp':
+            return 'image/webp'
+        elif extension == 'mixed':
+            # Depends on the tile transparency
+            return 'image/png'
+
+        if self.support_pbf() and extension == 'pbf':
+            return 'application/x-protobuf'
+
+        return ''
+
+    def support_pbf(self):
+        return Qgis.QGIS_VERSION_INT >= 31400
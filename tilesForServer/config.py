@@ -0,0 +1,102 @@
+""" Plugin configuration
+
+    Server wide settings are read from environment variables,
+    tile map settings are read from the project properties.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import os
+
+from typing import List, Optional
+
+from qgis.core import QgsProject
+
+# Project properties scope
+SCOPE = "TilesForServer"
+
+
+def getenv(name: str, default: Optional[str] = None) -> Optional[str]:
+    """ Return environment variable value
+    """
+    return os.getenv(name, default)
+
+
+def getenv_bool(name: str, default: bool = False) -> bool:
+    """ Return environment variable as boolean
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'yes', 'true', 'on')
+
+
+def getenv_int(name: str, default: int = 0) -> int:
+    """ Return environment variable as integer
+    """
+    value = os.getenv(name)
+    if not value:
+        return default
+    return int(value)
+
+
+def getenv_float(name: str, default: float = 0.) -> float:
+    """ Return environment variable as float
+    """
+    value = os.getenv(name)
+    if not value:
+        return default
+    return float(value)
+
+
+class TileMapOptions:
+    """ Tile map options
+
+        Options are read from the project properties
+        `TilesForServer/TileMaps/{tilemapid}/{option}` and default
+        to `TilesForServer/TileMaps/{option}` for all the tile maps
+        of the project.
+    """
+
+    def __init__(self, project: QgsProject, tilemapid: str) -> None:
+        self._project = project
+        self._tilemapid = tilemapid
+
+    def _keys(self, name: str):
+        yield f"/TileMaps/{self._tilemapid}/{name}"
+        yield f"/TileMaps/{name}"
+
+    def get_str(self, name: str, default: str = "") -> str:
+        for key in self._keys(name):
+            value, ok = self._project.readEntry(SCOPE, key, "")
+            if ok:
+                return value
+        return default
+
+    def get_int(self, name: str, default: int = 0) -> int:
+        for key in self._keys(name):
+            value, ok = self._project.readNumEntry(SCOPE, key, default)
+            if ok:
+                return value
+        return default
+
+    def get_float(self, name: str, default: float = 0.) -> float:
+        for key in self._keys(name):
+            value, ok = self._project.readDoubleEntry(SCOPE, key, default)
+            if ok:
+                return value
+        return default
+
+    def get_bool(self, name: str, default: bool = False) -> bool:
+        for key in self._keys(name):
+            value, ok = self._project.readBoolEntry(SCOPE, key, default)
+            if ok:
+                return value
+        return default
+
+    def get_list(self, name: str) -> List[str]:
+        for key in self._keys(name):
+            value, ok = self._project.readListEntry(SCOPE, key, [])
+            if ok:
+                return value
+        return []
@@ -0,0 +1,285 @@
+""" Coverage index of vector tile maps
+
+    The coverage index is a bitset of the tiles holding features at a
+    base zoom level, built from the bounding boxes of the features.
+    Vector tiles at or above the base zoom level outside of the covered
+    tiles are empty: they are answered without querying the layers.
+
+    Indexes are built by the tile cache management API, never on the
+    request path: tiles are covered until the index of the project
+    version exists. Indexes are persisted in the `QGIS_TILES_COVERAGE_PATH`
+    directory, builds and updates hold an exclusive lock of the index.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import fcntl
+import os
+import struct
+import tempfile
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from qgis.core import (
+    Qgis,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsFeatureRequest,
+    QgsMessageLog,
+    QgsProject,
+    QgsRectangle,
+    QgsVectorLayer,
+)
+
+from tilesForServer.cache import tile_key
+from tilesForServer.config import getenv, getenv_int
+from tilesForServer.fingerprint import project_fingerprint
+from tilesForServer.tilematrix import TileMatrixSet
+
+# Magic, version, unbounded, zoom, col min, row min, width, height
+HEADER = struct.Struct('<4sBBHiiii')
+MAGIC = b'TCOV'
+VERSION = 1
+
+# Vector tiles carry the features in a buffer of 1/16 of the tile size
+TILE_BUFFER = 1 / 16
+
+
+class CoverageIndex:
+    """ Bitset of the covered tiles of a range at a base zoom level
+
+        Tiles outside of the range are covered if the index is unbounded,
+        ie: when features lie outside of the extent of their layer.
+    """
+
+    def __init__(self, zoom: int, col_min: int, row_min: int, width: int, height: int,
+                 bits: Optional[bytearray] = None, unbounded: bool = False) -> None:
+        self.zoom = zoom
+        self.col_min = col_min
+        self.row_min = row_min
+        self.width = width
+        self.height = height
+        self.unbounded = unbounded
+        self._bits = bits if bits is not None else bytearray((width * height + 7) // 8)
+
+    def add(self, col_min: int, row_min: int, col_max: int, row_max: int) -> None:
+        """ Mark the tiles of the range at the base zoom level as covered
+        """
+        c0 = max(col_min - self.col_min, 0)
+        r0 = max(row_min - self.row_min, 0)
+        c1 = min(col_max - self.col_min, self.width - 1)
+        r1 = min(row_max - self.row_min, self.height - 1)
+        if (c0, r0, c1, r1) != (col_min - self.col_min, row_min - self.row_min,
+                                col_max - self.col_min, row_max - self.row_min):
+            self.unbounded = True
+        bits = self._bits
+        for r in range(r0, r1 + 1):
+            for i in range(r * self.width + c0, r * self.width + c1 + 1):
+                bits[i >> 3] |= 1 << (i & 7)
+
+    def covers(self, zoom: int, col: int, row: int) -> bool:
+        """ Check if the tile may hold features
+
+            Tiles below the base zoom level are always covered
+        """
+        if zoom < self.zoom:
+            return True
+        shift = zoom - self.zoom
+        c = (col >> shift) - self.col_min
+        r = (row >> shift) - self.row_min
+        if not (0 <= c < self.width and 0 <= r < self.height):
+            return self.unbounded
+        i = r * self.width + c
+        return bool(self._bits[i >> 3] & (1 << (i & 7)))
+
+    def to_bytes(self) -> bytes:
+        return HEADER.pack(MAGIC, VERSION, self.unbounded, self.zoom, self.col_min,
+                           self.row_min, self.width, self.height) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CoverageIndex':
+        magic, version, unbounded, zoom, col_min, row_min, width, height = HEADER.unpack_from(data)
+        bits = bytearray(data[HEADER.size:])
+        if magic != MAGIC or version != VERSION or len(bits) != (width * height + 7) // 8:
+            raise ValueError("Invalid coverage index")
+        return cls(zoom, col_min, row_min, width, height, bits, bool(unbounded))
+
+    def save(self, path: str) -> None:
+        """ Write the index, the file is replaced atomically
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.to_bytes())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> 'CoverageIndex':
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def build_coverage_index(project: QgsProject, layers: List[QgsVectorLayer], tms: TileMatrixSet,
+                         zoom: int) -> Optional[CoverageIndex]:
+    """ Build the coverage index of the layers at zoom level
+
+        Return None if the index exceeds `QGIS_TILES_COVERAGE_MAX_TILES`
+    """
+    context = project.transformContext()
+    unbounded = False
+    extent = None
+    for layer in layers:
+        try:
+            xform = QgsCoordinateTransform(layer.crs(), tms.crs, context)
+            layer_extent = xform.transformBoundingBox(layer.extent())
+        except QgsCsException:
+            unbounded = True
+            continue
+        if extent is None:
+            extent = QgsRectangle(layer_extent)
+        else:
+            extent.combineExtentWith(layer_extent)
+
+    tile_range = tms.tile_range(zoom, extent) if extent is not None else None
+    if tile_range is None:
+        index = CoverageIndex(zoom, 0, 0, 0, 0, unbounded=unbounded)
+    else:
+        col_min, row_min, col_max, row_max = tile_range
+        width, height = col_max - col_min + 1, row_max - row_min + 1
+        max_tiles = getenv_int('QGIS_TILES_COVERAGE_MAX_TILES', 1 << 26)
+        if width * height > max_tiles:
+            QgsMessageLog.logMessage(f"Coverage index of {width}x{height} tiles exceeds {max_tiles} tiles",
+                                     "tilesApi", Qgis.Warning)
+            return None
+        index = CoverageIndex(zoom, col_min, row_min, width, height, unbounded=unbounded)
+
+    buffer = tms.tile_dimension / (1 << zoom) * TILE_BUFFER
+    for layer in layers:
+        request = QgsFeatureRequest().setNoAttributes().setDestinationCrs(tms.crs, context)
+        for feature in layer.getFeatures(request):
+            geometry = feature.geometry()
+            if geometry.isNull():
+                continue
+            bbox = geometry.boundingBox()
+            bbox.grow(buffer)
+            feature_range = tms.tile_range(zoom, bbox)
+            if feature_range is not None:
+                index.add(*feature_range)
+    return index
+
+
+def coverage_path(project: QgsProject, tilemapid: str, tms: TileMatrixSet, zoom: int) -> str:
+    """ Return the path of the coverage index of the tile map
+    """
+    name = tile_key(project.fileName(), project_fingerprint(project), tilemapid, tms.identifier, zoom).hex()
+    root = getenv('QGIS_TILES_COVERAGE_PATH', os.path.join(tempfile.gettempdir(), 'qgis-tiles-coverage'))
+    return os.path.join(root, f"{name}.cov")
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+@contextmanager
+def _index_lock(path: str) -> Iterator[None]:
+    """ Hold the exclusive lock of the index
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+_indexes = OrderedDict()
+_cache_size = 32
+
+
+def coverage_index(project: QgsProject, tilemapid: str, tms: TileMatrixSet, zoom: int) -> Optional[CoverageIndex]:
+    """ Return the coverage index of the tile map, None if it
+        is not built
+
+        Loaded indexes are cached per process and loaded
+        again when the file changes.
+    """
+    path = coverage_path(project, tilemapid, tms, zoom)
+    mtime = _mtime(path)
+    cached = _indexes.get(path)
+    if cached is not None and cached[0] == mtime:
+        _indexes.move_to_end(path)
+        return cached[1]
+
+    index = None
+    if mtime is not None:
+        try:
+            index = CoverageIndex.load(path)
+        except (OSError, ValueError, struct.error) as err:
+            QgsMessageLog.logMessage(f"Failed to load coverage index {path}: {err}", "tilesApi", Qgis.Warning)
+
+    _indexes[path] = (mtime, index)
+    if len(_indexes) > _cache_size:
+        _indexes.popitem(last=False)
+    return index
+
+
+def update_coverage_index(project: QgsProject, tilemapid: str, tms: TileMatrixSet, zoom: int,
+                          layers: List[QgsVectorLayer], force: bool = False) -> Optional[CoverageIndex]:
+    """ Build and save the coverage index of the tile map
+
+        Concurrent builds wait for the first one, existing indexes
+        are built again only if `force` is set.
+    """
+    path = coverage_path(project, tilemapid, tms, zoom)
+    with _index_lock(path):
+        if not force and _mtime(path) is not None:
+            try:
+                return CoverageIndex.load(path)
+            except (OSError, ValueError, struct.error):
+                pass
+        start = time.perf_counter()
+        index = build_coverage_index(project, layers, tms, zoom)
+        if index is None:
+            return None
+        index.save(path)
+    QgsMessageLog.logMessage(
+        f"Built coverage index of '{tilemapid}' for {tms.identifier} at zoom {zoom} "
+        f"in {time.perf_counter() - start:.3f}s", "tilesApi", Qgis.Info)
+    return index
+
+
+def mark_coverage(project: QgsProject, tilemapid: str, tms: TileMatrixSet, zoom: int,
+                  extent: QgsRectangle) -> None:
+    """ Mark the tiles of a changed region as covered in the saved index
+    """
+    tile_range = tms.tile_range(zoom, extent)
+    if tile_range is None:
+        return
+    path = coverage_path(project, tilemapid, tms, zoom)
+    if _mtime(path) is None:
+        return
+    with _index_lock(path):
+        try:
+            index = CoverageIndex.load(path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, struct.error):
+            # Tiles are covered until the index is built again
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return
+        index.add(*tile_range)
+        index.save(path)
@@ -0,0 +1,134 @@
+""" Raster tile encoders
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import threading
+
+from typing import NamedTuple, Tuple
+
+from qgis.PyQt.QtCore import QBuffer, QByteArray, QIODevice, Qt
+from qgis.PyQt.QtGui import QImage, QImageWriter
+
+from tilesForServer.config import TileMapOptions
+
+PNG = 'image/png'
+JPEG = 'image/jpeg'
+WEBP = 'image/webp'
+
+# Raster extensions that may be enabled for tile maps
+# in addition to the WMTS formats
+EXTRA_FORMATS = ('png8', 'webp', 'mixed')
+
+
+def webp_supported() -> bool:
+    """ Check that Qt has the WebP image plugin
+    """
+    return b'webp' in QImageWriter.supportedImageFormats()
+
+
+def sniff_mimetype(data: bytes) -> str:
+    """ Return the mimetype of encoded image data
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return PNG
+    if data[:2] == b'\xff\xd8':
+        return JPEG
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return WEBP
+    return ''
+
+
+class EncodingOptions(NamedTuple):
+    jpeg_quality: int
+    webp_quality: int
+
+    @classmethod
+    def from_tilemap(cls, options: TileMapOptions, default_jpeg_quality: int = -1) -> 'EncodingOptions':
+        """ Read the encoding options of the tile map
+
+            * `jpegQuality`: JPEG quality (0-100)
+            * `webpQuality`: WebP quality (0-100)
+            * `webpLossless`: Use lossless WebP
+        """
+        webp_quality = options.get_int('webpQuality', 80)
+        if options.get_bool('webpLossless'):
+            # The Qt WebP plugin encodes lossless with quality 100
+            webp_quality = 100
+        return cls(
+            jpeg_quality=options.get_int('jpegQuality', default_jpeg_quality),
+            webp_quality=webp_quality,
+        )
+
+
+class ImageEncoder:
+    """ Encode images into a reusable buffer
+    """
+
+    def __init__(self) -> None:
+        self._data = QByteArray()
+        self._buffer = QBuffer(self._data)
+
+    def encode(self, image: QImage, fmt: str, quality: int = -1) -> bytes:
+        """ Encode image in the given Qt image format
+        """
+        self._data.clear()
+        self._buffer.open(QIODevice.WriteOnly)
+        try:
+            if not image.save(self._buffer, fmt, quality):
+                raise ValueError(f"Failed to encode image as {fmt}")
+        finally:
+            self._buffer.close()
+        return self._data.data()
+
+
+_local = threading.local()
+
+
+def encode_image(image: QImage, fmt: str, quality: int = -1) -> bytes:
+    """ Encode image with the encoder of the current thread
+    """
+    encoder = getattr(_local, 'encoder', None)
+    if encoder is None:
+        encoder = _local.encoder = ImageEncoder()
+    return encoder.encode(image, fmt, quality)
+
+
+def is_opaque(image: QImage) -> bool:
+    """ Check that all pixels of the image are opaque
+    """
+    if not image.hasAlphaChannel():
+        return True
+    alpha = image.convertToFormat(QImage.Format_Alpha8)
+    bits = alpha.constBits()
+    bits.setsize(alpha.sizeInBytes())
+    return min(memoryview(bits)) == 255
+
+
+def quantize(image: QImage) -> QImage:
+    """ Convert image to a 256 colors palette
+
+        Transparency is binary in the palette
+    """
+    if image.format() == QImage.Format_ARGB32_Premultiplied:
+        image = image.convertToFormat(QImage.Format_ARGB32)
+    return image.convertToFormat(QImage.Format_Indexed8, Qt.DiffuseDither | Qt.ThresholdAlphaDither)
+
+
+def encode_tile(image: QImage, extension: str, options: EncodingOptions) -> Tuple[bytes, str]:
+    """ Encode the tile image for the extension
+
+        Return the encoded data and its mimetype
+    """
+    if extension in ('jpg', 'jpeg'):
+        return encode_image(image, 'JPG', options.jpeg_quality), JPEG
+    if extension == 'png8':
+        return encode_image(quantize(image), 'PNG'), PNG
+    if extension == 'webp':
+        return encode_image(image, 'WEBP', options.webp_quality), WEBP
+    if extension == 'mixed':
+        # JPEG for opaque tiles, PNG for tiles with transparency
+        if is_opaque(image):
+            return encode_image(image, 'JPG', options.jpeg_quality), JPEG
+        return encode_image(image, 'PNG'), PNG
+    return encode_image(image, 'PNG'), PNG
@@ -0,0 +1,241 @@
+""" Export a tile map pyramid for static hosting
+
+    Tiles of a tile map are rendered in process by QGIS server instances,
+    one per worker process, and written to a `{z}/{x}/{y}.{ext}` directory,
+    a tar archive or a PMTiles archive:
+
+        python -m tilesForServer.export project.qgs france_parts tiles.pmtiles --maxzoom 8
+
+    Identical tiles, like empty sea tiles, are stored once: as hard links
+    in directories and tar archives, as shared tile data in PMTiles archives.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from tilesForServer.pmtiles import PMTilesWriter, zxy_to_tileid
+from tilesForServer.replay import handle_request, init_worker
+
+
+class DirectoryWriter:
+    """ Write tiles to a `{z}/{x}/{y}.{ext}` directory
+    """
+
+    def __init__(self, path: str, extension: str) -> None:
+        self._path = path
+        self._extension = extension
+        self._contents: Dict[bytes, str] = {}
+
+    def write(self, z: int, x: int, y: int, data: bytes) -> bool:
+        """ Write a tile, return False if the tile is a duplicate
+        """
+        path = os.path.join(self._path, str(z), str(x), f"{y}.{self._extension}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        first = self._contents.get(digest)
+        if first is not None:
+            try:
+                if os.path.exists(path):
+                    os.unlink(path)
+                os.link(first, path)
+                return False
+            except OSError:
+                pass
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._contents.setdefault(digest, path)
+        return True
+
+    def close(self, bounds: Optional[Tuple[float, float, float, float]] = None) -> None:
+        pass
+
+
+class TarWriter:
+    """ Write tiles to a tar archive of `{z}/{x}/{y}.{ext}` members
+    """
+
+    def __init__(self, path: str, extension: str) -> None:
+        self._extension = extension
+        self._tar = tarfile.open(path, 'w')
+        self._contents: Dict[bytes, str] = {}
+        self._mtime = time.time()
+
+    def write(self, z: int, x: int, y: int, data: bytes) -> bool:
+        """ Write a tile, return False if the tile is a duplicate
+        """
+        info = tarfile.TarInfo(f"{z}/{x}/{y}.{self._extension}")
+        info.mtime = self._mtime
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        first = self._contents.get(digest)
+        if first is not None:
+            info.type = tarfile.LNKTYPE
+            info.linkname = first
+            self._tar.addfile(info)
+            return False
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        self._contents[digest] = info.name
+        return True
+
+    def close(self, bounds: Optional[Tuple[float, float, float, float]] = None) -> None:
+        self._tar.close()
+
+
+def create_writer(path: str, extension: str, metadata: Dict):
+    """ Return the writer for the output path
+    """
+    if path.endswith('.pmtiles'):
+        return PMTilesWriter(path, extension, metadata)
+    if path.endswith('.tar'):
+        return TarWriter(path, extension)
+    return DirectoryWriter(path, extension)
+
+
+def tilemap_url(project: str, tilemap: str, tms: Optional[str]) -> str:
+    """ Return the url of the tile map information
+    """
+    tilemapid = f"{tilemap}@{tms}" if tms else tilemap
+    return f"/tms/{quote(tilemapid)}?MAP={quote(project)}"
+
+
+def _list_tiles(project: str, tilemap: str, tms_id: Optional[str], extension: str, minzoom: int,
+                maxzoom: int, bbox: Optional[List[float]]) -> Dict:
+    """ Return the tile map information and the tiles to export
+    """
+    from qgis.core import (
+        QgsCoordinateReferenceSystem,
+        QgsCoordinateTransform,
+        QgsProject,
+        QgsRectangle,
+    )
+
+    from tilesForServer.tilematrix import project_tile_matrix_sets
+
+    response = handle_request(tilemap_url(project, tilemap, tms_id))
+    if response.statusCode() != 200:
+        raise ValueError(f"Tile map '{tilemap}' not found")
+    info = json.loads(bytes(response.body()))
+
+    formats = {fmt['extension']: fmt for fmt in info['formats']}
+    if extension not in formats:
+        raise ValueError(f"Format '{extension}' not available for tile map '{tilemap}'")
+
+    qgs_project = QgsProject()
+    qgs_project.read(project)
+    tms = project_tile_matrix_sets(qgs_project)[info['crs']]
+
+    # Vector tiles above maxzoom are overzoomed by the clients
+    maxzoom = min(maxzoom, formats[extension].get('maxzoom', tms.last_level), tms.last_level)
+    bbox = bbox or info['bbox']
+    if not bbox:
+        raise ValueError(f"No extent for tile map '{tilemap}'")
+    extent = QgsRectangle(*bbox)
+
+    tiles = []
+    for zoom in range(max(0, minzoom), maxzoom + 1):
+        tile_range = tms.tile_range(zoom, extent)
+        if tile_range is None:
+            continue
+        col_min, row_min, col_max, row_max = tile_range
+        tiles.extend((zoom, col, row) for col in range(col_min, col_max + 1) for row in range(row_min, row_max + 1))
+
+    wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+    bounds = QgsCoordinateTransform(tms.crs, wgs84, qgs_project.transformContext()).transformBoundingBox(extent)
+    return {
+        'tms': tms.identifier,
+        'tiles': tiles,
+        'bounds': (bounds.xMinimum(), bounds.yMinimum(), bounds.xMaximum(), bounds.yMaximum()),
+    }
+
+
+def _export_tile(url: str) -> Tuple[int, bytes]:
+    """ Render a tile, return the status and the tile data
+    """
+    response = handle_request(url)
+    return response.statusCode(), bytes(response.body())
+
+
+def export(project: str, tilemap: str, output: str, extension: str, minzoom: int = 0, maxzoom: int = 8,
+           tms: Optional[str] = None, bbox: Optional[List[float]] = None, processes: int = 1) -> Dict:
+    """ Export the tiles of the tile map, return the statistics
+    """
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        listing = pool.apply(_list_tiles, (project, tilemap, tms, extension, minzoom, maxzoom, bbox))
+        tiles = listing['tiles']
+        if output.endswith('.pmtiles'):
+            if listing['tms'] != 'EPSG:3857':
+                raise ValueError("PMTiles archives require the EPSG:3857 tile matrix set")
+            tiles.sort(key=lambda t: zxy_to_tileid(*t))
+
+        tilemapid = quote(f"{tilemap}@{listing['tms']}")
+        map_param = quote(project)
+        urls = [f"/tms/{tilemapid}/{z}/{x}/{y}.{extension}?MAP={map_param}" for z, x, y in tiles]
+
+        writer = create_writer(output, extension, {'name': tilemap, 'format': extension})
+        stats = {'tiles': len(tiles), 'written': 0, 'duplicates': 0, 'empty': 0, 'errors': 0}
+        chunksize = min(64, max(1, len(urls) // (processes * 4)))
+        # Results are written sequentially in the order of the tiles
+        for (z, x, y), (status, data) in zip(tiles, pool.imap(_export_tile, urls, chunksize=chunksize)):
+            if status != 200:
+                stats['errors'] += 1
+                continue
+            if not data:
+                stats['empty'] += 1
+            if writer.write(z, x, y, data):
+                stats['written'] += 1
+            else:
+                stats['duplicates'] += 1
+        writer.close(listing['bounds'])
+
+    stats['elapsed'] = round(time.perf_counter() - start, 3)
+    return stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export the tiles of a tile map")
+    parser.add_argument('project', help="QGIS project path")
+    parser.add_argument('tilemap', help="tile map id")
+    parser.add_argument('output', help="output directory, .tar or .pmtiles archive")
+    parser.add_argument('-f', '--format', default='png', help="tile format extension")
+    parser.add_argument('--minzoom', type=int, default=0, help="minimum zoom level")
+    parser.add_argument('--maxzoom', type=int, default=8, help="maximum zoom level")
+    parser.add_argument('--tms', help="tile matrix set, defaults to the default tile matrix set")
+    parser.add_argument('--bbox', help="exported region as xmin,ymin,xmax,ymax in the tile matrix set crs")
+    parser.add_argument('-p', '--processes', type=int, default=1, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    bbox = None
+    if args.bbox:
+        try:
+            bbox = [float(v) for v in args.bbox.split(',')]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            print("Invalid bbox", file=sys.stderr)
+            return 1
+
+    try:
+        stats = export(os.path.abspath(args.project), args.tilemap, args.output, args.format,
+                       args.minzoom, args.maxzoom, args.tms, bbox, max(1, args.processes))
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
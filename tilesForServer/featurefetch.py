@@ -0,0 +1,178 @@
+""" Concurrent feature fetching for vector tiles
+
+    Features of the layers of a vector tile are fetched by a pool of
+    threads from thread safe snapshots of the layers, then copied to
+    memory layers encoded by the vector tile writer: the latency of
+    a tile is the latency of its slowest layer instead of the sum of
+    the latencies of its layers.
+
+    Provider connections of the fetching threads are pooled by the
+    QGIS providers connection pools.
+
+    Memory layers also restrict the attributes written to the vector
+    tiles to the attributes authorized by the access controls.
+
+    Memory layers number their features: the ids of the features of the
+    vector tiles are not the ids of the source features, which are kept
+    in the `fid` attribute unless the layer already has a `fid` field.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFeedback,
+    QgsField,
+    QgsFields,
+    QgsMemoryProviderUtils,
+    QgsProject,
+    QgsRectangle,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from tilesForServer.config import getenv_int
+
+# Attribute holding the ids of the source features
+FID_FIELD = 'fid'
+
+
+def _fetch(source: QgsVectorLayerFeatureSource, request: QgsFeatureRequest,
+           feedback: Optional[QgsFeedback]) -> List[QgsFeature]:
+    if feedback is None:
+        return list(source.getFeatures(request))
+    features = []
+    for feature in source.getFeatures(request):
+        if feedback.isCanceled():
+            break
+        features.append(feature)
+    return features
+
+
+# Layer, filter expression and authorized attributes, all if None
+FetchedLayer = Tuple[QgsVectorLayer, Optional[str], Optional[List[str]]]
+
+
+def _feature_request(project: QgsProject, layer: QgsVectorLayer, expression: Optional[str],
+                     extent: QgsRectangle, crs: QgsCoordinateReferenceSystem) -> QgsFeatureRequest:
+    request = QgsFeatureRequest()
+    try:
+        xform = QgsCoordinateTransform(crs, layer.crs(), project.transformContext())
+        request.setFilterRect(xform.transformBoundingBox(extent))
+    except QgsCsException:
+        # Fetch all the features, the writer clips them
+        pass
+    if expression:
+        request.setFilterExpression(expression)
+        request.setExpressionContext(
+            QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer)))
+    return request
+
+
+def _memory_layer(layer: QgsVectorLayer, features: List[QgsFeature],
+                  attributes: Optional[List[str]]) -> QgsVectorLayer:
+    """ Return a memory layer holding the features with
+        the attributes of the layer and their source ids
+    """
+    fields = layer.fields()
+    if attributes is None:
+        indexes = list(range(fields.count()))
+    else:
+        indexes = [fields.indexFromName(name) for name in attributes]
+    subset = QgsFields()
+    for index in indexes:
+        subset.append(fields.at(index))
+    with_fid = fields.indexFromName(FID_FIELD) < 0
+    if with_fid:
+        subset.append(QgsField(FID_FIELD, QVariant.LongLong))
+
+    copies = []
+    for feature in features:
+        copy = QgsFeature(subset)
+        copy.setGeometry(feature.geometry())
+        values = [feature.attribute(index) for index in indexes]
+        if with_fid:
+            values.append(feature.id())
+        copy.setAttributes(values)
+        copies.append(copy)
+
+    memory_layer = QgsMemoryProviderUtils.createMemoryLayer(layer.name(), subset, layer.wkbType(), layer.crs())
+    memory_layer.dataProvider().addFeatures(copies)
+    return memory_layer
+
+
+def copy_layer(project: QgsProject, layer: QgsVectorLayer, expression: Optional[str],
+               attributes: Optional[List[str]], extent: QgsRectangle, crs: QgsCoordinateReferenceSystem,
+               feedback: Optional[QgsFeedback] = None) -> QgsVectorLayer:
+    """ Return a memory layer holding the features of the layer in extent
+        with the attributes, fetched by the calling thread
+    """
+    request = _feature_request(project, layer, expression, extent, crs)
+    features = _fetch(QgsVectorLayerFeatureSource(layer), request, feedback)
+    return _memory_layer(layer, features, attributes)
+
+
+class FeatureFetcher:
+    """ Fetch the features of vector layers concurrently
+    """
+
+    def __init__(self, threads: int) -> None:
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='tiles-fetch')
+
+    @classmethod
+    def from_env(cls) -> Optional['FeatureFetcher']:
+        """ Create the feature fetcher from the environment
+
+            * `QGIS_TILES_FETCH_THREADS`: number of fetching threads of the
+              tile maps with the `concurrentFetch` option, features are
+              fetched by the vector tile writer if not set
+        """
+        threads = getenv_int('QGIS_TILES_FETCH_THREADS')
+        if threads <= 0:
+            return None
+        return cls(threads)
+
+    def fetch_layers(self, project: QgsProject, layers: List[FetchedLayer], extent: QgsRectangle,
+                     crs: QgsCoordinateReferenceSystem,
+                     feedback: Optional[QgsFeedback] = None) -> List[QgsVectorLayer]:
+        """ Return memory layers holding the features of the layers in extent
+
+            Layers are given with their filter expression and their
+            authorized attributes. Snapshots of the layers are taken by
+            the calling thread, so subset strings set on the layers apply.
+            Fetching stops when the feedback is canceled.
+        """
+        futures = []
+        for layer, expression, _ in layers:
+            request = _feature_request(project, layer, expression, extent, crs)
+            source = QgsVectorLayerFeatureSource(layer)
+            futures.append(self._executor.submit(_fetch, source, request, feedback))
+
+        return [
+            _memory_layer(layer, future.result(), attributes)
+            for (layer, _, attributes), future in zip(layers, futures)
+        ]
+
+
+_feature_fetcher: Optional[FeatureFetcher] = None
+_initialized = False
+
+
+def feature_fetcher() -> Optional[FeatureFetcher]:
+    """ Return the feature fetcher or None if concurrent fetching is disabled
+    """
+    global _feature_fetcher, _initialized
+    if not _initialized:
+        _feature_fetcher = FeatureFetcher.from_env()
+        _initialized = True
+    return _feature_fetcher
@@ -0,0 +1,103 @@
+""" Project fingerprint
+
+    The fingerprint identifies the version of a loaded project: it is
+    part of the tile cache keys and entity tags, so tiles of a previous
+    version of the project are never served.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import hashlib
+import os
+
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from qgis.core import QgsProject
+
+_fingerprints = OrderedDict()
+_cache_size = 64
+
+# Current and previous fingerprints of the project paths
+_latest: Dict[str, str] = {}
+_previous: Dict[str, str] = {}
+
+# Read size for hashing project files
+CHUNK_SIZE = 1024 * 1024
+
+# Dynamic property holding the fingerprint of a loaded project
+FINGERPRINT_PROPERTY = 'tilesForServerFingerprint'
+
+
+def file_digest(path: str) -> str:
+    """ Return the hex digest of the file content
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _file_fingerprint(project: QgsProject) -> str:
+    """ Return the fingerprint of the project file as it is on disk
+    """
+    path = project.fileName()
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is not None:
+        key = (path, st.st_mtime_ns, st.st_size)
+    else:
+        key = (path, project.lastModified().toMSecsSinceEpoch())
+
+    fingerprint = _fingerprints.get(key)
+    if fingerprint is None:
+        if st is not None:
+            fingerprint = file_digest(path)
+        else:
+            fingerprint = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        _fingerprints[key] = fingerprint
+        if len(_fingerprints) > _cache_size:
+            _fingerprints.popitem(last=False)
+    else:
+        _fingerprints.move_to_end(key)
+    return fingerprint
+
+
+def project_fingerprint(project: QgsProject) -> str:
+    """ Return the fingerprint of the project
+
+        The fingerprint is the digest of the project file content,
+        so nodes sharing a deployed project compute the same
+        fingerprint. It is computed when the loaded project is first
+        seen and kept with the project: a project file updated while
+        the previous version is still served from the server project
+        cache does not change the fingerprint, loading the updated
+        project does.
+
+        Projects from a project storage use their last
+        modification time.
+    """
+    fingerprint = project.property(FINGERPRINT_PROPERTY)
+    if fingerprint:
+        return fingerprint
+
+    fingerprint = _file_fingerprint(project)
+    project.setProperty(FINGERPRINT_PROPERTY, fingerprint)
+    path = project.fileName()
+    latest = _latest.get(path)
+    if latest is not None and latest != fingerprint:
+        _previous[path] = latest
+    _latest[path] = fingerprint
+    return fingerprint
+
+
+def previous_fingerprint(project: QgsProject) -> Optional[str]:
+    """ Return the fingerprint of the version of the project seen
+        by the process before the current version
+    """
+    fingerprint = project_fingerprint(project)
+    previous = _previous.get(project.fileName())
+    return previous if previous != fingerprint else None
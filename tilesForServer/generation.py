@@ -0,0 +1,98 @@
+""" Generations of the restricted tile cache partitions
+
+    Restricted partitions of a tile map cannot be enumerated: they
+    depend on the access controls of the users. The generation of a
+    tile map is part of the cache keys of its restricted partitions,
+    bumping it invalidates the tiles of all of them at once.
+
+    Generations are stored in small files shared by the server
+    processes of a host, or by the nodes of a cluster on a shared
+    volume. The modification time of the file is the time of the
+    last invalidation of the tile map.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import fcntl
+import os
+import tempfile
+
+from typing import Dict, Tuple
+
+from qgis.core import QgsProject
+
+from tilesForServer.cache import tile_key
+from tilesForServer.config import getenv
+
+# Generations read by the process, by file status
+_generations: Dict[str, Tuple[Tuple[int, int, int], int]] = {}
+
+
+def generation_path() -> str:
+    """ Return the directory of the generation files
+
+        Set with `QGIS_TILES_GENERATION_PATH`
+    """
+    return getenv('QGIS_TILES_GENERATION_PATH', os.path.join(tempfile.gettempdir(), 'qgis-tiles-generations'))
+
+
+def _generation_file(project: QgsProject, tilemapid: str) -> str:
+    return os.path.join(generation_path(), f"{tile_key(project.fileName(), tilemapid).hex()}.gen")
+
+
+def _read(fd: int) -> int:
+    value = os.pread(fd, 32, 0).strip()
+    return int(value) if value.isdigit() else 0
+
+
+def tilemap_generation(project: QgsProject, tilemapid: str) -> int:
+    """ Return the generation of the restricted partitions of the tile map
+
+        The file is read again only when its status changes.
+    """
+    path = _generation_file(project, tilemapid)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return 0
+    status = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _generations.get(path)
+    if cached is not None and cached[0] == status:
+        return cached[1]
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    try:
+        generation = _read(fd)
+    finally:
+        os.close(fd)
+    _generations[path] = (status, generation)
+    return generation
+
+
+def invalidation_time(project: QgsProject, tilemapid: str) -> float:
+    """ Return the time of the last invalidation of the tile map,
+        0 if the tile map was never invalidated
+    """
+    try:
+        return os.stat(_generation_file(project, tilemapid)).st_mtime
+    except FileNotFoundError:
+        return 0.
+
+
+def bump_generation(project: QgsProject, tilemapid: str) -> int:
+    """ Invalidate the restricted partitions of the tile map,
+        return the new generation
+    """
+    os.makedirs(generation_path(), exist_ok=True)
+    fd = os.open(_generation_file(project, tilemapid), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        generation = _read(fd) + 1
+        data = str(generation).encode()
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+    return generation
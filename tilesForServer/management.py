@@ -0,0 +1,253 @@
+""" Tile cache management
+
+    Invalidate the tiles of a changed data region in every tile store
+    and in the cache manager, and optionally seed them again. Build
+    the coverage indexes of the vector tile maps.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsRectangle,
+    QgsTileXYZ,
+)
+
+from tilesForServer.accesscontrol import PUBLIC
+from tilesForServer.admission import admission
+from tilesForServer.apiutils import HTTPError
+from tilesForServer.cache import tile_stores
+from tilesForServer.config import getenv_int
+from tilesForServer.coverage import mark_coverage, update_coverage_index
+from tilesForServer.fingerprint import previous_fingerprint
+from tilesForServer.generation import bump_generation
+from tilesForServer.prefetch import prefetcher
+from tilesForServer.seeding import seeder
+from tilesForServer.tilecontent import TileContentHandler
+from tilesForServer.tilematrix import TileMatrixSet
+from tilesForServer.writeback import writeback
+
+
+class CacheManagementHandler(TileContentHandler):
+    """ Tile cache management handler
+
+        * `GET` returns the tile stores statistics
+        * `POST` invalidates the tiles of a region:
+          * `TILEMAP`: the tile map id, or `LAYER`: a layer id
+            for all the tile maps containing the layer
+          * `BBOX`: the region as `xmin,ymin,xmax,ymax`, defaults to
+            the layer or tile map extent
+          * `CRS`: the crs of the bbox, defaults to the tile matrix set crs
+          * `MINZOOM`, `MAXZOOM`: the zoom range, defaults to all levels
+          * `TILEMATRIXSET`: the tile matrix set, defaults to all
+          * `SEED`: seed the invalidated tiles in the background
+          * `COVERAGE`: build the coverage indexes of the tile maps
+            instead of invalidating tiles
+    """
+
+    def get(self) -> None:
+        writer = writeback()
+        prefetch = prefetcher()
+        self.write({
+            'stores': [{'name': store.name, **store.stats()} for store in tile_stores()],
+            'seeding': seeder().stats(),
+            'writeback': writer.stats() if writer else None,
+            'prefetch': prefetch.stats() if prefetch else None,
+            'admission': admission().stats(),
+        })
+
+    def post(self) -> None:
+        tilemapids = self.invalidation_tilemaps()
+
+        grids = self.tile_matrix_sets()
+        tms_id = self.get_argument('TILEMATRIXSET')
+        if tms_id:
+            if tms_id not in grids:
+                raise HTTPError(400, reason=f"Unknown tile matrix set '{tms_id}'")
+            grids = {tms_id: grids[tms_id]}
+
+        if self.get_argument('COVERAGE', '').lower() in ('1', 'yes', 'true', 'on'):
+            self.write({
+                'tileMaps': tilemapids,
+                'coverageIndexes': self.build_coverage(tilemapids, grids),
+            })
+            return
+
+        try:
+            minzoom = int(self.get_argument('MINZOOM', 0))
+            maxzoom = int(self.get_argument('MAXZOOM', -1))
+        except ValueError:
+            raise HTTPError(400, reason="Invalid zoom range") from None
+
+        tiles, regions = self.invalidation_tiles(tilemapids, grids, minzoom, maxzoom)
+        self.evict_tiles(tiles)
+
+        # Features may have been added to the region
+        for tilemapid, tms, extent in regions:
+            zoom = self.coverage_zoom(tilemapid)
+            if zoom >= 0:
+                mark_coverage(self.project, tilemapid, tms, zoom, extent)
+
+        seeded = 0
+        if self.get_argument('SEED', '').lower() in ('1', 'yes', 'true', 'on'):
+            seeded = seeder().submit(
+                (self.tile_href(tilemapid, tms, tile, extension) for tilemapid, tms, tile, extension in tiles),
+                self.forwarded_headers(),
+            )
+
+        self.write({
+            'tileMaps': tilemapids,
+            'tiles': len(tiles),
+            'seeded': seeded,
+        })
+
+    def build_coverage(self, tilemapids: List[str], grids: Dict[str, TileMatrixSet]) -> int:
+        """ Build the coverage indexes of the vector tile maps,
+            return the number of indexes built
+        """
+        count = 0
+        for tilemapid in tilemapids:
+            zoom = self.coverage_zoom(tilemapid)
+            if zoom < 0 or 'pbf' not in self.get_tilemap_info(tilemapid)['formats']:
+                continue
+            layers = list(self.tilemap_vectorlayers(tilemapid))
+            for tms in grids.values():
+                try:
+                    index = update_coverage_index(self.project, tilemapid, tms, zoom, layers, force=True)
+                except OSError as err:
+                    raise HTTPError(500, reason=f"Failed to save coverage index: {err}") from None
+                if index is not None:
+                    count += 1
+        return count
+
+    def invalidation_tiles(self, tilemapids: List[str], grids: Dict[str, TileMatrixSet], minzoom: int,
+                           maxzoom: int) -> Tuple[List[Tuple[str, TileMatrixSet, QgsTileXYZ, str]], List[Tuple]]:
+        """ Return the tiles to invalidate and the invalidated regions
+            of the vector tile maps
+        """
+        max_tiles = getenv_int('QGIS_TILES_INVALIDATION_MAX_TILES', 100000)
+
+        # Collect tiles first to check the limit before evicting
+        tiles = []
+        regions = []
+        for tilemapid in tilemapids:
+            info = self.get_tilemap_info(tilemapid)
+            for tms in grids.values():
+                extent = self.invalidation_extent(info, tms)
+                if extent is None:
+                    continue
+                if 'pbf' in info['formats']:
+                    regions.append((tilemapid, tms, extent))
+                for extension in info['formats']:
+                    last = tms.last_level
+                    if extension == 'pbf':
+                        last = self.vector_maxzoom(tilemapid, tms)
+                    if maxzoom >= 0:
+                        last = min(last, maxzoom)
+                    for tile in self.tiles_in_extent(tms, extent, minzoom, last):
+                        tiles.append((tilemapid, tms, tile, extension))
+                        if len(tiles) > max_tiles:
+                            raise HTTPError(400, reason=f"Too many tiles to invalidate (max {max_tiles})")
+
+        return tiles, regions
+
+    def invalidation_tilemaps(self) -> List[str]:
+        """ Return the tile maps to invalidate
+        """
+        tilemapid = self.get_argument('TILEMAP')
+        if tilemapid:
+            if not self.get_tilemap_info(tilemapid):
+                raise HTTPError(404, reason=f"Tile map '{tilemapid}' not found")
+            return [tilemapid]
+
+        layerid = self.get_argument('LAYER')
+        if not layerid:
+            raise HTTPError(400, reason="Missing TILEMAP or LAYER parameter")
+        if not self.project.mapLayer(layerid):
+            raise HTTPError(404, reason=f"Layer '{layerid}' not found")
+
+        tilemapids = []
+        for info in self.tile_maps_info():
+            ids = {layer.id() for layer in self.tilemap_layers(info['id'])}
+            ids.update(layer.id() for layer in self.tilemap_vectorlayers(info['id']))
+            if layerid in ids:
+                tilemapids.append(info['id'])
+        return tilemapids
+
+    def invalidation_extent(self, info: Dict, tms: TileMatrixSet) -> Optional[QgsRectangle]:
+        """ Return the region to invalidate in the tile matrix set crs
+        """
+        project = self.project
+        bbox = self.get_argument('BBOX')
+        if bbox:
+            try:
+                xmin, ymin, xmax, ymax = (float(v) for v in bbox.split(','))
+            except ValueError:
+                raise HTTPError(400, reason="Invalid BBOX parameter") from None
+            extent = QgsRectangle(xmin, ymin, xmax, ymax)
+            crs = QgsCoordinateReferenceSystem(self.get_argument('CRS', tms.identifier))
+            if not crs.isValid():
+                raise HTTPError(400, reason="Invalid CRS parameter")
+            if crs != tms.crs:
+                xform = QgsCoordinateTransform(crs, tms.crs, project.transformContext())
+                extent = xform.transformBoundingBox(extent)
+            return extent
+
+        layerid = self.get_argument('LAYER')
+        if layerid:
+            bbox = self.get_layer_bbox(layerid, tms.crs)
+        else:
+            bbox = self.get_tilemap_bbox(info['source_type'], info['source_id'], tms.crs)
+        if not bbox:
+            return None
+        return QgsRectangle(*bbox)
+
+    @staticmethod
+    def tiles_in_extent(tms: TileMatrixSet, extent: QgsRectangle, minzoom: int,
+                        maxzoom: int) -> Iterator[QgsTileXYZ]:
+        """ Return the tiles intersecting the extent for the zoom range
+        """
+        for zoom in range(max(0, minzoom), maxzoom + 1):
+            tile_range = tms.tile_range(zoom, extent)
+            if tile_range is None:
+                continue
+            col_min, row_min, col_max, row_max = tile_range
+            for col in range(col_min, col_max + 1):
+                for row in range(row_min, row_max + 1):
+                    yield QgsTileXYZ(col, row, zoom)
+
+    def evict_tiles(self, tiles: List[Tuple[str, TileMatrixSet, QgsTileXYZ, str]]) -> None:
+        """ Delete the tiles from the tile stores and the cache manager
+
+            Tiles are evicted from the public partition, with the tiles
+            of the previous version of the project served as stale tiles.
+            Restricted partitions cannot be enumerated: the generation of
+            the tile maps is bumped, which invalidates all their restricted
+            tiles and the stale tiles of the previous version.
+        """
+        project = self.project
+        cache_manager = self.server_interface.cacheManager()
+        previous = previous_fingerprint(project)
+
+        keys = []
+        for tilemapid, tms, tile, extension in tiles:
+            mimetype = self.mimetypeFromExtension(extension)
+            req = self.get_tile_request(tilemapid, tms, tile, extension, mimetype)
+            keys.append(self.tile_cache_key(tilemapid, tms, tile, extension, PUBLIC))
+            if previous is not None:
+                keys.append(self.tile_cache_key(tilemapid, tms, tile, extension, PUBLIC, previous))
+            cache_manager.deleteCachedImage(project, req, None)
+
+        for tilemapid in {tilemapid for tilemapid, _, _, _ in tiles}:
+            bump_generation(project, tilemapid)
+
+        # Pending writes would restore evicted tiles
+        writer = writeback()
+        if writer is not None:
+            writer.discard(keys)
+
+        for store in tile_stores():
+            store.delete_many(keys)
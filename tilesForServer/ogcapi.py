@@ -0,0 +1,283 @@
+""" OGC API - Tiles
+
+    Tiles are rendered by the same pipeline as the
+    Tile Map Service API.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+from typing import Dict, List, Optional
+
+from qgis.core import QgsCoordinateReferenceSystem, QgsRectangle
+from qgis.server import QgsServerProjectUtils
+
+from tilesForServer.apiutils import (
+    HTTPError,
+    RequestHandler,
+    register_api_handlers,
+)
+from tilesForServer.catalog import ProjectParser
+from tilesForServer.tilecontent import TileContentHandler
+from tilesForServer.tilematrix import TileMatrixSet
+
+JSON_TYPE = 'application/json'
+
+
+def crs_uri(crs: QgsCoordinateReferenceSystem) -> str:
+    """ Return the OGC uri of the crs
+    """
+    authority, _, code = crs.authid().partition(':')
+    return f"http://www.opengis.net/def/crs/{authority}/0/{code}"
+
+
+class OgcTilesHandler(RequestHandler, ProjectParser):
+    """ Base class for OGC API Tiles metadata handlers
+    """
+    def get_tilemap_tms(self, tilemapid: str, tilematrixsetid: str) -> TileMatrixSet:
+        """ Return the tile matrix set or raise a 404 error
+        """
+        if not self.get_tilemap_info(tilemapid):
+            raise HTTPError(404, reason=f"Collection '{tilemapid}' not found")
+        tms = self.tile_matrix_sets().get(tilematrixsetid)
+        if not tms:
+            raise HTTPError(404, reason=f"Tile matrix set '{tilematrixsetid}' not found")
+        return tms
+
+    def tileset_links(self, info: Dict, tms: TileMatrixSet) -> List[Dict]:
+        """ Return the tileset links
+        """
+        tilemapid = info['id']
+        base, _, query = self.api_href(f"/collections/{tilemapid}/tiles/{tms.identifier}").partition('?')
+        query = f"{query}&" if query else ""
+        links = [{
+            'href': self.api_href(f"/collections/{tilemapid}/tiles/{tms.identifier}"),
+            'rel': 'self',
+            'type': JSON_TYPE,
+            'title': f"{info['title']} tileset in {tms.identifier}",
+        }, {
+            'href': self.api_href(f"/tileMatrixSets/{tms.identifier}"),
+            'rel': 'http://www.opengis.net/def/rel/ogc/1.0/tiling-scheme',
+            'type': JSON_TYPE,
+            'title': f"{tms.identifier} tile matrix set definition",
+        }]
+        for ext in info['formats']:
+            links.append({
+                'href': f"{base}/{{tileMatrix}}/{{tileRow}}/{{tileCol}}?{query}f={ext}",
+                'rel': 'item',
+                'type': self.mimetypeFromExtension(ext),
+                'templated': True,
+                'title': f"{info['title']} tiles as {ext}",
+            })
+        return links
+
+    def tile_matrix_set_limits(self, info: Dict, tms: TileMatrixSet) -> List[Dict]:
+        """ Return the tile matrix limits from the tile map extent
+        """
+        bbox = self.get_tilemap_bbox(info['source_type'], info['source_id'], tms.crs)
+        if not bbox:
+            return []
+        rect = QgsRectangle(*bbox)
+        limits = []
+        for zoom in range(tms.last_level + 1):
+            size = tms.tile_dimension / (1 << zoom)
+            width, height = tms.matrix_size(zoom)
+            limits.append({
+                'tileMatrix': str(zoom),
+                'minTileCol': max(0, int((rect.xMinimum() - tms.left) // size)),
+                'maxTileCol': min(width - 1, int((rect.xMaximum() - tms.left) // size)),
+                'minTileRow': max(0, int((tms.top - rect.yMaximum()) // size)),
+                'maxTileRow': min(height - 1, int((tms.top - rect.yMinimum()) // size)),
+            })
+        return limits
+
+    def tileset(self, info: Dict, tms: TileMatrixSet, limits: bool = False) -> Dict:
+        """ Return the tileset description
+        """
+        data = {
+            'title': info['title'],
+            'dataType': 'vector' if info['formats'] == ['pbf'] else 'map',
+            'crs': crs_uri(tms.crs),
+            'tileMatrixSetId': tms.identifier,
+            'links': self.tileset_links(info, tms),
+        }
+        if limits:
+            data['tileMatrixSetLimits'] = self.tile_matrix_set_limits(info, tms)
+        if 'pbf' in info['formats']:
+            # Clients should overzoom vector tiles above maxzoom
+            maxzoom = self.vector_maxzoom(info['id'], tms)
+            if maxzoom < tms.last_level:
+                data['vectorMaxZoom'] = maxzoom
+        return data
+
+
+class LandingPage(OgcTilesHandler):
+    """ OGC API Tiles landing page
+    """
+    def get(self) -> None:
+        if self.check_document_etag():
+            return
+
+        project = self.project
+
+        data = {
+            'title': QgsServerProjectUtils.owsServiceTitle(project),
+            'description': QgsServerProjectUtils.owsServiceAbstract(project),
+            'links': [{
+                'href': self.api_href("/tileMatrixSets"),
+                'rel': 'http://www.opengis.net/def/rel/ogc/1.0/tiling-schemes',
+                'type': JSON_TYPE,
+                'title': "Tile matrix sets",
+            }],
+            'tilesets': [],
+        }
+        if self.tile_matrix_sets():
+            for info in self.tile_maps_info():
+                data['links'].append({
+                    'href': self.api_href(f"/collections/{info['id']}/tiles"),
+                    'rel': 'http://www.opengis.net/def/rel/ogc/1.0/tilesets-map',
+                    'type': JSON_TYPE,
+                    'title': info['title'],
+                })
+                data['tilesets'].extend(self.tileset(info, tms) for tms in self.tile_matrix_sets().values())
+        self.write(data)
+
+
+class TileMatrixSets(OgcTilesHandler):
+    """ Tile matrix sets listing
+    """
+    def get(self) -> None:
+        if self.check_document_etag():
+            return
+
+        self.write({
+            'tileMatrixSets': [{
+                'id': tms.identifier,
+                'title': tms.identifier,
+                'links': [{
+                    'href': self.api_href(f"/tileMatrixSets/{tms.identifier}"),
+                    'rel': 'http://www.opengis.net/def/rel/ogc/1.0/tiling-scheme',
+                    'type': JSON_TYPE,
+                    'title': f"{tms.identifier} tile matrix set definition",
+                }],
+            } for tms in self.tile_matrix_sets().values()],
+        })
+
+
+class TileMatrixSetInfo(OgcTilesHandler):
+    """ Tile matrix set definition
+    """
+    def get(self, tilematrixsetid) -> None:
+        if self.check_document_etag():
+            return
+
+        tms = self.tile_matrix_sets().get(tilematrixsetid)
+        if not tms:
+            raise HTTPError(404, reason=f"Tile matrix set '{tilematrixsetid}' not found")
+        self.write({
+            'id': tms.identifier,
+            'title': tms.identifier,
+            'crs': crs_uri(tms.crs),
+            'tileMatrices': tms.tile_matrices(),
+        })
+
+
+class TileSets(OgcTilesHandler):
+    """ Collection tilesets listing
+    """
+    def get(self, tilemapid) -> None:
+        if self.check_document_etag():
+            return
+
+        info = self.get_tilemap_info(tilemapid)
+        if not info:
+            raise HTTPError(404, reason=f"Collection '{tilemapid}' not found")
+        self.write({
+            'tilesets': [self.tileset(info, tms) for tms in self.tile_matrix_sets().values()],
+        })
+
+
+class TileSetInfo(OgcTilesHandler):
+    """ Collection tileset metadata
+    """
+    def get(self, tilemapid, tilematrixsetid) -> None:
+        if self.check_document_etag():
+            return
+
+        tms = self.get_tilemap_tms(tilemapid, tilematrixsetid)
+        self.write(self.tileset(self.get_tilemap_info(tilemapid), tms, limits=True))
+
+
+class TileSetContent(TileContentHandler):
+    """ Collection tile content
+
+        The format is selected with the `f` parameter, defaults
+        to the first format of the tile map.
+    """
+    def get(self, tilemapid, tilematrixsetid, tilematrixid, tilerowid, tilecolid) -> None:
+        info = self.get_tilemap_info(tilemapid)
+        if not info:
+            raise HTTPError(404, reason=f"Collection '{tilemapid}' not found")
+
+        tms = self.tile_matrix_sets().get(tilematrixsetid)
+        if not tms:
+            raise HTTPError(404, reason=f"Tile matrix set '{tilematrixsetid}' not found")
+
+        extension = self.get_argument('f', info['formats'][0])
+        tile = self.parse_tile(tilematrixid, tilecolid, tilerowid)
+        self.send_tile(tilemapid, tms, tile, extension)
+
+    def tile_url(self, tilemapid, tms, extension):
+        """ override
+        """
+        href = self.api_href(f"/collections/{tilemapid}/tiles/{tms.identifier}")
+        base, _, query = href.partition('?')
+        query = '&'.join(item for item in query.split('&') if item and not item.startswith('f='))
+        query = f"{query}&f={extension}" if query else f"f={extension}"
+        return lambda z, x, y: f"{base}/{z}/{y}/{x}?{query}"
+
+
+def match_tile_path(path: str) -> Optional[Dict[str, str]]:
+    """ Split based parser for tile path
+        `/collections/{tilemapid}/tiles/{tilematrixsetid}/{z}/{y}/{x}`
+    """
+    if path.endswith('/'):
+        path = path[:-1]
+    parts = path.split('/')
+    if len(parts) != 8 or parts[0] or parts[1] != 'collections' or parts[3] != 'tiles':
+        return None
+    _, _, tilemapid, _, tilematrixsetid, tilematrixid, tilerowid, tilecolid = parts
+    if not (tilemapid and tilematrixsetid):
+        return None
+    if not (tilematrixid.isdecimal() and tilerowid.isdecimal() and tilecolid.isdecimal()):
+        return None
+    return {
+        'tilemapid': tilemapid,
+        'tilematrixsetid': tilematrixsetid,
+        'tilematrixid': tilematrixid,
+        'tilerowid': tilerowid,
+        'tilecolid': tilecolid,
+    }
+
+
+def init_ogc_tiles_api(server_iface) -> None:
+    """ Initialize the OGC API Tiles
+    """
+    kwargs = dict(srv_iface=server_iface)
+
+    # Parameters are extracted from the url, query string included:
+    # values must not match the query string and patterns are not
+    # anchored at the end. Patterns are ordered from the most specific.
+    #
+    # see https://github.com/qgis/QGIS/issues/45439
+    #
+    handlers = [
+        (r"/collections/(?P<tilemapid>[^/?]+)/tiles/(?P<tilematrixsetid>[^/?]+)/(?P<tilematrixid>\d+)/(?P<tilerowid>\d+)/(?P<tilecolid>\d+)",  # noqa: E501
+            TileSetContent, dict(kwargs, fast_match=match_tile_path)),
+        (r"/collections/(?P<tilemapid>[^/?]+)/tiles/(?P<tilematrixsetid>[^/?]+)", TileSetInfo, kwargs),
+        (r"/collections/(?P<tilemapid>[^/?]+)/tiles", TileSets, kwargs),
+        (r"/tileMatrixSets/(?P<tilematrixsetid>[^/?]+)", TileMatrixSetInfo, kwargs),
+        (r"/tileMatrixSets", TileMatrixSets, kwargs),
+        (r"/?", LandingPage, kwargs),
+    ]
+
+    register_api_handlers(server_iface, '/ogcapi/tiles', 'OGC API Tiles', handlers)
@@ -0,0 +1,263 @@
+""" PMTiles version 3 archive writer
+
+    Tiles are addressed by their position on the Hilbert curve of
+    their zoom level. Identical tiles are stored once and consecutive
+    identical tiles share a directory entry.
+
+    See https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+from typing import Dict, List, Optional, Tuple
+
+HEADER = struct.Struct('<7sBQQQQQQQQQQQBBBBBBiiiiBii')
+HEADER_SIZE = 127
+# Header and root directory fit in the first 16 KiB
+ROOT_MAX_SIZE = 16384 - HEADER_SIZE
+LEAF_SIZE = 4096
+
+# Compression
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+
+# Tile types
+TILE_TYPES = {
+    'pbf': 1,
+    'png': 2,
+    'png8': 2,
+    'jpg': 3,
+    'jpeg': 3,
+    'webp': 4,
+}
+
+# Tile id, offset, length, run length
+Entry = List[int]
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    """ Return the PMTiles id of the tile
+    """
+    if z > 31 or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        raise ValueError(f"Tile {z}/{x}/{y} out of range")
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    n = 1 << z
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+
+def _varint(buf: bytearray, value: int) -> None:
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def serialize_directory(entries: List[Entry]) -> bytes:
+    """ Return the compressed directory of the entries
+    """
+    buf = bytearray()
+    _varint(buf, len(entries))
+    last_id = 0
+    for entry in entries:
+        _varint(buf, entry[0] - last_id)
+        last_id = entry[0]
+    for entry in entries:
+        _varint(buf, entry[3])
+    for entry in entries:
+        _varint(buf, entry[2])
+    for i, entry in enumerate(entries):
+        if i > 0 and entry[1] == entries[i - 1][1] + entries[i - 1][2]:
+            _varint(buf, 0)
+        else:
+            _varint(buf, entry[1] + 1)
+    return gzip.compress(bytes(buf), mtime=0)
+
+
+def build_directories(entries: List[Entry]) -> Tuple[bytes, bytes]:
+    """ Return the root directory and the leaf directories
+    """
+    root = serialize_directory(entries)
+    if len(root) <= ROOT_MAX_SIZE:
+        return root, b''
+
+    leaf_size = LEAF_SIZE
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for i in range(0, len(entries), leaf_size):
+            chunk = entries[i:i + leaf_size]
+            leaf = serialize_directory(chunk)
+            root_entries.append([chunk[0][0], len(leaves), len(leaf), 0])
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_MAX_SIZE:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+class PMTilesWriter:
+    """ Write tiles to a PMTiles archive
+
+        Tile data is written sequentially to a temporary file,
+        the archive is assembled on close.
+    """
+
+    def __init__(self, path: str, extension: str, metadata: Optional[Dict] = None) -> None:
+        self._path = path
+        self._tile_type = TILE_TYPES.get(extension, 0)
+        self._metadata = metadata or {}
+        self._data = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self._entries: List[Entry] = []
+        self._contents: Dict[bytes, Tuple[int, int]] = {}
+        self._offset = 0
+        self._addressed = 0
+        self._clustered = True
+        self._zooms = set()
+
+    def write(self, z: int, x: int, y: int, data: bytes) -> bool:
+        """ Add a tile, return False if the tile is a duplicate
+
+            Empty tiles are not stored
+        """
+        if not data:
+            return True
+        tile_id = zxy_to_tileid(z, x, y)
+        if self._entries and tile_id <= self._entries[-1][0]:
+            self._clustered = False
+        self._addressed += 1
+        self._zooms.add(z)
+
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        content = self._contents.get(digest)
+        if content is not None:
+            offset, length = content
+            last = self._entries[-1] if self._entries else None
+            if last is not None and last[0] + last[3] == tile_id and last[1] == offset:
+                last[3] += 1
+            else:
+                self._entries.append([tile_id, offset, length, 1])
+            return False
+
+        self._data.write(data)
+        self._contents[digest] = (self._offset, len(data))
+        self._entries.append([tile_id, self._offset, len(data), 1])
+        self._offset += len(data)
+        return True
+
+    def close(self, bounds: Optional[Tuple[float, float, float, float]] = None) -> None:
+        """ Write the archive
+
+            `bounds` are given in WGS84 as (min lon, min lat, max lon, max lat)
+        """
+        entries = self._entries
+        if not self._clustered:
+            entries.sort(key=lambda e: e[0])
+        root, leaves = build_directories(entries)
+        metadata = gzip.compress(json.dumps(self._metadata).encode(), mtime=0)
+
+        min_lon, min_lat, max_lon, max_lat = bounds or (-180., -85.0511287, 180., 85.0511287)
+        min_zoom = min(self._zooms, default=0)
+        max_zoom = max(self._zooms, default=0)
+        metadata_offset = HEADER_SIZE + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + len(leaves)
+
+        header = HEADER.pack(
+            b'PMTiles', 3,
+            HEADER_SIZE, len(root),
+            metadata_offset, len(metadata),
+            leaves_offset, len(leaves),
+            data_offset, self._offset,
+            self._addressed, len(entries), len(self._contents),
+            int(self._clustered), COMPRESSION_GZIP, COMPRESSION_NONE, self._tile_type,
+            min_zoom, max_zoom,
+            round(min_lon * 1e7), round(min_lat * 1e7), round(max_lon * 1e7), round(max_lat * 1e7),
+            min_zoom, round((min_lon + max_lon) / 2 * 1e7), round((min_lat + max_lat) / 2 * 1e7),
+        )
+        with open(self._path, 'wb') as f:
+            f.write(header)
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            self._data.seek(0)
+            shutil.copyfileobj(self._data, f, 1024 * 1024)
+        self._data.close()
+
+
+class PMTilesReader:
+    """ Read tiles from a PMTiles archive written by PMTilesWriter
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            self._buffer = f.read()
+        self.header = HEADER.unpack_from(self._buffer)
+        if self.header[0] != b'PMTiles' or self.header[1] != 3:
+            raise ValueError("Not a PMTiles version 3 archive")
+
+    @staticmethod
+    def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, pos
+            shift += 7
+
+    def entries(self, offset: int, length: int) -> List[Entry]:
+        """ Return the entries of the directory at offset
+        """
+        data = gzip.decompress(self._buffer[offset:offset + length])
+        count, pos = self._read_varint(data, 0)
+        entries = [[0, 0, 0, 0] for _ in range(count)]
+        last_id = 0
+        for entry in entries:
+            delta, pos = self._read_varint(data, pos)
+            last_id = entry[0] = last_id + delta
+        for field in (3, 2):
+            for entry in entries:
+                entry[field], pos = self._read_varint(data, pos)
+        for i, entry in enumerate(entries):
+            value, pos = self._read_varint(data, pos)
+            entry[1] = entries[i - 1][1] + entries[i - 1][2] if value == 0 and i > 0 else value - 1
+        return entries
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """ Return the data of the tile or None if the tile is not stored
+        """
+        tile_id = zxy_to_tileid(z, x, y)
+        offset, length = self.header[2], self.header[3]
+        while True:
+            leaf = None
+            for entry in self.entries(offset, length):
+                if entry[0] > tile_id:
+                    break
+                if entry[3] == 0:
+                    leaf = entry
+                elif tile_id < entry[0] + entry[3]:
+                    start = self.header[8] + entry[1]
+                    return self._buffer[start:start + entry[2]]
+            if leaf is None:
+                return None
+            offset, length = self.header[6] + leaf[1], leaf[2]
@@ -0,0 +1,239 @@
+""" Predictive prefetch of neighbouring and child tiles
+
+    Tiles adjacent to a served tile and its children are requested
+    from a background thread when the process is idle, so that the
+    next requests of map clients land on a warm cache.
+
+    Prefetch candidates are prioritized by the number of requests of
+    the served tile and limited by a budget per tile map. Only the
+    request of the served tile is counted on the request path, the
+    candidates are expanded and checked against the tile stores by
+    the background thread.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import heapq
+import itertools
+import threading
+import time
+
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Hashable, List, Optional
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.apiutils import idle_time
+from tilesForServer.config import getenv_bool, getenv_float, getenv_int
+from tilesForServer.seeding import fetch_url
+
+
+class TokenBucket:
+    """ Budget of requests per minute
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self._capacity = float(per_minute)
+        self._rate = per_minute / 60.
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Prefetcher:
+    """ Idle time tile prefetcher
+
+        * `budget`: maximum number of prefetched tiles per tile map and per minute
+        * `idle_delay`: minimum idle time of the process before prefetching, in seconds
+        * `max_queue`: maximum number of pending tiles, the lowest priority
+          tiles are dropped
+        * `min_hits`: number of requests of a tile before prefetching around it
+    """
+
+    def __init__(self, budget: int = 60, idle_delay: float = 0.2, max_queue: int = 1000,
+                 min_hits: int = 1, max_counters: int = 100000, timeout: float = 30.) -> None:
+        self._budget = budget
+        self._idle_delay = idle_delay
+        self._max_queue = max_queue
+        self._min_hits = min_hits
+        self._max_counters = max_counters
+        self._timeout = timeout
+
+        self._hits: Dict[Hashable, int] = OrderedDict()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._heap: List = []
+        self._queued = set()
+        self._expansions = deque()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+        self._prefetched = 0
+        self._dropped = 0
+        self._over_budget = 0
+        self._errors = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['Prefetcher']:
+        """ Create the prefetcher from the environment
+
+            * `QGIS_TILES_PREFETCH`: enable prefetching
+            * `QGIS_TILES_PREFETCH_BUDGET`: tiles per tile map and per minute
+            * `QGIS_TILES_PREFETCH_IDLE_DELAY`: idle time before prefetching in seconds
+            * `QGIS_TILES_PREFETCH_QUEUE_SIZE`: maximum number of pending tiles
+            * `QGIS_TILES_PREFETCH_MIN_HITS`: requests of a tile before prefetching around it
+        """
+        if not getenv_bool('QGIS_TILES_PREFETCH'):
+            return None
+        return cls(
+            budget=getenv_int('QGIS_TILES_PREFETCH_BUDGET', 60),
+            idle_delay=getenv_float('QGIS_TILES_PREFETCH_IDLE_DELAY', 0.2),
+            max_queue=getenv_int('QGIS_TILES_PREFETCH_QUEUE_SIZE', 1000),
+            min_hits=getenv_int('QGIS_TILES_PREFETCH_MIN_HITS', 1),
+        )
+
+    def hit(self, tile_id: Hashable) -> int:
+        """ Count a request of the tile, return the number of requests
+        """
+        with self._cond:
+            hits = self._hits.pop(tile_id, 0) + 1
+            self._hits[tile_id] = hits
+            if len(self._hits) > self._max_counters:
+                self._hits.popitem(last=False)
+        return hits
+
+    def accepts(self, hits: int) -> bool:
+        """ Check that a tile requested hits times is worth prefetching around
+        """
+        return hits >= self._min_hits
+
+    def submit(self, tilemapid: str, hits: int, urls: List[str], headers: Dict[str, str]) -> int:
+        """ Queue tile urls of the tile map with the priority given by hits
+
+            Return the number of queued urls
+        """
+        if not self.accepts(hits):
+            return 0
+        count = 0
+        with self._cond:
+            bucket = self._buckets.get(tilemapid)
+            if bucket is None:
+                bucket = self._buckets[tilemapid] = TokenBucket(self._budget)
+            for url in urls:
+                if url in self._queued:
+                    continue
+                if not bucket.take():
+                    self._over_budget += 1
+                    break
+                heapq.heappush(self._heap, (-hits, next(self._counter), url, headers))
+                self._queued.add(url)
+                count += 1
+            while len(self._heap) > self._max_queue:
+                # Drop the lowest priority tile
+                item = max(self._heap)
+                self._heap.remove(item)
+                heapq.heapify(self._heap)
+                self._queued.discard(item[2])
+                self._dropped += 1
+            if count:
+                self._start()
+                self._cond.notify()
+        return count
+
+    def expand(self, tilemapid: str, hits: int, candidates: Callable[[], List[str]],
+               headers: Dict[str, str]) -> bool:
+        """ Queue the expansion of the prefetch candidates of a tile
+
+            `candidates` returns the urls of the tiles to prefetch, it is
+            called by the prefetch thread and must not use the request.
+
+            Return False if the expansion is not queued
+        """
+        if not self.accepts(hits):
+            return False
+        with self._cond:
+            if len(self._expansions) >= self._max_queue:
+                self._dropped += 1
+                return False
+            self._expansions.append((tilemapid, hits, candidates, headers))
+            self._start()
+            self._cond.notify()
+        return True
+
+    def _expand(self, tilemapid: str, hits: int, candidates: Callable[[], List[str]],
+                headers: Dict[str, str]) -> None:
+        try:
+            urls = candidates()
+        except Exception as err:
+            self._errors += 1
+            QgsMessageLog.logMessage(f"Failed to expand prefetch candidates: {err}", "tilesApi", Qgis.Warning)
+            return
+        if urls:
+            self.submit(tilemapid, hits, urls, headers)
+
+    def _start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="tiles-prefetch", daemon=True)
+            self._thread.start()
+
+    def _wait_idle(self) -> None:
+        while True:
+            idle = idle_time()
+            if idle >= self._idle_delay:
+                return
+            time.sleep(self._idle_delay - idle if idle else self._idle_delay)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap and not self._expansions:
+                    self._cond.wait()
+            self._wait_idle()
+            with self._cond:
+                expansion = self._expansions.popleft() if self._expansions else None
+                if expansion is None:
+                    if not self._heap:
+                        continue
+                    _, _, url, headers = heapq.heappop(self._heap)
+                    self._queued.discard(url)
+            if expansion is not None:
+                self._expand(*expansion)
+                continue
+            try:
+                fetch_url(url, headers, self._timeout)
+                self._prefetched += 1
+            except Exception as err:
+                self._errors += 1
+                QgsMessageLog.logMessage(f"Failed to prefetch tile {url}: {err}", "tilesApi", Qgis.Warning)
+
+    def stats(self) -> Dict:
+        return {
+            'pending': len(self._heap),
+            'expansions': len(self._expansions),
+            'prefetched': self._prefetched,
+            'dropped': self._dropped,
+            'overBudget': self._over_budget,
+            'errors': self._errors,
+        }
+
+
+_prefetcher: Optional[Prefetcher] = None
+_initialized = False
+
+
+def prefetcher() -> Optional[Prefetcher]:
+    """ Return the prefetcher or None if prefetching is disabled
+    """
+    global _prefetcher, _initialized
+    if not _initialized:
+        _prefetcher = Prefetcher.from_env()
+        _initialized = True
+    return _prefetcher
@@ -0,0 +1,173 @@
+""" Request profiling
+
+    Requests whose path matches the server allowlist are profiled when
+    they carry the `X-Tiles-Profile` header or when they are sampled.
+    Handlers run under cProfile and/or tracemalloc, profiles are written
+    to the profile directory:
+
+    * `{name}.prof`: cProfile statistics, to be read with `pstats` or `snakeviz`
+    * `{name}.tracemalloc`: tracemalloc snapshot, to be read with `tracemalloc.Snapshot.load`
+    * `{name}.json`: request url, status, duration, peak traced memory
+      and top allocations
+
+    The profile name is built from the request time, the process id and
+    the request key. Profiling is disabled unless the profile directory
+    and the allowlist are set.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import cProfile
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from typing import Dict, Iterator, List, Optional
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.config import getenv, getenv_float, getenv_int
+
+PROFILE_HEADER = 'X-Tiles-Profile'
+
+# Number of allocation sites in the summary
+TOP_ALLOCATIONS = 20
+
+
+class Profiler:
+    """ Profile selected requests
+
+        * `allowlist`: glob patterns of the profiled request paths
+        * `sample`: percentage of the allowed requests profiled without header
+        * `token`: value of the profile header, any value if not set
+        * `limit`: maximum number of profiles written by the process
+    """
+
+    def __init__(self, path: str, allowlist: List[str], sample: float = 0., token: Optional[str] = None,
+                 cpu: bool = True, memory: bool = False, frames: int = 10, limit: int = 100) -> None:
+        self._path = path
+        self._allowlist = allowlist
+        self._sample = sample
+        self._token = token
+        self._cpu = cpu
+        self._memory = memory
+        self._frames = frames
+        self._limit = limit
+        self._written = 0
+        # Profilers cannot be nested
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional['Profiler']:
+        """ Create the profiler from the environment
+
+            * `QGIS_TILES_PROFILE_PATH`: directory of the profiles, profiling is disabled if not set
+            * `QGIS_TILES_PROFILE_ALLOWLIST`: comma separated glob patterns of the profiled
+              request paths, ie: `/tms/france_parts/*`, profiling is disabled if not set
+            * `QGIS_TILES_PROFILE_SAMPLE`: percentage of the allowed requests profiled
+            * `QGIS_TILES_PROFILE_TOKEN`: required value of the `X-Tiles-Profile` header
+            * `QGIS_TILES_PROFILE_MODE`: `cpu`, `memory` or `cpu,memory`
+            * `QGIS_TILES_PROFILE_FRAMES`: number of frames of the traced allocations
+            * `QGIS_TILES_PROFILE_LIMIT`: maximum number of profiles per process
+        """
+        path = getenv('QGIS_TILES_PROFILE_PATH')
+        allowlist = [p.strip() for p in getenv('QGIS_TILES_PROFILE_ALLOWLIST', '').split(',') if p.strip()]
+        if not path or not allowlist:
+            return None
+        mode = {m.strip() for m in getenv('QGIS_TILES_PROFILE_MODE', 'cpu').lower().split(',')}
+        return cls(
+            path,
+            allowlist,
+            sample=getenv_float('QGIS_TILES_PROFILE_SAMPLE'),
+            token=getenv('QGIS_TILES_PROFILE_TOKEN') or None,
+            cpu='cpu' in mode,
+            memory='memory' in mode,
+            frames=getenv_int('QGIS_TILES_PROFILE_FRAMES', 10),
+            limit=getenv_int('QGIS_TILES_PROFILE_LIMIT', 100),
+        )
+
+    def accepts(self, path: str, header: Optional[str]) -> bool:
+        """ Check if the request is profiled
+        """
+        if self._written >= self._limit or not any(fnmatchcase(path, p) for p in self._allowlist):
+            return False
+        if header:
+            return self._token is None or header == self._token
+        return self._sample > 0 and random.random() * 100 < self._sample
+
+    @contextmanager
+    def profile(self, url: str) -> Iterator[Dict]:
+        """ Profile the execution of the request
+
+            Yield the summary of the profile, values added to
+            the summary are written with the profile.
+        """
+        if not self._lock.acquire(blocking=False):
+            yield {}
+            return
+        try:
+            key = hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+            summary = {'name': f"{int(time.time() * 1000)}-{os.getpid()}-{key}", 'url': url}
+
+            profile = cProfile.Profile() if self._cpu else None
+            trace = self._memory and not tracemalloc.is_tracing()
+            if trace:
+                tracemalloc.start(self._frames)
+            start = time.perf_counter()
+            if profile is not None:
+                profile.enable()
+            try:
+                yield summary
+            finally:
+                if profile is not None:
+                    profile.disable()
+                summary['duration'] = round((time.perf_counter() - start) * 1000, 3)
+                snapshot = None
+                if trace:
+                    snapshot = tracemalloc.take_snapshot()
+                    summary['peak'] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                self._write(summary, profile, snapshot)
+        finally:
+            self._lock.release()
+
+    def _write(self, summary: Dict, profile: Optional[cProfile.Profile],
+               snapshot: Optional[tracemalloc.Snapshot]) -> None:
+        base = os.path.join(self._path, summary['name'])
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            if profile is not None:
+                profile.dump_stats(f"{base}.prof")
+            if snapshot is not None:
+                snapshot.dump(f"{base}.tracemalloc")
+                summary['allocations'] = [
+                    {'location': str(stat.traceback[0]), 'size': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+                ]
+            with open(f"{base}.json", 'w') as f:
+                json.dump(summary, f, indent=2)
+        except OSError as err:
+            QgsMessageLog.logMessage(f"Failed to write profile: {err}", "tilesApi", Qgis.Warning)
+            return
+        self._written += 1
+        QgsMessageLog.logMessage(f"Profile {summary['name']} written for {summary['url']}", "tilesApi", Qgis.Info)
+
+
+_profiler: Optional[Profiler] = None
+_initialized = False
+
+
+def profiler() -> Optional[Profiler]:
+    """ Return the request profiler or None if profiling is disabled
+    """
+    global _profiler, _initialized
+    if not _initialized:
+        _profiler = Profiler.from_env()
+        _initialized = True
+    return _profiler
@@ -0,0 +1,333 @@
+""" Redis tile store
+
+    A tile store shared by the nodes of a cluster, speaking the Redis
+    serialization protocol (RESP) over pooled persistent connections.
+
+    Tile data is stored once per content hash under `{prefix}data:{hash}`,
+    tile keys `{prefix}ref:{key}` hold the creation timestamp and the
+    content hash of the tile. Values are binary safe.
+
+    Data is never deleted with the references: it expires with the
+    store time to live or is evicted by the server eviction policy.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import socket
+import struct
+import threading
+import time
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import unquote, urlparse
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.cache import TileEntry, TileReference, TileStore, content_digest
+from tilesForServer.config import getenv, getenv_float, getenv_int
+
+# Creation timestamp and content hash of the references
+REFERENCE = struct.Struct('<d16s')
+
+DEFAULT_PORT = 6379
+
+# Maximum number of keys of a MGET or DEL command
+MGET_CHUNK_SIZE = 256
+
+
+class RedisError(Exception):
+    """ Error reply from the server
+    """
+    pass
+
+
+def encode_command(*args) -> bytes:
+    """ Encode a command as a RESP array of bulk strings
+    """
+    out = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, (int, float)):
+            arg = str(arg).encode()
+        out.append(b'$%d\r\n' % len(arg))
+        out.append(arg)
+        out.append(b'\r\n')
+    return b''.join(out)
+
+
+class RedisConnection:
+    """ Persistent connection to a Redis server
+    """
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None,
+                 timeout: Optional[float] = None) -> None:
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+        if db:
+            self.execute('SELECT', db)
+
+    def close(self) -> None:
+        try:
+            self._reader.close()
+        finally:
+            self._sock.close()
+
+    def execute(self, *args):
+        """ Send a command and return its reply
+        """
+        self._sock.sendall(encode_command(*args))
+        return self.read_reply()
+
+    def pipeline(self, commands: Sequence[Sequence]) -> List:
+        """ Send all the commands at once and return their replies
+        """
+        self._sock.sendall(b''.join(encode_command(*args) for args in commands))
+        return [self.read_reply() for _ in commands]
+
+    def read_reply(self):
+        """ Read a RESP reply
+        """
+        line = self._reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by server")
+        kind, value = line[:1], line[1:-2]
+        if kind == b'$':
+            length = int(value)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by server")
+            return data[:-2]
+        if kind == b'+':
+            return value
+        if kind == b':':
+            return int(value)
+        if kind == b'*':
+            length = int(value)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        if kind == b'-':
+            raise RedisError(value.decode(errors='replace'))
+        raise ConnectionError(f"Invalid reply {line!r}")
+
+
+class ConnectionPool:
+    """ Pool of persistent connections
+
+        Connections are returned to the pool after use and
+        dropped on connection errors.
+    """
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None,
+                 timeout: Optional[float] = None, max_idle: int = 8) -> None:
+        self._args = (host, port, db, password, timeout)
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> RedisConnection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return RedisConnection(*self._args)
+
+    def release(self, conn: RedisConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def execute(self, func):
+        """ Call func with a connection from the pool
+        """
+        conn = self.acquire()
+        try:
+            result = func(conn)
+        except BaseException:
+            # The protocol state is unknown
+            conn.close()
+            raise
+        self.release(conn)
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class RedisStore(TileStore):
+    """ Redis tile store
+
+        Server errors are logged and handled as cache misses.
+    """
+    name = 'redis'
+
+    def __init__(self, host: str, port: int = DEFAULT_PORT, db: int = 0,
+                 password: Optional[str] = None, prefix: str = 'qgis-tiles:',
+                 ttl: int = 0, timeout: Optional[float] = None, pool_size: int = 8) -> None:
+        self._pool = ConnectionPool(host, port, db, password, timeout, pool_size)
+        self._prefix = prefix.encode()
+        self._refs = self._prefix + b'ref:'
+        self._data = self._prefix + b'data:'
+        self._ttl = ttl
+        self._address = f"{host}:{port}/{db}"
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+        self._deduplicated = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['RedisStore']:
+        """ Create the store from the environment
+
+            * `QGIS_TILES_REDIS_URL`: server url, `redis://[:password@]host[:port][/db]`,
+              the store is disabled if not set
+            * `QGIS_TILES_REDIS_PREFIX`: prefix of the keys
+            * `QGIS_TILES_REDIS_TTL`: time to live of the tiles in seconds
+            * `QGIS_TILES_REDIS_TIMEOUT`: socket timeout in seconds
+            * `QGIS_TILES_REDIS_POOL_SIZE`: maximum number of idle connections
+        """
+        url = getenv('QGIS_TILES_REDIS_URL')
+        if not url:
+            return None
+        parsed = urlparse(url)
+        if parsed.scheme != 'redis':
+            raise ValueError(f"Invalid redis url: {url}")
+        db = parsed.path.strip('/')
+        return cls(
+            parsed.hostname or 'localhost',
+            parsed.port or DEFAULT_PORT,
+            db=int(db) if db else 0,
+            password=unquote(parsed.password) if parsed.password else None,
+            prefix=getenv('QGIS_TILES_REDIS_PREFIX', 'qgis-tiles:'),
+            ttl=getenv_int('QGIS_TILES_REDIS_TTL'),
+            timeout=getenv_float('QGIS_TILES_REDIS_TIMEOUT', 1.) or None,
+            pool_size=getenv_int('QGIS_TILES_REDIS_POOL_SIZE', 8),
+        )
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def _execute(self, func, default=None):
+        try:
+            return self._pool.execute(func)
+        except (OSError, ConnectionError, RedisError) as err:
+            self._errors += 1
+            QgsMessageLog.logMessage(f"Redis tile store error: {err}", "tilesApi", Qgis.Warning)
+            return default
+
+    def _references(self, values: Sequence[Optional[bytes]]) -> List[Optional[Tuple[float, bytes]]]:
+        return [REFERENCE.unpack(value) if value is not None and len(value) == REFERENCE.size else None
+                for value in values]
+
+    def _entry(self, reference: Optional[Tuple[float, bytes]], data: Optional[bytes]) -> Optional[TileEntry]:
+        if reference is None or data is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        created, digest = reference
+        return TileEntry(data, created, digest)
+
+    def get(self, key: bytes) -> Optional[TileEntry]:
+        """ Return the entry of key
+
+            The reference and the data are fetched with two commands
+        """
+        return self.get_many([key])[0]
+
+    def _mget(self, keys: Sequence[bytes]) -> List[Optional[bytes]]:
+        """ Return the values of keys fetched with MGET commands
+            sent in a single pipeline
+        """
+        commands = [
+            ['MGET', *keys[i:i + MGET_CHUNK_SIZE]]
+            for i in range(0, len(keys), MGET_CHUNK_SIZE)
+        ]
+        replies = self._execute(lambda conn: conn.pipeline(commands), [])
+        values = [value for reply in replies for value in reply]
+        if len(values) != len(keys):
+            values = [None] * len(keys)
+        return values
+
+    def get_many(self, keys: Sequence[bytes]) -> List[Optional[TileEntry]]:
+        """ Return the entries of keys
+
+            References then data are fetched in two pipelines, the
+            data of identical tiles is fetched once.
+        """
+        if not keys:
+            return []
+        references = self._references(self._mget([self._refs + key for key in keys]))
+        digests = list({ref[1] for ref in references if ref is not None})
+        data = dict(zip(digests, self._mget([self._data + digest for digest in digests]))) if digests else {}
+        return [self._entry(ref, data.get(ref[1]) if ref is not None else None) for ref in references]
+
+    def get_reference(self, key: bytes) -> Optional[TileReference]:
+        """ Return the reference of key, without fetching the data
+        """
+        reference = self._references(self._mget([self._refs + key]))[0]
+        return TileReference(*reference) if reference is not None else None
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        """ Check which keys are stored with EXISTS commands sent
+            in a single pipeline
+        """
+        if not keys:
+            return []
+        commands = [['EXISTS', self._refs + key] for key in keys]
+        replies = self._execute(lambda conn: conn.pipeline(commands), [0] * len(keys))
+        return [bool(reply) for reply in replies]
+
+    def set(self, key: bytes, data: bytes, created: Optional[float] = None,
+            digest: Optional[bytes] = None) -> None:
+        """ Store the reference of key, and the data if not already stored
+
+            The time to live of stored data is renewed by each new reference
+        """
+        digest = digest or content_digest(data)
+        expire = ['EX', self._ttl] if self._ttl > 0 else []
+        data_key = self._data + digest
+        commands = [
+            ['EXPIRE', data_key, self._ttl] if self._ttl > 0 else ['EXISTS', data_key],
+            ['SET', self._refs + key, REFERENCE.pack(created or time.time(), digest), *expire],
+        ]
+        replies = self._execute(lambda conn: conn.pipeline(commands))
+        if replies is None:
+            return
+        if replies[0]:
+            self._deduplicated += 1
+            return
+        self._execute(lambda conn: conn.execute('SET', data_key, bytes(data), *expire))
+
+    def delete(self, key: bytes) -> None:
+        self._execute(lambda conn: conn.execute('DEL', self._refs + key))
+
+    def delete_many(self, keys: Sequence[bytes]) -> None:
+        """ Delete keys with DEL commands sent in a single pipeline
+        """
+        if not keys:
+            return
+        commands = [
+            ['DEL', *(self._refs + key for key in keys[i:i + MGET_CHUNK_SIZE])]
+            for i in range(0, len(keys), MGET_CHUNK_SIZE)
+        ]
+        self._execute(lambda conn: conn.pipeline(commands))
+
+    def stats(self) -> Dict:
+        return {
+            'address': self._address,
+            'ttl': self._ttl,
+            'hits': self._hits,
+            'misses': self._misses,
+            'errors': self._errors,
+            'deduplicated': self._deduplicated,
+        }
@@ -0,0 +1,162 @@
+""" Direct rendering of raster tiles
+
+    Map settings are prepared once per tile map and tile matrix set
+    and tiles are rendered without going through the WMTS service.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from qgis.core import (
+    Qgis,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeedback,
+    QgsMapLayer,
+    QgsMapRendererParallelJob,
+    QgsMapSettings,
+    QgsMessageLog,
+    QgsProject,
+    QgsRectangle,
+)
+from qgis.PyQt.QtCore import QEventLoop, QSize
+from qgis.PyQt.QtGui import QColor, QImage
+
+from tilesForServer.fingerprint import project_fingerprint
+from tilesForServer.tilematrix import OGC_PX_M, TILE_SIZE, TileMatrixSet
+
+_map_settings = OrderedDict()
+_cache_size = 64
+
+
+def create_map_settings(project: QgsProject, tms: TileMatrixSet, transparent: bool) -> QgsMapSettings:
+    """ Create the map settings template for rendering tiles
+    """
+    settings = QgsMapSettings()
+    settings.setDestinationCrs(tms.crs)
+    settings.setOutputSize(QSize(TILE_SIZE, TILE_SIZE))
+    # The WMTS grids are defined for the OGC standardized pixel size
+    settings.setOutputDpi(0.0254 / OGC_PX_M)
+    settings.setOutputImageFormat(QImage.Format_ARGB32_Premultiplied)
+    settings.setBackgroundColor(QColor(255, 255, 255, 0 if transparent else 255))
+    settings.setTransformContext(project.transformContext())
+    settings.setEllipsoid(project.ellipsoid())
+    settings.setLabelingEngineSettings(project.labelingEngineSettings())
+    settings.setPathResolver(project.pathResolver())
+    settings.setFlag(QgsMapSettings.Antialiasing, True)
+    settings.setFlag(QgsMapSettings.UseAdvancedEffects, True)
+    settings.setFlag(QgsMapSettings.RenderMapTile, True)
+
+    context = QgsExpressionContext()
+    context.appendScope(QgsExpressionContextUtils.globalScope())
+    context.appendScope(QgsExpressionContextUtils.projectScope(project))
+    settings.setExpressionContext(context)
+    return settings
+
+
+def get_map_settings(project: QgsProject, tilemapid: str, tms: TileMatrixSet,
+                     layers: List[QgsMapLayer], transparent: bool) -> QgsMapSettings:
+    """ Return map settings for rendering a tile of the tile map
+
+        The template is prepared once and cached without layers:
+        layer instances do not outlive the project, so they are set
+        for each tile.
+    """
+    key = (project.fileName(), project_fingerprint(project),
+           tilemapid, tms.identifier, transparent)
+    template = _map_settings.get(key)
+    if template is None:
+        template = create_map_settings(project, tms, transparent)
+        _map_settings[key] = template
+        if len(_map_settings) > _cache_size:
+            _map_settings.popitem(last=False)
+    else:
+        _map_settings.move_to_end(key)
+
+    settings = QgsMapSettings(template)
+    settings.setLayers(layers)
+    return settings
+
+
+@contextmanager
+def access_control_subsets(layers: List[QgsMapLayer], access_controls) -> Iterator[None]:
+    """ Apply access control subset strings to the layers for
+        the duration of the rendering
+    """
+    restore = []
+    if access_controls:
+        for layer in layers:
+            if layer.type() != QgsMapLayer.VectorLayer:
+                continue
+            sql = access_controls.extraSubsetString(layer)
+            if not sql:
+                continue
+            subset = layer.subsetString()
+            restore.append((layer, subset))
+            layer.setSubsetString(f"({subset}) AND ({sql})" if subset else sql)
+    try:
+        yield
+    finally:
+        for layer, subset in restore:
+            layer.setSubsetString(subset)
+
+
+class RenderTimeout(Exception):
+    """ Raised when a render is canceled at its deadline
+    """
+
+
+@contextmanager
+def render_deadline(timeout: float) -> Iterator[Optional[QgsFeedback]]:
+    """ Yield a feedback canceled after timeout seconds
+
+        Yield None if timeout is not positive
+    """
+    if timeout <= 0:
+        yield None
+        return
+    feedback = QgsFeedback()
+    timer = threading.Timer(timeout, feedback.cancel)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield feedback
+    finally:
+        timer.cancel()
+
+
+def render_image(settings: QgsMapSettings, extent: QgsRectangle, access_controls=None,
+                 feedback: Optional[QgsFeedback] = None) -> QImage:
+    """ Render the map for the tile extent
+
+        The render job is canceled when the feedback is canceled
+    """
+    settings.setExtent(extent)
+
+    layers = settings.layers()
+    with access_control_subsets(layers, access_controls):
+        job = QgsMapRendererParallelJob(settings)
+        if access_controls:
+            job.setFeatureFilterProvider(access_controls)
+        job.start()
+        if feedback is not None:
+            loop = QEventLoop()
+            job.finished.connect(loop.quit)
+            feedback.canceled.connect(loop.quit)
+            if job.isActive() and not feedback.isCanceled():
+                loop.exec_()
+            if job.isActive():
+                job.cancel()
+                raise RenderTimeout()
+        job.waitForFinished()
+
+    for error in job.errors():
+        QgsMessageLog.logMessage(f"Rendering error for layer {error.layerID}: {error.message}",
+                                 "tilesApi", Qgis.Warning)
+    return job.renderedImage()
+
@@ -0,0 +1,165 @@
+""" Replay an access log against the plugin
+
+    Requests of an access log are executed in process by QGIS server
+    instances, one per worker process:
+
+        python -m tilesForServer.replay access.log --concurrency 4
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+REPLAYED_METHODS = ('get', 'head')
+
+
+def read_log(path: str) -> Iterator[Dict]:
+    """ Read the entries of an access log
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def entry_url(entry: Dict) -> str:
+    """ Return the url of the request of an entry
+    """
+    query = entry.get('query')
+    return f"{entry['path']}?{query}" if query else entry['path']
+
+
+def popular_urls(entries: List[Dict]) -> List[Tuple[str, int]]:
+    """ Return the requested urls by decreasing number of requests
+    """
+    return Counter(entry_url(entry) for entry in entries).most_common()
+
+
+# Worker process state
+_app = None
+_server = None
+_plugin = None
+
+
+def init_worker() -> None:
+    """ Start a QGIS server with the plugin in the worker process
+    """
+    global _app, _server, _plugin
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    from qgis.core import QgsApplication
+    from qgis.server import QgsServer
+
+    import tilesForServer
+
+    _app = QgsApplication([], False)
+    _app.initQgis()
+    _server = QgsServer()
+    _plugin = tilesForServer.serverClassFactory(_server.serverInterface())
+
+
+def handle_request(url: str) -> Any:
+    """ Execute a request with the server of the worker process,
+        return the QgsBufferServerResponse
+    """
+    from qgis.server import (
+        QgsBufferServerRequest,
+        QgsBufferServerResponse,
+        QgsServerRequest,
+    )
+
+    request = QgsBufferServerRequest(url, QgsServerRequest.GetMethod, {}, None)
+    response = QgsBufferServerResponse()
+    _server.handleRequest(request, response)
+    return response
+
+
+def _replay(url: str) -> Tuple[int, str, float]:
+    """ Execute a request, return the status, the cache outcome
+        and the duration in ms
+    """
+    start = time.perf_counter()
+    response = handle_request(url)
+    duration = (time.perf_counter() - start) * 1000
+    cache = response.headers().get('X-Tiles-Cache', '')
+    return response.statusCode(), cache, duration
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Return the p percentile of sorted values
+    """
+    if not values:
+        return 0.
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def replay(urls: List[str], concurrency: int = 1) -> Dict:
+    """ Replay the urls, return the statistics
+    """
+    chunksize = min(64, max(1, len(urls) // (concurrency * 4)))
+    start = time.perf_counter()
+    with multiprocessing.Pool(concurrency, initializer=init_worker) as pool:
+        results = pool.map(_replay, urls, chunksize=chunksize)
+    elapsed = time.perf_counter() - start
+
+    durations = sorted(duration for _, _, duration in results)
+    return {
+        'requests': len(results),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 1) if elapsed else 0.,
+        'status': dict(Counter(str(status) for status, _, _ in results)),
+        'cache': dict(Counter(cache or 'none' for _, cache, _ in results)),
+        'latency': {
+            'p50': round(percentile(durations, 50), 3),
+            'p95': round(percentile(durations, 95), 3),
+            'p99': round(percentile(durations, 99), 3),
+            'max': round(durations[-1], 3) if durations else 0.,
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay a tiles access log")
+    parser.add_argument('log', help="NDJSON access log")
+    parser.add_argument('-c', '--concurrency', type=int, default=1, help="number of worker processes")
+    parser.add_argument('-n', '--limit', type=int, default=0, help="maximum number of requests")
+    parser.add_argument('--tiles-only', action='store_true', help="replay only tile requests")
+    parser.add_argument('--popular', action='store_true',
+                        help="replay each url once, most requested first (ie: for seeding)")
+    args = parser.parse_args(argv)
+
+    entries = [
+        entry for entry in read_log(args.log)
+        if entry.get('method', 'get') in REPLAYED_METHODS and (not args.tiles_only or 'z' in entry)
+    ]
+    if args.popular:
+        urls = [url for url, _ in popular_urls(entries)]
+    else:
+        urls = [entry_url(entry) for entry in entries]
+    if args.limit > 0:
+        urls = urls[:args.limit]
+    if not urls:
+        print("No request to replay", file=sys.stderr)
+        return 1
+
+    print(json.dumps(replay(urls, max(1, args.concurrency)), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
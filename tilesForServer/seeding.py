@@ -0,0 +1,135 @@
+""" Background tile seeding
+
+    Tiles are seeded by requesting their URL from a background
+    thread: tiles are rendered by the server processes with the
+    same pipeline and access controls as client requests.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import queue
+import threading
+import urllib.request
+
+from typing import Dict, Iterable, List, Optional
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.config import getenv, getenv_float, getenv_int
+
+# Header of the seeding requests, seeding requests do not
+# trigger prefetching
+SEED_HEADER = 'X-Tiles-Seed'
+
+
+def fetch_url(url: str, headers: Dict[str, str], timeout: float) -> None:
+    """ Request a tile url
+    """
+    req = urllib.request.Request(url, headers={**headers, SEED_HEADER: '1'})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        resp.read()
+
+
+class Seeder:
+    """ Request tile URLs from a background thread
+
+        URLs are dropped when the queue is full.
+    """
+
+    def __init__(self, max_queue: int = 10000, timeout: float = 30.) -> None:
+        self._queue = queue.Queue(max_queue)
+        self._timeout = timeout
+        self._thread = None
+        self._lock = threading.Lock()
+        self._seeded = 0
+        self._errors = 0
+        self._dropped = 0
+
+    @classmethod
+    def from_env(cls) -> 'Seeder':
+        """ Create the seeder from the environment
+
+            * `QGIS_TILES_SEED_QUEUE_SIZE`: maximum number of pending tiles
+            * `QGIS_TILES_SEED_TIMEOUT`: timeout of the tile requests in seconds
+        """
+        return cls(
+            max_queue=getenv_int('QGIS_TILES_SEED_QUEUE_SIZE', 10000),
+            timeout=getenv_float('QGIS_TILES_SEED_TIMEOUT', 30.),
+        )
+
+    def submit(self, urls: Iterable[str], headers: Optional[Dict[str, str]] = None) -> int:
+        """ Queue tile URLs for seeding
+
+            Return the number of queued URLs
+        """
+        headers = headers or {}
+        count = 0
+        for url in urls:
+            try:
+                self._queue.put_nowait((url, headers))
+            except queue.Full:
+                self._dropped += 1
+                continue
+            count += 1
+        if count:
+            self._start()
+        return count
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tiles-seeder", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            url, headers = self._queue.get()
+            try:
+                self.fetch(url, headers)
+                self._seeded += 1
+            except Exception as err:
+                self._errors += 1
+                QgsMessageLog.logMessage(f"Failed to seed tile {url}: {err}", "tilesApi", Qgis.Warning)
+            finally:
+                self._queue.task_done()
+
+    def fetch(self, url: str, headers: Dict[str, str]) -> None:
+        """ Request the tile
+        """
+        fetch_url(url, headers, self._timeout)
+
+    def join(self) -> None:
+        """ Wait for the queued tiles
+        """
+        self._queue.join()
+
+    def stats(self) -> Dict:
+        return {
+            'pending': self._queue.qsize(),
+            'seeded': self._seeded,
+            'errors': self._errors,
+            'dropped': self._dropped,
+        }
+
+
+def seed_headers() -> List[str]:
+    """ Return the names of the request headers forwarded
+        to the seeding requests
+
+        Set with `QGIS_TILES_SEED_HEADERS` as a comma separated list
+        (ie: `Authorization`)
+    """
+    value = getenv('QGIS_TILES_SEED_HEADERS', '')
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+_seeder: Optional[Seeder] = None
+
+
+def seeder() -> Seeder:
+    """ Return the seeder of the process
+    """
+    global _seeder
+    if _seeder is None:
+        _seeder = Seeder.from_env()
+    return _seeder
@@ -0,0 +1,312 @@
+""" Shared memory tile store
+
+    A fixed size, set associative LRU cache in a memory mapped file
+    shared by all the server processes of a host.
+
+    The file holds two tables divided into sets of `ways` slots: a
+    table of small reference slots, mapping the tile keys to content
+    hashes, and a table of data slots keyed by content hash, so that
+    identical tiles are stored once. A key is stored in the set given
+    by its hash and evicts the least recently used slot of the set.
+    Sets are protected by byte range locks on the file, so processes
+    lock only the set they access. A file with another layout is
+    replaced, never resized while other processes map it.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.cache import TileEntry, TileReference, TileStore, content_digest
+from tilesForServer.config import getenv, getenv_int
+
+MAGIC = b'QTILSHM2'
+
+# magic, number of sets, ways, slot size, references per data slot
+HEADER = struct.Struct('<8sIIII')
+HEADER_SIZE = 64
+
+# content hash, created, last access, data length
+SLOT_HEADER = struct.Struct('<16sddI')
+SLOT_HEADER_SIZE = 40
+
+# key digest, created, last access, content hash
+REF_SLOT = struct.Struct('<16sdd16s')
+REF_SLOT_SIZE = 48
+
+# Offset of the last access in both slot layouts
+ACCESS_OFFSET = 24
+
+EMPTY_KEY = bytes(16)
+
+# Number of in process locks, fcntl locks do not
+# exclude threads of the same process
+THREAD_LOCKS = 64
+
+
+class SharedMemoryStore(TileStore):
+    """ Shared memory LRU tile store
+    """
+    name = 'shm'
+
+    def __init__(self, path: str, size: int, slot_size: int = 64 * 1024, ways: int = 8,
+                 references: int = 16) -> None:
+        self._path = path
+        self._slot_size = slot_size
+        self._ways = ways
+        self._slot_stride = SLOT_HEADER_SIZE + slot_size
+        self._set_stride = self._slot_stride * ways
+        self._ref_set_stride = REF_SLOT_SIZE * ways
+        references = max(1, references)
+        self._nsets = max(1, (size - HEADER_SIZE) // (self._set_stride + references * self._ref_set_stride))
+        self._nrefsets = self._nsets * references
+        # Reference table first, then data table
+        self._data_offset = HEADER_SIZE + self._nrefsets * self._ref_set_stride
+        self._size = self._data_offset + self._nsets * self._set_stride
+
+        self._thread_locks = [threading.Lock() for _ in range(THREAD_LOCKS)]
+        self._hits = 0
+        self._misses = 0
+        self._too_large = 0
+        self._deduplicated = 0
+
+        header = HEADER.pack(MAGIC, self._nsets, ways, slot_size, references)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            st = os.fstat(fd)
+            if st.st_nlink == 0:
+                # Replaced by another process
+                os.close(fd)
+                continue
+            if st.st_size == 0:
+                os.ftruncate(fd, self._size)
+                os.pwrite(fd, header, 0)
+            elif st.st_size != self._size or os.pread(fd, HEADER.size, 0) != header:
+                # Never truncate a file mapped by other processes: processes
+                # with the previous layout keep their mapping of the old file
+                QgsMessageLog.logMessage(f"Shared memory tile store layout changed, replacing {path}",
+                                         "tilesApi", Qgis.Info)
+                os.unlink(path)
+                os.close(fd)
+                continue
+            break
+        try:
+            self._mm = mmap.mmap(fd, self._size)
+        except BaseException:
+            os.close(fd)
+            raise
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._fd = fd
+
+    @classmethod
+    def from_env(cls) -> Optional['SharedMemoryStore']:
+        """ Create the store from the environment
+
+            * `QGIS_TILES_SHM_CACHE_SIZE`: size in MB, the store is disabled if not set
+            * `QGIS_TILES_SHM_CACHE_PATH`: path of the cache file
+            * `QGIS_TILES_SHM_CACHE_SLOT_SIZE`: maximum tile size in KB
+            * `QGIS_TILES_SHM_CACHE_REFERENCES`: number of tile references per data slot
+        """
+        size = getenv_int('QGIS_TILES_SHM_CACHE_SIZE')
+        if size <= 0:
+            return None
+        return cls(
+            getenv('QGIS_TILES_SHM_CACHE_PATH', '/dev/shm/qgis-tiles-cache'),
+            size * 1024 * 1024,
+            slot_size=getenv_int('QGIS_TILES_SHM_CACHE_SLOT_SIZE', 64) * 1024,
+            references=getenv_int('QGIS_TILES_SHM_CACHE_REFERENCES', 16),
+        )
+
+    def close(self) -> None:
+        self._mm.close()
+        os.close(self._fd)
+
+    def _ref_set(self, key: bytes) -> Tuple[int, int]:
+        index = int.from_bytes(key[:8], 'little') % self._nrefsets
+        return HEADER_SIZE + index * self._ref_set_stride, index
+
+    def _data_set(self, digest: bytes) -> Tuple[int, int]:
+        index = int.from_bytes(digest[:8], 'little') % self._nsets
+        return self._data_offset + index * self._set_stride, index
+
+    def _lock(self, offset: int, index: int):
+        # Locks of the two tables are never held together
+        return _SetLock(self._fd, offset, self._thread_locks[index % THREAD_LOCKS])
+
+    def _find(self, offset: int, key: bytes, stride: int) -> Optional[int]:
+        mm = self._mm
+        for way in range(self._ways):
+            slot = offset + way * stride
+            if mm[slot:slot + 16] == key:
+                return slot
+        return None
+
+    def _evict(self, offset: int, stride: int) -> int:
+        """ Return an empty slot of the set or the least recently used
+        """
+        mm = self._mm
+        lru = slot = None
+        for way in range(self._ways):
+            candidate = offset + way * stride
+            if mm[candidate:candidate + 16] == EMPTY_KEY:
+                return candidate
+            accessed = struct.unpack_from('<d', mm, candidate + ACCESS_OFFSET)[0]
+            if lru is None or accessed < lru:
+                lru = accessed
+                slot = candidate
+        return slot
+
+    def _get_data(self, digest: bytes) -> Optional[bytes]:
+        offset, index = self._data_set(digest)
+        mm = self._mm
+        with self._lock(offset, index):
+            slot = self._find(offset, digest, self._slot_stride)
+            if slot is None:
+                return None
+            length = SLOT_HEADER.unpack_from(mm, slot)[3]
+            start = slot + SLOT_HEADER_SIZE
+            data = mm[start:start + length]
+            struct.pack_into('<d', mm, slot + ACCESS_OFFSET, time.time())
+        return data
+
+    def get(self, key: bytes) -> Optional[TileEntry]:
+        """ Return the entry for key
+
+            Data is copied out of the shared memory while holding
+            the set lock. References to evicted data are misses.
+        """
+        offset, index = self._ref_set(key)
+        mm = self._mm
+        with self._lock(offset, index):
+            slot = self._find(offset, key, REF_SLOT_SIZE)
+            if slot is None:
+                self._misses += 1
+                return None
+            _, created, _, digest = REF_SLOT.unpack_from(mm, slot)
+            struct.pack_into('<d', mm, slot + ACCESS_OFFSET, time.time())
+        data = self._get_data(digest)
+        if data is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return TileEntry(data, created, digest)
+
+    def get_reference(self, key: bytes) -> Optional[TileReference]:
+        """ Return the reference of key, without reading the data
+        """
+        offset, index = self._ref_set(key)
+        with self._lock(offset, index):
+            slot = self._find(offset, key, REF_SLOT_SIZE)
+            if slot is None:
+                return None
+            _, created, _, digest = REF_SLOT.unpack_from(self._mm, slot)
+        return TileReference(created, digest)
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        """ Check which keys are stored, without reading the data
+        """
+        result = []
+        for key in keys:
+            offset, index = self._ref_set(key)
+            with self._lock(offset, index):
+                slot = self._find(offset, key, REF_SLOT_SIZE)
+                digest = REF_SLOT.unpack_from(self._mm, slot)[3] if slot is not None else None
+            if digest is not None:
+                offset, index = self._data_set(digest)
+                with self._lock(offset, index):
+                    result.append(self._find(offset, digest, self._slot_stride) is not None)
+            else:
+                result.append(False)
+        return result
+
+    def set(self, key: bytes, data: bytes, created: Optional[float] = None,
+            digest: Optional[bytes] = None) -> None:
+        """ Store data for key, evict the least recently used
+            slots of the sets if needed
+
+            Data already stored for another key is not copied again.
+        """
+        length = len(data)
+        if length > self._slot_size:
+            self._too_large += 1
+            return
+        digest = digest or content_digest(data)
+        now = time.time()
+        created = created or now
+        mm = self._mm
+
+        offset, index = self._data_set(digest)
+        with self._lock(offset, index):
+            slot = self._find(offset, digest, self._slot_stride)
+            if slot is None:
+                slot = self._evict(offset, self._slot_stride)
+                start = slot + SLOT_HEADER_SIZE
+                mm[start:start + length] = data
+                SLOT_HEADER.pack_into(mm, slot, digest, created, now, length)
+            else:
+                self._deduplicated += 1
+                struct.pack_into('<d', mm, slot + ACCESS_OFFSET, now)
+
+        offset, index = self._ref_set(key)
+        with self._lock(offset, index):
+            slot = self._find(offset, key, REF_SLOT_SIZE)
+            if slot is None:
+                slot = self._evict(offset, REF_SLOT_SIZE)
+            REF_SLOT.pack_into(mm, slot, key, created, now, digest)
+
+    def delete(self, key: bytes) -> None:
+        """ Delete the reference of key, data is evicted when
+            no longer used
+        """
+        offset, index = self._ref_set(key)
+        with self._lock(offset, index):
+            slot = self._find(offset, key, REF_SLOT_SIZE)
+            if slot is not None:
+                REF_SLOT.pack_into(self._mm, slot, EMPTY_KEY, 0., 0., EMPTY_KEY)
+
+    def stats(self) -> Dict:
+        return {
+            'path': self._path,
+            'size': self._size,
+            'slots': self._nsets * self._ways,
+            'slotSize': self._slot_size,
+            'references': self._nrefsets * self._ways,
+            'hits': self._hits,
+            'misses': self._misses,
+            'tooLarge': self._too_large,
+            'deduplicated': self._deduplicated,
+        }
+
+
+class _SetLock:
+    """ Lock a set for both threads and processes
+    """
+
+    def __init__(self, fd: int, offset: int, thread_lock: threading.Lock) -> None:
+        self._fd = fd
+        self._offset = offset
+        self._thread_lock = thread_lock
+
+    def __enter__(self) -> None:
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._offset)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def __exit__(self, *exc) -> None:
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset)
+        finally:
+            self._thread_lock.release()
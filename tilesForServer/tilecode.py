@@ -0,0 +1,87 @@
+""" Compact tile codes
+
+    A tile code is an integer of at most 64 bits: the Morton code of
+    the column and the row of the tile, interleaving their bits, below
+    a sentinel bit giving the zoom level. Tile matrices with more than
+    one tile at level 0 use `root_bits` more bits per axis.
+
+    Parents, children and descendants are bit operations:
+
+    * parent: `code >> 2`
+    * children: `(code << 2) | i` for i in 0..3
+    * descendants at `d` levels below: the range `[code << 2d, (code + 1) << 2d)`
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+from typing import List, Tuple
+
+# Maximum zoom level plus root bits of a 64-bit code
+MAX_LEVEL = 31
+
+
+def _spread(v: int) -> int:
+    """ Insert a zero bit between the bits of v
+    """
+    v &= 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def _compact(v: int) -> int:
+    """ Remove the odd bits of v
+    """
+    v &= 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+    return v
+
+
+def tile_code(zoom: int, col: int, row: int, root_bits: int = 0) -> int:
+    """ Return the code of the tile
+    """
+    level = zoom + root_bits
+    if not 0 <= level <= MAX_LEVEL:
+        raise ValueError(f"Zoom level {zoom} out of range")
+    return (1 << (2 * level)) | _spread(col) | (_spread(row) << 1)
+
+
+def tile_from_code(code: int, root_bits: int = 0) -> Tuple[int, int, int]:
+    """ Return the zoom level, the column and the row of the tile code
+    """
+    level = (code.bit_length() - 1) // 2
+    morton = code ^ (1 << (2 * level))
+    return level - root_bits, _compact(morton), _compact(morton >> 1)
+
+
+def tile_zoom(code: int, root_bits: int = 0) -> int:
+    """ Return the zoom level of the tile code
+    """
+    return (code.bit_length() - 1) // 2 - root_bits
+
+
+def parent_tile(code: int, levels: int = 1) -> int:
+    """ Return the code of the ancestor of the tile levels above
+    """
+    return code >> (2 * levels)
+
+
+def child_tiles(code: int) -> List[int]:
+    """ Return the codes of the children of the tile
+    """
+    code <<= 2
+    return [code, code | 1, code | 2, code | 3]
+
+
+def descendant_range(code: int, levels: int) -> Tuple[int, int]:
+    """ Return the range of the codes of the descendants
+        of the tile levels below, end excluded
+    """
+    return code << (2 * levels), (code + 1) << (2 * levels)
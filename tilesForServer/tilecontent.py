@@ -0,0 +1,685 @@
+""" Tile content rendering shared by the tiles APIs
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import tempfile
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from qgis.core import (  # QgsVectorTileMVTEncoder, #define SIP_NO_FILE
+    Qgis,
+    QgsDataSourceUri,
+    QgsFeedback,
+    QgsMapLayer,
+    QgsMessageLog,
+    QgsTileMatrix,
+    QgsTileXYZ,
+    QgsVectorTileWriter,
+)
+from qgis.PyQt.QtCore import QUrl
+from qgis.server import (
+    QgsBufferServerRequest,
+    QgsServerProjectUtils,
+    QgsServerRequest,
+)
+
+from tilesForServer.accesscontrol import (
+    PUBLIC,
+    access_control_key,
+    authorized_attributes,
+    partition_forwarded,
+)
+from tilesForServer.accesslog import timeout_log
+from tilesForServer.admission import admission
+from tilesForServer.apiutils import HTTPError, RequestHandler
+from tilesForServer.cache import (
+    TileEntry,
+    content_digest,
+    tile_code_key,
+    tile_key,
+    tile_namespace,
+    tile_stores,
+)
+from tilesForServer.catalog import ProjectParser
+from tilesForServer.config import getenv_float, getenv_int
+from tilesForServer.coverage import TILE_BUFFER, coverage_index
+from tilesForServer.encoders import EncodingOptions, encode_tile, sniff_mimetype
+from tilesForServer.featurefetch import FetchedLayer, copy_layer, feature_fetcher
+from tilesForServer.fingerprint import previous_fingerprint, project_fingerprint
+from tilesForServer.generation import invalidation_time, tilemap_generation
+from tilesForServer.prefetch import prefetcher
+from tilesForServer.render import (
+    RenderTimeout,
+    access_control_subsets,
+    get_map_settings,
+    render_deadline,
+    render_image,
+)
+from tilesForServer.seeding import SEED_HEADER, seed_headers, seeder
+from tilesForServer.tilecode import child_tiles, tile_code, tile_from_code
+from tilesForServer.tilematrix import TileMatrixSet
+from tilesForServer.vectorfilters import FALSE, layer_in_scale_range, renderer_filter
+from tilesForServer.writeback import writeback
+
+# Cache key formats of extensions sharing the same mimetype
+CACHE_FORMATS = {
+    'png8': 'image/png; mode=8bit',
+    'mixed': 'image/png; mode=mixed',
+}
+
+# Stale tiles are revalidated once per process and per interval in seconds
+REVALIDATION_INTERVAL = 60
+
+_revalidations = OrderedDict()
+_revalidations_size = 10000
+
+
+def prefetch_candidates(tms: TileMatrixSet, namespace: int, code: int, maxzoom: int,
+                        tile_url: Callable[[int, int, int], str]) -> List[str]:
+    """ Return the URLs of the adjacent tiles and the children
+        of the tile which are not in the tile stores
+    """
+    z, x, y = tile_from_code(code, tms.root_bits)
+    neighbours = [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]
+    codes = [tile_code(z, col, row, tms.root_bits) for col, row in neighbours if tms.contains(z, col, row)]
+    if z < maxzoom:
+        codes.extend(child_tiles(code))
+
+    stores = tile_stores()
+    if stores:
+        keys = [tile_code_key(namespace, c) for c in codes]
+        cached = [False] * len(keys)
+        for store in stores:
+            cached = [a or b for a, b in zip(cached, store.contains_many(keys))]
+        codes = [c for c, is_cached in zip(codes, cached) if not is_cached]
+
+    return [tile_url(*tile_from_code(c, tms.root_bits)) for c in codes]
+
+
+class TileContentHandler(RequestHandler, ProjectParser, ABC):
+    """ Base class for tile content handlers
+
+        Subclasses extract the tile parameters from the request,
+        call `send_tile` and implement `tile_url`.
+    """
+    def initialize(self, srv_iface, **kwargs ) -> None:
+        """ override
+        """
+        super().initialize(**kwargs)
+        self._srv_iface = srv_iface
+
+    def getVectorTile320(self, tile: QgsTileXYZ, writer: QgsVectorTileWriter,
+                         tilematrix: QgsTileMatrix, feedback: Optional[QgsFeedback] = None) -> bytes:
+        """ Build vector tile for qgis version <= 3.20
+        """
+        writer.setExtent(tilematrix.tileExtent(tile))
+
+        tmp_dir = tempfile.gettempdir()
+        ds = QgsDataSourceUri()
+        ds.setParam("type", "xyz" )
+        ds.setParam("url", QUrl.fromLocalFile(tmp_dir).toString() + '/{z}-{x}-{y}.pbf' )
+
+        writer.setDestinationUri(bytes(ds.encodedUri()).decode())
+        if not writer.writeTiles(feedback):
+            raise HTTPError(500, writer.errorMessage())
+
+        pbf_path = Path(tmp_dir,f'{tile.zoomLevel()}-{tile.column()}-{tile.row()}.pbf')
+        if not pbf_path.exists():
+            raise HTTPError(500, 'Error generating vector tile')
+
+        try:
+            with pbf_path.open('rb+') as pbf:
+                return pbf.read()
+        finally:
+            pbf_path.unlink()
+
+    def _get_vector_tile(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                         vectorlayers: List[QgsMapLayer], access_controls,
+                         feedback: Optional[QgsFeedback] = None) -> bytes:
+        """ Build vector tile
+
+            Layers out of the scale range of the tile are left out.
+            With the `rendererFilters` tile map option, features are
+            filtered by the rule-based renderer of the layers.
+            Access control filters are applied to the features and
+            only the authorized attributes are written. With the
+            `concurrentFetch` tile map option, the features of the layers
+            are fetched concurrently and only the encoding is serialized.
+            Raise RenderTimeout when the feedback is canceled.
+        """
+        tilematrix = tms.tile_matrix(tile.zoomLevel())
+        if tilematrix is None:
+            raise HTTPError(400, reason=f"Vector tiles are not supported for tile matrix set {tms.identifier}")
+
+        filtered = self.vector_tile_layers(tilemapid, tms.scale(tile.zoomLevel()), vectorlayers, access_controls)
+        if not filtered:
+            # Empty tile
+            return b''
+
+        writer = QgsVectorTileWriter()
+        writer.setMaxZoom(tile.zoomLevel())
+        writer.setMinZoom(tile.zoomLevel())
+
+        if Qgis.QGIS_VERSION_INT >= 32200:
+            writer.setRootTileMatrix(tms.tile_matrix(0))
+
+        fetcher = feature_fetcher() if self.tilemap_options(tilemapid).get_bool('concurrentFetch') else None
+        extent = tms.tile_extent(tile.zoomLevel(), tile.column(), tile.row())
+        extent.grow(extent.width() * TILE_BUFFER)
+        with access_control_subsets(vectorlayers, access_controls):
+            layers = []
+            # Memory layers are referenced until the tile is written
+            fetched = []
+            if fetcher is not None and len(filtered) > 1:
+                fetched = fetcher.fetch_layers(self.project, filtered, extent, tms.crs, feedback)
+                layers = [QgsVectorTileWriter.Layer(ml) for ml in fetched]
+            else:
+                for vl, expression, attributes in filtered:
+                    if attributes is not None:
+                        # The writer encodes all the fields of its layers
+                        fetched.append(copy_layer(self.project, vl, expression, attributes, extent,
+                                                  tms.crs, feedback))
+                        layers.append(QgsVectorTileWriter.Layer(fetched[-1]))
+                        continue
+                    layer = QgsVectorTileWriter.Layer(vl)
+                    if expression:
+                        layer.setFilterExpression(expression)
+                    layers.append(layer)
+            writer.setLayers(layers)
+
+            if Qgis.QGIS_VERSION_INT >= 32100:
+                data = writer.writeSingleTile(tile, feedback).data()
+            else:
+                data = self.getVectorTile320(tile, writer, tilematrix, feedback)
+
+        if feedback is not None and feedback.isCanceled():
+            raise RenderTimeout()
+
+        return data
+
+    def vector_tile_layers(self, tilemapid: str, scale: float, vectorlayers: List[QgsMapLayer],
+                           access_controls) -> List[FetchedLayer]:
+        """ Return the layers of the vector tile at scale with their
+            filter expression and their authorized attributes
+        """
+        use_renderer = self.tilemap_options(tilemapid).get_bool('rendererFilters')
+
+        filtered = []
+        for vl in vectorlayers:
+            if not layer_in_scale_range(vl, scale):
+                continue
+            expressions = []
+            if use_renderer:
+                expression = renderer_filter(vl.renderer(), scale)
+                if expression == FALSE:
+                    continue
+                if expression:
+                    expressions.append(expression)
+            attributes = None
+            if access_controls:
+                expression = access_controls.layerFilterExpression(vl)
+                if expression:
+                    expressions.append(expression)
+                attributes = authorized_attributes(vl, access_controls)
+            filtered.append((vl, ' AND '.join(f"({e})" for e in expressions) if expressions else None,
+                             attributes))
+        return filtered
+
+    def get_tile_request(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                         extension: str, mimetype: str, acl_key: str = PUBLIC) -> QgsBufferServerRequest:
+        """ Build the WMTS request used as cache key
+        """
+        parameters = {
+            "MAP": self.project.fileName(),
+            "SERVICE": "WMTS",
+            "VERSION": "1.0.0",
+            "REQUEST": "GetTile",
+            "LAYER": tilemapid,
+            "STYLE": "",
+            "TILEMATRIXSET": tms.identifier,
+            "TILEMATRIX": tile.zoomLevel(),
+            "TILEROW": tile.row(),
+            "TILECOL": tile.column(),
+            "FORMAT": CACHE_FORMATS.get(extension, mimetype),
+            # Tiles of previous versions of the project are never hit
+            "FINGERPRINT": project_fingerprint(self.project),
+        }
+        if acl_key != PUBLIC:
+            parameters["GENERATION"] = tilemap_generation(self.project, tilemapid)
+
+        qs = f"?{'&'.join('%s=%s' % item for item in parameters.items())}"
+        return QgsBufferServerRequest(qs, QgsServerRequest.GetMethod, {}, None)
+
+    def send_tile(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ, extension: str) -> None:
+        """ Write the tile content
+        """
+        project = self.project
+
+        self.log_values(tilemap=tilemapid, tms=tms.identifier, z=tile.zoomLevel(),
+                        x=tile.column(), y=tile.row(), format=extension)
+
+        info = self.get_tilemap_info(tilemapid)
+        if not info:
+            raise HTTPError(404, reason=f"Tile map '{tilemapid}' not found")
+
+        mimetype = self.mimetypeFromExtension(extension)
+        if not mimetype:
+            raise HTTPError(400, reason='Unknown extension')
+
+        if extension == 'jpeg':
+            extension = 'jpg'
+        if extension not in info['formats']:
+            raise HTTPError(400, reason=f"Format '{extension}' not available for tile map '{tilemapid}'")
+
+        if not tms.contains(tile.zoomLevel(), tile.column(), tile.row()):
+            raise HTTPError(400, reason="Tile out of tile matrix set range")
+
+        if extension == 'pbf':
+            maxzoom = self.vector_maxzoom(tilemapid, tms)
+            if tile.zoomLevel() > maxzoom:
+                self.redirect_overzoom(tilemapid, tms, tile, maxzoom)
+                return
+
+        iface = self.server_interface
+        access_controls = iface.accessControls()
+
+        layers = self.content_layers(tilemapid, extension)
+        self.check_read_permissions(layers, access_controls)
+
+        acl_key = self.access_control_key(layers, access_controls)
+        if acl_key == PUBLIC:
+            # No restriction applies: tiles are shared by all the users
+            access_controls = None
+
+        key = self.tile_cache_key(tilemapid, tms, tile, extension, acl_key)
+
+        self.prefetch_around(tilemapid, tms, tile, extension, acl_key)
+
+        # Answer conditional requests before rendering
+        if self._request.header('If-None-Match'):
+            etag = self.stored_etag(tilemapid, key)
+            if etag is not None and self.check_etag(etag):
+                self.log_values(cache='not-modified')
+                return
+
+        digest = None
+        if extension == 'pbf' and not self.tile_covered(tilemapid, tms, tile):
+            # No feature in the tile
+            data, cache_status = b'', 'empty'
+        else:
+            # Get tile from the tile stores
+            entry, cache_status = self.get_cached_tile(tilemapid, tms, tile, extension, acl_key, key)
+            data, digest = (entry.data, entry.digest) if entry is not None else (None, None)
+        if data is None:
+            # Get tile from the cache manager
+            req = self.get_tile_request(tilemapid, tms, tile, extension, mimetype, acl_key)
+            data = iface.cacheManager().getCachedImage(project, req, access_controls).data()
+            if data:
+                cache_status = 'cache-manager'
+            else:
+                data, mimetype = self.render_tile(tilemapid, tms, tile, extension, mimetype,
+                                                  layers, access_controls)
+                # Register image in cache
+                iface.cacheManager().setCachedImage(data, project, req, access_controls)
+            digest = content_digest(data)
+            self.store_tile(key, data, digest)
+
+        # The entity tag is the content hash: tiles left unchanged
+        # by a new version of the project keep their entity tag.
+        # Without tile store, it is given by the key of the tile.
+        etag = (digest or content_digest(data)).hex() if tile_stores() else self.key_etag(tilemapid, key)
+        if self.check_etag(etag):
+            self.log_values(cache='not-modified')
+            return
+
+        if cache_status != 'miss' and extension == 'mixed':
+            mimetype = sniff_mimetype(data)
+
+        self.set_header('Content-Type', mimetype)
+        self.set_header('X-Tiles-Cache', cache_status)
+        self.log_values(cache=cache_status)
+        self.write(data)
+
+    def content_layers(self, tilemapid: str, extension: str) -> List[QgsMapLayer]:
+        """ Return the layers of the tile content
+        """
+        if extension == 'pbf':
+            return list(self.tilemap_vectorlayers(tilemapid))
+        return self.tilemap_layers(tilemapid)
+
+    def render_tile(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ, extension: str,
+                    mimetype: str, layers: List[QgsMapLayer], access_controls) -> Tuple[bytes, str]:
+        """ Render the tile in a render slot of the tile map, within the
+            render deadline
+
+            Return the tile data and its mimetype
+        """
+        timeout = self.render_timeout(tilemapid)
+        with self.render_slot(tilemapid), render_deadline(timeout) as feedback:
+            try:
+                if extension == 'pbf':
+                    data = self._get_vector_tile(tilemapid, tms, tile, layers, access_controls, feedback)
+                    return data, mimetype
+                return self._get_raster_tile(tilemapid, tms, tile, extension, layers, access_controls, feedback)
+            except RenderTimeout:
+                self.record_timeout(tilemapid, tms, tile, extension, timeout)
+                raise HTTPError(504, f"Tile render exceeded {timeout}s", reason="Tile render timeout") from None
+
+    def render_timeout(self, tilemapid: str) -> float:
+        """ Return the render deadline of the tiles of the tile map in seconds
+
+            Set with the `renderTimeout` tile map option or
+            `QGIS_TILES_RENDER_TIMEOUT`, renders are not bounded if 0
+        """
+        return self.tilemap_options(tilemapid).get_float('renderTimeout',
+                                                         getenv_float('QGIS_TILES_RENDER_TIMEOUT', 0.))
+
+    def record_timeout(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                       extension: str, timeout: float) -> None:
+        """ Record the timed out tile for seeding offline
+        """
+        QgsMessageLog.logMessage(f"Render of tile {tilemapid}/{tms.identifier}/{tile.zoomLevel()}/"
+                                 f"{tile.column()}/{tile.row()}.{extension} exceeded {timeout}s",
+                                 "tilesApi", Qgis.Warning)
+        self.log_values(timeout=True)
+        log = timeout_log()
+        if log is None:
+            return
+        url = self._request.url()
+        log.log({
+            'time': time.time(),
+            'method': 'get',
+            'path': url.path(),
+            'query': url.query(),
+            'project': self.project.fileName(),
+            'tilemap': tilemapid,
+            'tms': tms.identifier,
+            'z': tile.zoomLevel(),
+            'x': tile.column(),
+            'y': tile.row(),
+            'format': extension,
+            'timeout': timeout,
+        })
+
+    def render_slot(self, tilemapid: str):
+        """ Return the context holding a render slot of the tile map
+
+            The number of slots is set by the `maxRenders` tile map option.
+            Seeding requests do not wait for a slot.
+        """
+        control = admission()
+        slots = self.tilemap_options(tilemapid).get_int('maxRenders', control.slots)
+        name = tile_key(self.project.fileName(), tilemapid).hex()
+        return control.admit(name, slots, queue=not self._request.header(SEED_HEADER))
+
+    def coverage_zoom(self, tilemapid: str) -> int:
+        """ Return the base zoom level of the coverage index
+            of the tile map, -1 if disabled
+        """
+        return self.tilemap_options(tilemapid).get_int('coverageZoom', -1)
+
+    def tile_covered(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ) -> bool:
+        """ Check the coverage index of the vector tile map
+
+            Tiles are covered if the coverage index is disabled
+            or not built
+        """
+        zoom = self.coverage_zoom(tilemapid)
+        if zoom < 0 or tile.zoomLevel() < zoom:
+            return True
+        index = coverage_index(self.project, tilemapid, tms, zoom)
+        return index is None or index.covers(tile.zoomLevel(), tile.column(), tile.row())
+
+    def tile_cache_key(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                       extension: str, acl_key: str, fingerprint: Optional[str] = None) -> bytes:
+        """ Return the tile stores key of the tile
+
+            The key is given for the current version of the project
+            or for the version of `fingerprint`
+        """
+        namespace = self.cache_namespace(tilemapid, tms, extension, acl_key, fingerprint)
+        return tile_code_key(namespace, tile_code(tile.zoomLevel(), tile.column(), tile.row(), tms.root_bits))
+
+    def cache_namespace(self, tilemapid: str, tms: TileMatrixSet, extension: str, acl_key: str,
+                        fingerprint: Optional[str] = None) -> int:
+        """ Return the namespace id of the tile stores keys of the tile map
+
+            Restricted partitions include the generation of the tile map
+        """
+        project = self.project
+        generation = tilemap_generation(project, tilemapid) if acl_key != PUBLIC else 0
+        return tile_namespace(project.fileName(), fingerprint or project_fingerprint(project),
+                              tilemapid, tms.identifier, extension, acl_key, generation)
+
+    def store_tile(self, key: bytes, data: bytes, digest: Optional[bytes] = None) -> None:
+        """ Write the tile to the tile stores
+
+            Writes are handed to the background writer if enabled
+        """
+        stores = tile_stores()
+        if not stores:
+            return
+
+        created = time.time()
+
+        def write():
+            for store in stores:
+                store.set(key, data, created, digest)
+
+        writer = writeback()
+        if writer is None:
+            write()
+        else:
+            writer.submit(key, write)
+
+    def get_stored_tile(self, key: bytes) -> Tuple[Optional[TileEntry], str]:
+        """ Return the tile entry from the first tile store holding it
+
+            The tile is copied to the stores checked before.
+        """
+        stores = tile_stores()
+        for i, store in enumerate(stores):
+            entry = store.get(key)
+            if entry is not None:
+                for upper in stores[:i]:
+                    upper.set(key, entry.data, entry.created, entry.digest)
+                return entry, store.name
+        return None, 'miss'
+
+    def stale_limits(self, tilemapid: str) -> Tuple[int, int]:
+        """ Return the `maxAge` and `maxStale` options of the tile map,
+            0 if not set
+        """
+        options = self.tilemap_options(tilemapid)
+        return (options.get_int('maxAge', getenv_int('QGIS_TILES_MAX_AGE')),
+                options.get_int('maxStale', getenv_int('QGIS_TILES_MAX_STALE')))
+
+    def key_etag(self, tilemapid: str, key: bytes) -> str:
+        """ Return the entity tag of the tile key, changed by
+            each invalidation of the tile map
+        """
+        return tile_key(key.hex(), tilemap_generation(self.project, tilemapid)).hex()
+
+    def stored_etag(self, tilemapid: str, key: bytes) -> Optional[str]:
+        """ Return the entity tag of the tile without reading nor
+            rendering the tile, None if unknown
+
+            The entity tag is the content hash of the stored tile read
+            from the references of the tile stores, or given by the key
+            of the tile without tile store.
+        """
+        stores = tile_stores()
+        if not stores:
+            return self.key_etag(tilemapid, key)
+        max_age, max_stale = self.stale_limits(tilemapid)
+        for store in stores:
+            reference = store.get_reference(key)
+            if reference is None:
+                continue
+            if max_age > 0 and max_stale > 0 and time.time() - reference.created > max_age + max_stale:
+                # Rendered again
+                return None
+            return reference.digest.hex()
+        return None
+
+    def get_cached_tile(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ, extension: str,
+                        acl_key: str, key: bytes) -> Tuple[Optional[TileEntry], str]:
+        """ Return the tile entry from the tile stores
+
+            Stale tiles, older than the `maxAge` tile map option or
+            from the previous version of the project, are returned at
+            once and revalidated in the background. Tiles of the previous
+            version are only looked up when `maxAge` or `maxStale` is set,
+            and never when the tile map was invalidated since they were
+            stored. Seeding requests never get stale tiles, nor requests
+            of restricted partitions which can not be revalidated with
+            the forwarded headers.
+        """
+        entry, cache_status = self.get_stored_tile(key)
+        max_age, max_stale = self.stale_limits(tilemapid)
+        if entry is not None and (max_age <= 0 or time.time() - entry.created <= max_age):
+            return entry, cache_status
+
+        if self._request.header(SEED_HEADER) or not partition_forwarded(acl_key, seed_headers()):
+            return None, 'miss'
+
+        if entry is None:
+            previous = previous_fingerprint(self.project)
+            if previous is None or (max_age <= 0 and max_stale <= 0):
+                return None, cache_status
+            entry, cache_status = self.get_stored_tile(
+                self.tile_cache_key(tilemapid, tms, tile, extension, acl_key, previous))
+            if entry is None or entry.created <= invalidation_time(self.project, tilemapid):
+                return None, 'miss'
+
+        age = int(time.time() - entry.created)
+        if max_stale > 0 and age > max(max_age, 0) + max_stale:
+            return None, 'miss'
+
+        self.revalidate_tile(tilemapid, tms, tile, extension, key)
+        self.set_header('X-Tiles-Stale', str(age))
+        self.log_values(stale=age)
+        return entry, cache_status
+
+    def revalidate_tile(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                        extension: str, key: bytes) -> None:
+        """ Render the tile again in the background
+
+            A tile is revalidated once per process until the
+            revalidation interval is elapsed.
+        """
+        now = time.monotonic()
+        if _revalidations.get(key, 0) > now:
+            return
+        _revalidations[key] = now + REVALIDATION_INTERVAL
+        if len(_revalidations) > _revalidations_size:
+            _revalidations.popitem(last=False)
+        seeder().submit([self.tile_href(tilemapid, tms, tile, extension)], self.forwarded_headers())
+
+    def access_control_key(self, layers: List[QgsMapLayer], access_controls) -> str:
+        """ Return the cache partition of the request for the layers
+        """
+        return access_control_key(layers, access_controls, self._request)
+
+    def prefetch_around(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                        extension: str, acl_key: str) -> None:
+        """ Queue the prefetch of the adjacent tiles and the children
+            of the tile which are not in the tile stores
+
+            Tiles of restricted partitions are prefetched only if
+            the prefetch requests get the same partition.
+        """
+        prefetch = prefetcher()
+        if prefetch is None or self._request.header(SEED_HEADER):
+            return
+        if not partition_forwarded(acl_key, seed_headers()):
+            return
+
+        z, x, y = tile.zoomLevel(), tile.column(), tile.row()
+        namespace = self.cache_namespace(tilemapid, tms, extension, acl_key)
+        code = tile_code(z, x, y, tms.root_bits)
+        hits = prefetch.hit((namespace, code))
+        if not prefetch.accepts(hits):
+            return
+
+        maxzoom = self.vector_maxzoom(tilemapid, tms) if extension == 'pbf' else tms.last_level
+        candidates = partial(prefetch_candidates, tms, namespace, code, maxzoom,
+                             self.tile_url(tilemapid, tms, extension))
+        prefetch.expand(tilemapid, hits, candidates, self.forwarded_headers())
+
+    def forwarded_headers(self) -> Dict[str, str]:
+        """ Return the request headers forwarded to the seeding requests
+        """
+        headers = {}
+        for name in seed_headers():
+            value = self._request.header(name)
+            if value:
+                headers[name] = value
+        return headers
+
+    def tile_href(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ, extension: str) -> str:
+        """ Return the URL of a tile
+        """
+        return self.tile_url(tilemapid, tms, extension)(tile.zoomLevel(), tile.column(), tile.row())
+
+    @abstractmethod
+    def tile_url(self, tilemapid: str, tms: TileMatrixSet, extension: str) -> Callable[[int, int, int], str]:
+        """ Return a function of `z, x, y` building the URLs of the tiles
+
+            The function does not use the request, it may be called
+            from other threads.
+        """
+
+    def redirect_overzoom(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ, maxzoom: int) -> None:
+        """ Redirect to the ancestor tile at maxzoom
+
+            Vector tiles above the tile map maxzoom are never
+            encoded: clients have to overzoom the ancestor tile.
+        """
+        dz = tile.zoomLevel() - maxzoom
+        parent = QgsTileXYZ(tile.column() >> dz, tile.row() >> dz, maxzoom)
+        self.set_status(302)
+        self.set_header('Location', self.tile_href(tilemapid, tms, parent, 'pbf'))
+        self.set_header('X-Tiles-Overzoom', str(maxzoom))
+        self.finish()
+
+    def check_read_permissions(self, layers: List[QgsMapLayer], access_controls) -> None:
+        """ Check that the layers are readable as the WMS service does
+        """
+        if not access_controls:
+            return
+        for layer in layers:
+            if not access_controls.layerReadPermission(layer):
+                raise HTTPError(403, reason=f"You are not allowed to access to the layer: {layer.name()}")
+
+    def _get_raster_tile(self, tilemapid: str, tms: TileMatrixSet, tile: QgsTileXYZ,
+                         extension: str, layers: List[QgsMapLayer], access_controls,
+                         feedback: Optional[QgsFeedback] = None) -> Tuple[bytes, str]:
+        """ Render raster tile
+
+            Return the encoded tile and its mimetype
+        """
+        project = self.project
+        transparent = extension not in ('jpg', 'jpeg')
+        settings = get_map_settings(project, tilemapid, tms, layers, transparent)
+        image = render_image(settings, tms.tile_extent(tile.zoomLevel(), tile.column(), tile.row()),
+                             access_controls, feedback)
+        options = EncodingOptions.from_tilemap(self.tilemap_options(tilemapid),
+                                               QgsServerProjectUtils.wmsImageQuality(project))
+        return encode_tile(image, extension, options)
+
+    @staticmethod
+    def parse_tile(tilematrixid: str, tilecolid: str, tilerowid: str) -> QgsTileXYZ:
+        """ Return the tile from the path values
+        """
+        try:
+            return QgsTileXYZ(int(tilecolid), int(tilerowid), int(tilematrixid))
+        except ValueError as err:
+            raise HTTPError(400, f"Parameters error: {err}", reason="Invalid parameters") from None
+
@@ -0,0 +1,226 @@
+""" Tile matrix sets built from the project WMTS grids
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import math
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from qgis.core import (
+    Qgis,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsPointXY,
+    QgsProject,
+    QgsRectangle,
+    QgsTileMatrix,
+    QgsUnitTypes,
+)
+
+# OGC standardized rendering pixel size (0.28mm)
+OGC_PX_M = 0.00028
+TILE_SIZE = 256
+
+# Default grids definition used by the WMTS service
+# (top, left, scale denominator, last level)
+DEFAULT_GRIDS = {
+    'EPSG:3857': (20037508.3427892480, -20037508.3427892480, 559082264.0287178, 18),
+    'EPSG:4326': (90.0, -180.0, 279541132.0143588675, 18),
+}
+
+DEFAULT_TILE_MATRIX_SET = 'EPSG:3857'
+
+
+class TileMatrixSet:
+    """ Tile matrix set definition for a WMTS grid
+    """
+
+    def __init__(self, crs: QgsCoordinateReferenceSystem, top: float, left: float,
+                 scale_denominator: float, last_level: int) -> None:
+        self.identifier = crs.authid()
+        self.crs = crs
+        self.top = top
+        self.left = left
+        self.scale_denominator = scale_denominator
+        self.last_level = last_level
+
+        units_per_meter = QgsUnitTypes.fromUnitToUnitFactor(QgsUnitTypes.DistanceMeters, crs.mapUnits())
+        # Tile dimension in map units at level 0
+        self.tile_dimension = TILE_SIZE * scale_denominator * OGC_PX_M * units_per_meter
+
+        # Matrix size at level 0
+        extent = crs_extent(crs)
+        self.matrix_width = max(1, math.ceil((extent.xMaximum() - left) / self.tile_dimension - 1e-6))
+        self.matrix_height = max(1, math.ceil((top - extent.yMinimum()) / self.tile_dimension - 1e-6))
+
+        # Bits of the tile codes for the tiles at level 0
+        self.root_bits = max(self.matrix_width - 1, self.matrix_height - 1).bit_length()
+
+    def scale(self, zoom: int) -> float:
+        """ Return the scale denominator at zoom level
+        """
+        return self.scale_denominator / (1 << zoom)
+
+    def matrix_size(self, zoom: int) -> Tuple[int, int]:
+        """ Return the matrix width and height at zoom level
+        """
+        return (self.matrix_width << zoom, self.matrix_height << zoom)
+
+    def contains(self, zoom: int, col: int, row: int) -> bool:
+        """ Check that the tile is in the tile matrix set
+        """
+        if not 0 <= zoom <= self.last_level:
+            return False
+        width, height = self.matrix_size(zoom)
+        return 0 <= col < width and 0 <= row < height
+
+    def tile_extent(self, zoom: int, col: int, row: int) -> QgsRectangle:
+        """ Return the tile extent in the tile matrix set crs
+        """
+        size = self.tile_dimension / (1 << zoom)
+        xmin = self.left + col * size
+        ymax = self.top - row * size
+        return QgsRectangle(xmin, ymax - size, xmin + size, ymax)
+
+    def tile_range(self, zoom: int, extent: QgsRectangle) -> Optional[Tuple[int, int, int, int]]:
+        """ Return the range of the tiles intersecting the extent
+            as (col min, row min, col max, row max)
+
+            Return None if the extent is outside of the tile matrix
+        """
+        size = self.tile_dimension / (1 << zoom)
+        width, height = self.matrix_size(zoom)
+        col_min = max(0, math.floor((extent.xMinimum() - self.left) / size))
+        col_max = min(width - 1, math.ceil((extent.xMaximum() - self.left) / size) - 1)
+        row_min = max(0, math.floor((self.top - extent.yMaximum()) / size))
+        row_max = min(height - 1, math.ceil((self.top - extent.yMinimum()) / size) - 1)
+        if col_min > col_max or row_min > row_max:
+            return None
+        return col_min, row_min, col_max, row_max
+
+    def tile_matrix(self, zoom: int) -> Optional[QgsTileMatrix]:
+        """ Return the QgsTileMatrix at zoom level
+
+            Custom tile matrices require QGIS 3.22
+        """
+        if Qgis.QGIS_VERSION_INT >= 32200:
+            return QgsTileMatrix.fromCustomDef(zoom, self.crs, QgsPointXY(self.left, self.top),
+                                               self.tile_dimension, self.matrix_width, self.matrix_height)
+        if self.identifier == 'EPSG:3857':
+            return QgsTileMatrix.fromWebMercator(zoom)
+        return None
+
+    def tile_matrices(self) -> List[Dict]:
+        """ Return the OGC two dimensional tile matrices definition
+        """
+        return [{
+            'id': str(zoom),
+            'scaleDenominator': self.scale(zoom),
+            'cellSize': self.tile_dimension / TILE_SIZE / (1 << zoom),
+            'cornerOfOrigin': 'topLeft',
+            'pointOfOrigin': [self.left, self.top],
+            'tileWidth': TILE_SIZE,
+            'tileHeight': TILE_SIZE,
+            'matrixWidth': self.matrix_size(zoom)[0],
+            'matrixHeight': self.matrix_size(zoom)[1],
+        } for zoom in range(self.last_level + 1)]
+
+    def as_dict(self) -> Dict:
+        return {
+            'id': self.identifier,
+            'crs': self.identifier,
+            'topLeftCorner': [self.left, self.top],
+            'scaleDenominator': self.scale_denominator,
+            'tileSize': TILE_SIZE,
+            'matrixWidth': self.matrix_width,
+            'matrixHeight': self.matrix_height,
+            'minzoom': 0,
+            'maxzoom': self.last_level,
+        }
+
+
+def crs_extent(crs: QgsCoordinateReferenceSystem) -> QgsRectangle:
+    """ Return the crs area of use in crs units
+    """
+    wgs84 = QgsCoordinateReferenceSystem("EPSG:4326")
+    xform = QgsCoordinateTransform(wgs84, crs, QgsProject.instance().transformContext())
+    return xform.transformBoundingBox(crs.bounds())
+
+
+def tile_matrix_set_from_crs(crs: QgsCoordinateReferenceSystem, min_scale: float) -> TileMatrixSet:
+    """ Build the grid from the crs extent as the WMTS service does
+        for grids without configuration
+    """
+    extent = crs_extent(crs)
+    units_per_meter = QgsUnitTypes.fromUnitToUnitFactor(QgsUnitTypes.DistanceMeters, crs.mapUnits())
+    dimension = max(extent.width(), extent.height())
+    scale_denominator = dimension / (TILE_SIZE * OGC_PX_M * units_per_meter)
+    last_level = 0
+    scale = scale_denominator
+    while scale > min_scale and last_level < 30:
+        scale /= 2
+        last_level += 1
+    return TileMatrixSet(crs, extent.yMaximum(), extent.xMinimum(), scale_denominator, last_level)
+
+
+def read_tile_matrix_sets(project: QgsProject) -> Dict[str, TileMatrixSet]:
+    """ Read the tile matrix sets from the project WMTS grids configuration
+    """
+    crs_list = project.readListEntry("WMTSGrids", "CRS")[0]
+    configs = {}
+    for config in project.readListEntry("WMTSGrids", "Config")[0]:
+        parts = config.split(',')
+        if len(parts) != 5:
+            continue
+        try:
+            configs[parts[0]] = (float(parts[1]), float(parts[2]), float(parts[3]), int(parts[4]))
+        except ValueError:
+            continue
+
+    min_scale = project.readNumEntry("WMTSMinScale", "/", 5000)[0]
+
+    grids = {}
+    for authid in crs_list:
+        crs = QgsCoordinateReferenceSystem(authid)
+        if not crs.isValid():
+            continue
+        config = configs.get(authid, DEFAULT_GRIDS.get(authid))
+        if config:
+            grids[authid] = TileMatrixSet(crs, *config)
+        else:
+            grids[authid] = tile_matrix_set_from_crs(crs, min_scale)
+    return grids
+
+
+_project_tile_matrix_sets = OrderedDict()
+_cache_size = 32
+
+
+def project_tile_matrix_sets(project: QgsProject) -> Dict[str, TileMatrixSet]:
+    """ Return the tile matrix sets of the project
+
+        Tile matrix sets are cached per project
+    """
+    key = (project.fileName(), project.lastModified().toMSecsSinceEpoch())
+    grids = _project_tile_matrix_sets.get(key)
+    if grids is None:
+        grids = read_tile_matrix_sets(project)
+        _project_tile_matrix_sets[key] = grids
+        if len(_project_tile_matrix_sets) > _cache_size:
+            _project_tile_matrix_sets.popitem(last=False)
+    else:
+        _project_tile_matrix_sets.move_to_end(key)
+    return grids
+
+
+def default_tile_matrix_set(grids: Dict[str, TileMatrixSet]) -> Optional[TileMatrixSet]:
+    """ Return the default tile matrix set
+
+        EPSG:3857 is the default if configured, else the first
+        configured grid.
+    """
+    if DEFAULT_TILE_MATRIX_SET in grids:
+        return grids[DEFAULT_TILE_MATRIX_SET]
+    return next(iter(grids.values()), None)
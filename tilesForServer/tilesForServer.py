@@ -4,6 +4,7 @@ __email__ = 'info@3liz.org'
 
 from qgis.server import QgsServerInterface
 
+from tilesForServer.ogcapi import init_ogc_tiles_api
 from tilesForServer.tmsapi import init_tms_api
 
 
@@ -11,3 +12,4 @@ class TilesForServer:
 
     def __init__(self, server_iface: QgsServerInterface) -> None:
         init_tms_api(server_iface)
+        init_ogc_tiles_api(server_iface)
@@ -0,0 +1,78 @@
+""" Vector tile layer filters from the layer styles
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+from typing import List, Optional
+
+from qgis.core import QgsFeatureRenderer, QgsRuleBasedRenderer, QgsVectorLayer
+
+TRUE = 'TRUE'
+FALSE = 'FALSE'
+
+
+def layer_in_scale_range(layer: QgsVectorLayer, scale: float) -> bool:
+    """ Check the scale based visibility of the layer
+    """
+    return not layer.hasScaleBasedVisibility() or layer.isInScaleRange(scale)
+
+
+def _and(expressions: List[str]) -> str:
+    expressions = [e for e in expressions if e != TRUE]
+    if FALSE in expressions:
+        return FALSE
+    if not expressions:
+        return TRUE
+    if len(expressions) == 1:
+        return expressions[0]
+    return ' AND '.join(f"({e})" for e in expressions)
+
+
+def _or(expressions: List[str]) -> str:
+    expressions = [e for e in expressions if e != FALSE]
+    if TRUE in expressions:
+        return TRUE
+    if not expressions:
+        return FALSE
+    if len(expressions) == 1:
+        return expressions[0]
+    return ' OR '.join(f"({e})" for e in expressions)
+
+
+def _rule_filter(rule: QgsRuleBasedRenderer.Rule, scale: float) -> Optional[str]:
+    """ Return the filter of the features drawn by the rule
+
+        Return None if the filter cannot be expressed
+    """
+    if not rule.active() or not rule.isScaleOK(scale):
+        return FALSE
+    if rule.isElse():
+        # Else rules depend on the sibling rules
+        return None
+
+    expression = rule.filterExpression() or TRUE
+    if rule.symbol():
+        return expression
+
+    children = []
+    for child in rule.children():
+        child_filter = _rule_filter(child, scale)
+        if child_filter is None:
+            return None
+        children.append(child_filter)
+    return _and([expression, _or(children)])
+
+
+def renderer_filter(renderer: QgsFeatureRenderer, scale: float) -> Optional[str]:
+    """ Return the filter of the features drawn by the renderer at scale
+
+        Only rule-based renderers are translated, return None if the
+        renderer draws all the features or if the rules cannot be
+        expressed as a filter. Return `FALSE` if no feature is drawn.
+    """
+    if not isinstance(renderer, QgsRuleBasedRenderer):
+        return None
+    expression = _rule_filter(renderer.rootRule(), scale)
+    if expression == TRUE:
+        return None
+    return expression
@@ -0,0 +1,127 @@
+""" Background tile store writes
+
+    Tiles are written to the tile stores by a pool of threads
+    so that responses are not delayed by the stores latency.
+
+    author: 3Liz
+    Copyright: (C) 2021 3Liz
+"""
+import queue
+import threading
+
+from typing import Callable, Dict, Optional
+
+from qgis.core import Qgis, QgsMessageLog
+
+from tilesForServer.config import getenv_int
+
+
+class WriteBack:
+    """ Bounded background writer
+
+        Pending writes to the same key are deduplicated: only the
+        last submitted write is executed. Writes are dropped when
+        the queue is full.
+    """
+
+    def __init__(self, threads: int = 2, max_queue: int = 1000) -> None:
+        self._threads = threads
+        self._queue = queue.Queue(max_queue)
+        self._pending: Dict[bytes, Callable[[], None]] = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._written = 0
+        self._deduplicated = 0
+        self._dropped = 0
+        self._errors = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['WriteBack']:
+        """ Create the writer from the environment
+
+            * `QGIS_TILES_WRITEBACK_THREADS`: number of writer threads,
+              writes are synchronous if not set
+            * `QGIS_TILES_WRITEBACK_QUEUE_SIZE`: maximum number of pending writes
+        """
+        threads = getenv_int('QGIS_TILES_WRITEBACK_THREADS')
+        if threads <= 0:
+            return None
+        return cls(threads, getenv_int('QGIS_TILES_WRITEBACK_QUEUE_SIZE', 1000))
+
+    def submit(self, key: bytes, write: Callable[[], None]) -> bool:
+        """ Queue the write for key
+
+            Return False if the write is dropped
+        """
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = write
+                self._deduplicated += 1
+                return True
+            try:
+                self._queue.put_nowait(key)
+            except queue.Full:
+                self._dropped += 1
+                return False
+            self._pending[key] = write
+            if not self._workers:
+                self._start()
+        return True
+
+    def discard(self, keys) -> None:
+        """ Cancel the pending writes of keys
+        """
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+
+    def _start(self) -> None:
+        for i in range(self._threads):
+            worker = threading.Thread(target=self._run, name=f"tiles-writeback-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _run(self) -> None:
+        while True:
+            key = self._queue.get()
+            try:
+                with self._lock:
+                    write = self._pending.pop(key, None)
+                if write is None:
+                    continue
+                write()
+                self._written += 1
+            except Exception as err:
+                self._errors += 1
+                QgsMessageLog.logMessage(f"Failed to write tile: {err}", "tilesApi", Qgis.Warning)
+            finally:
+                self._queue.task_done()
+
+    def join(self) -> None:
+        """ Wait for the pending writes
+        """
+        self._queue.join()
+
+    def stats(self) -> Dict:
+        return {
+            'threads': self._threads,
+            'pending': self._queue.qsize(),
+            'written': self._written,
+            'deduplicated': self._deduplicated,
+            'dropped': self._dropped,
+            'errors': self._errors,
+        }
+
+
+_writeback: Optional[WriteBack] = None
+_initialized = False
+
+
+def writeback() -> Optional[WriteBack]:
+    """ Return the background writer or None if writes are synchronous
+    """
+    global _writeback, _initialized
+    if not _initialized:
+        _writeback = WriteBack.from_env()
+        _initialized = True
+    return _writeback